@@ -26,6 +26,7 @@ from osgeo import ogr, osr
 import os
 from pydynamind import *
 from pydmtoolbox import *
+import ubblockstore as ubstore
 
 class ExportToGISShapeFile(Module):
     """A Custom Export Module for UrbanBEATS Maps that exports the required
@@ -337,10 +338,13 @@ class ExportToGISShapeFile(Module):
             layer.CreateField(field)
             layer.GetLayerDefn()
         
-        #Get Blocks View
+        #Get Blocks View, Block attributes kept in a Block attribute store are copied onto the faces first
+        blockstore = ubstore.getBlockStore(map_attr)
         uuids = city.getUUIDsOfComponentsInView(self.block)
         for i in range(len(uuids)):
             currentAttList = city.getFace(uuids[i])
+            if blockstore is not None:
+                blockstore.writeToFace(currentAttList)
         
             #Draw Geometry
             line = ogr.Geometry(ogr.wkbPolygon)
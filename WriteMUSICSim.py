@@ -24,6 +24,8 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
 import ubmusicwrite as ubmusic
+import ubactiveblocks as ubactive
+import ubblockstore as ubstore
 from pydynamind import * 
 import sys, random, numpy, math
 
@@ -71,6 +73,7 @@ class WriteResults2MUSIC(Module):
         self.addData("City", datastream)
 	
 	self.BLOCKIDtoUUID = {}
+	self.blockstore = None
 	
     def run(self):
 	city = self.getData("City")
@@ -78,9 +81,11 @@ class WriteResults2MUSIC(Module):
 	
 	strvec = city.getUUIDsOfComponentsInView(self.mapattributes)
         map_attr = city.getComponent(strvec[0])
+        self.blockstore = ubstore.getBlockStore(map_attr)      #None if the Block attributes are kept on the faces
         
         #get data needed to being for loop analysis
         blocks_num = map_attr.getAttribute("NumBlocks").getDouble()     #number of blocks to loop through
+        activeIDs = ubactive.getActiveBlockIDs(map_attr, blocks_num)    #only the active Blocks are written
         blocks_size = map_attr.getAttribute("BlockSize").getDouble()    #size of block
         map_w = map_attr.getAttribute("WidthBlocks").getDouble()        #num of blocks wide
         map_h = map_attr.getAttribute("HeightBlocks").getDouble()       #num of blocks tall
@@ -107,8 +112,7 @@ class WriteResults2MUSIC(Module):
             ncount = 1
             musicnodedb = {}       #contains the database of nodes for each Block
             
-            for i in range(int(blocks_num)):
-                currentID = i+1
+            for currentID in activeIDs:
                 currentAttList = self.getBlockUUID(currentID, city)
                 if currentAttList.getAttribute("Status").getDouble() == 0:
                     continue    #Skip block since it has no info
@@ -198,8 +202,7 @@ class WriteResults2MUSIC(Module):
                     ubmusic.writeMUSIClink(ufile, nodelinks[link][0], nodelinks[link][1])
             
             #(5) WRITE ALL LINKS BETWEEN BLOCKS
-            for i in range(int(blocks_num)):
-                currentID = i+1
+            for currentID in activeIDs:
                 currentAttList = self.getBlockUUID(currentID, city)
                 if currentAttList.getAttribute("Status").getDouble() == 0:
                     continue    #Skip block since it has no info
@@ -405,6 +408,8 @@ class WriteResults2MUSIC(Module):
     #DYNAMIND FUNCTIONS                                    #
     ########################################################
     def getBlockUUID(self, blockid,city):
+	if self.blockstore is not None:
+		return self.blockstore.record(blockid)     #attributes are read and written through the Block attribute store
 	try:
 		key = self.BLOCKIDtoUUID[blockid]
 	except KeyError:
@@ -26,9 +26,14 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 import PyQt4
-import math, time
+import math, time, hashlib
+import numpy as np
 import random as rand
 import ubpatchdelin as ubpat
+import ubblockaggregate as ubagg
+import ubterrain as ubterr
+import ubactiveblocks as ubactive
+import ubblockstore as ubstore
 import ubconvertcoord as ubcc
 import ubvectormapload as ubvmap
 #import urbanbeatsdatatypes as ubdata    #UBCORE
@@ -128,6 +133,7 @@ class Delinblocks(Module):      #DYNAMIND
         self.createParameter("include_employment", BOOL, "")
         self.createParameter("jobdatatype", STRING, "")
         self.createParameter("include_rivers", BOOL, "")
+        self.createParameter("river_import", STRING, "")
         self.createParameter("include_lakes", BOOL, "")
         self.createParameter("include_groundwater", BOOL, "")
         self.createParameter("groundwater_datum", STRING, "")
@@ -142,6 +148,15 @@ class Delinblocks(Module):      #DYNAMIND
         self.createParameter("socpar2_type", STRING, "")
         self.createParameter("patchdelin", BOOL, "")
         self.createParameter("spatialmetrics", BOOL, "")        #DYNAMIND
+        self.createParameter("stream_rasters", BOOL, "")
+        self.createParameter("parallel_workers", DOUBLE, "")
+        self.createParameter("incremental_delin", BOOL, "")
+        self.createParameter("block_store", STRING, "")
+        self.createParameter("nhd_stats", BOOL, "")
+        self.createParameter("nhd_radius", DOUBLE, "")
+        self.createParameter("aggregate_pyramid", BOOL, "")
+        self.createParameter("rng_seed", DOUBLE, "")
+        self.createParameter("rng_cycle", DOUBLE, "")
         #-------> DYNAMIND 
 
         self.popdatatype = "D"                  #population data type: D = density, C = count
@@ -154,6 +169,7 @@ class Delinblocks(Module):      #DYNAMIND
         self.include_employment = False         #include employment data for industrial land uses?
         self.jobdatatype = "D"                  #employment data type: D = density, C = count
         self.include_rivers = False             #include river systems
+        self.river_import = "L"                 #L = walk the river lines through the Block grid, P = points every cs/4 along the rivers
         self.include_lakes = False              #include lake systems
         self.include_groundwater = False        #include groundwater table
         self.groundwater_datum = "Sea"          #"Sea" = Sea level, "Surf" = Surface level
@@ -171,6 +187,16 @@ class Delinblocks(Module):      #DYNAMIND
         
         self.patchdelin = True                  #perform patch delineation? All subsequent algorithms will need to consider this
         self.spatialmetrics = True              #perform calculation of spatial metrics? Just an additional feature
+        self.stream_rasters = False             #read the input rasters one row of Blocks at a time? Bounds memory for very large inputs
+        self.parallel_workers = 1               #number of worker processes for patch delineation, 1 = no parallel processing
+        self.incremental_delin = False          #reuse the Blocks whose input data did not change since the last run (block cache)?
+        self.block_store = ""                   #directory of the memory-mapped Block attribute store, "" = attributes on the Block faces
+        self.blockstore = None
+        self.nhd_stats = False                  #calculate land use shares and population in the neighbourhood of each Block?
+        self.nhd_radius = 500.0                 #[m] distance from the Block within which the neighbourhood statistics are taken
+        self.aggregate_pyramid = False          #derive power of two multiples of a previous run's Block size from the aggregate pyramid?
+        self.rng_seed = 1                       #seed of the per-Block random streams of the planning modules, 0 = draw a random seed every run, see ubrandom
+        self.rng_cycle = 0                      #cycle of the simulation (e.g. the year), every cycle draws from its own streams
         
         #Local Extents and Map Connectivity                   
         #DYNAMIND ------>        
@@ -180,6 +206,9 @@ class Delinblocks(Module):      #DYNAMIND
         self.createParameter("flow_method", STRING,"")
         self.createParameter("demsmooth_choose", BOOL,"")
         self.createParameter("demsmooth_passes", DOUBLE,"")
+        self.createParameter("dinf_realizations", DOUBLE,"")
+        self.createParameter("dinf_seed", DOUBLE,"")
+        self.createParameter("sink_method", STRING,"")
         #------> DYNAMIND 
         
         self.Neighbourhood = "M"                #three options: M = Moore, N = von Neumann
@@ -188,6 +217,9 @@ class Delinblocks(Module):      #DYNAMIND
         self.flow_method = "D8"                 #three options: DI = D-infinity (Tarboton), D8 = D8 (O'Callaghan & Mark) and MS = Divergent (Freeman)
         self.demsmooth_choose = False
         self.demsmooth_passes = 1
+        self.dinf_realizations = 1              #number of stochastic D-infinity realizations drawn in one batch
+        self.dinf_seed = 0                      #seed of the D-infinity RNG streams, 0 = draw a random seed
+        self.sink_method = "U"                  #two options: U = unblock sinks in immediate neighbourhood, PF = priority-flood depression filling
         
         #Regional Geography
         #DYNAMIND ------------>        
@@ -212,10 +244,16 @@ class Delinblocks(Module):      #DYNAMIND
         self.createParameter("RiversFilename", STRING, "")
         self.createParameter("LakesFilename", STRING, "")
         self.createParameter("obtain_flowbasins", STRING, "")           #changed internally depending on cycle to skip flowpath delineation
+        self.createParameter("FlowBasinsFilename", STRING, "")          #cache of the flow paths and basins, reused if the terrain is unchanged
+        self.createParameter("BlockCacheFilename", STRING, "")          #cache of the aggregated Blocks and patches for incremental_delin
+        self.createParameter("PyramidFilename", STRING, "")             #aggregate pyramid of the Block sums for aggregate_pyramid
         self.LocalityFilename = "C:/UrbanBEATSv1CaseStudies/Yarra Estuary Catchment/GIS Maps/LocalityMap_UTM.shp"
         self.RiversFilename = "C:/UrbanBEATSv1CaseStudies/Yarra Estuary Catchment/GIS Maps/Rivers_UTM.shp"
         self.LakesFilename = "C:/UrbanBEATSv1CaseStudies/Yarra Estuary Catchment/GIS Maps/Lakes.shp"
-        self.obtain_flowbasins = "D"                                    #F = file, D = delineate
+        self.obtain_flowbasins = "F"                                    #F = file (if still valid), D = delineate
+        self.FlowBasinsFilename = ""                                    #e.g. the simulation's output folder + "flowbasins.npz", "" = no cache
+        self.BlockCacheFilename = "simulationblockcache.npz"
+        self.PyramidFilename = "simulationpyramid.npz"
         
         self.createParameter("xllcorner", DOUBLE, "")
         self.createParameter("yllcorner", DOUBLE, "")
@@ -224,7 +262,7 @@ class Delinblocks(Module):      #DYNAMIND
         #-------------> DYNAMIND
         
         #LATER ON! FOR LATER CYCLES - CHANGING THIS VARIABLE WILL ALLOW SKIPPING OF FLOWPATHS AND BASIN DELINATION!
-        self.obtain_flowbasins = "D"                                    #F = file, D = delineate
+        #With "F" the cached delineation is only used if its key still matches the terrain and settings
         
 #        self.xllcorner = 0    #UBCORE Obtained from the loaded raster data (elevation) upon run-time
 #        self.yllcorner = 0    #UBCORE spatial extents of the input map
@@ -274,6 +312,12 @@ class Delinblocks(Module):      #DYNAMIND
         self.mapattributes.addAttribute("CBDLocationLong")
         self.mapattributes.addAttribute("CBDLocationLat")
         self.mapattributes.addAttribute("TotalBasins")
+        self.mapattributes.addAttribute("ActiveBlockIDs")
+        self.mapattributes.addAttribute("NumActiveBlocks")
+        self.mapattributes.addAttribute("BlockStore")
+        self.mapattributes.addAttribute("NhdRadius")
+        self.mapattributes.addAttribute("RNGSeed")
+        self.mapattributes.addAttribute("RNGCycle")
         self.mapattributes.addAttribute("include_plan_map")
         self.mapattributes.addAttribute("include_local_map")
         self.mapattributes.addAttribute("include_employment")
@@ -334,6 +378,7 @@ class Delinblocks(Module):      #DYNAMIND
         self.block.addAttribute("PM_LI")
         self.block.addAttribute("PM_HI")
         self.block.addAttribute("HasRiv")
+        self.block.addAttribute("RivLength")        #Length of river within the Block [m], river_import = L only
         self.block.addAttribute("HasLake")
         self.block.addAttribute("LakeAr")
         self.block.addAttribute("HasLoc")
@@ -344,15 +389,25 @@ class Delinblocks(Module):      #DYNAMIND
         self.block.addAttribute("ShDIV")           #Shannon Diversity Index
         self.block.addAttribute("ShDOM")           #Shannon Dominance Index
         self.block.addAttribute("ShEVEN")          #Shannon Evenness Index
+        for luc in ubagg.LANDUSE_CLASSES:
+            self.block.addAttribute("NhdLU_"+luc)   #Share of the land use class in the Block's neighbourhood (within nhd_radius)
+        self.block.addAttribute("NhdPop")           #Total people LIVING in the Block's neighbourhood
         
         self.block.addAttribute("downID")            #ID block water flows to naturally
         self.block.addAttribute("maxdZ")            #maximum drop in elevation
         self.block.addAttribute("slope")            #average slope
+        self.block.addAttribute("downProb")         #probability of flowing to downID (D-infinity), 1 for D8
+        self.block.addAttribute("altDownID")        #other neighbour of the steepest D-infinity facet, -1 if none
+        self.block.addAttribute("altProb")          #probability of flowing to altDownID (D-infinity), 0 for D8
+        self.block.addAttribute("outAgree")         #share of D-infinity realizations draining into the same end Block
         self.block.addAttribute("drainID")           #ID block drains to if a sink
         self.block.addAttribute("h_pond")               #height of ponding before sink can drain
         self.block.addAttribute("Outlet")       #If the Block is an outlet = 1, yes - 0, no
         self.block.addAttribute("CBDdist")          #Distance from CBD [km]
         self.block.addAttribute("CBDdir")         #Which direction to travel from CBD to get to Block? Specified as an angle in degrees
+        self.block.addAttribute("RivDist")          #Distance to the nearest Block with a river [m]
+        self.block.addAttribute("LakeDist")         #Distance to the nearest Block with a lake [m]
+        self.block.addAttribute("FacDist")          #Distance to the nearest Block with a facility of the locality map [m]
         
         self.block.addAttribute("UpstrIDs")
         self.block.addAttribute("DownstrIDs")
@@ -548,7 +603,8 @@ class Delinblocks(Module):      #DYNAMIND
         else: employment = 0
         
         #(4) - Rivers Map
-        if self.include_rivers: riverpoints = ubvmap.runRiverImport(float(cs/4), self.RiversFilename)
+        if self.include_rivers and self.river_import == "L": riverpoints = ubvmap.runRiverLineImport(self.RiversFilename)
+        elif self.include_rivers: riverpoints = ubvmap.runRiverImport(float(cs/4), self.RiversFilename)
         else: riverpoints = 0
         
         #(5) - Lakes Map
@@ -636,6 +692,20 @@ class Delinblocks(Module):      #DYNAMIND
         map_attr.addAttribute("spatialmetrics", self.spatialmetrics)
         map_attr.addAttribute("considerCBD", self.considerCBD)
         
+        #Block attributes are written to the columnar store instead of the faces if one is used, see ubblockstore
+        self.blockstore = None
+        if self.block_store != "":
+            self.blockstore = ubstore.createBlockStore(self.block_store, numblocks)
+        map_attr.addAttribute("BlockStore", self.block_store)
+        
+        #Seed and cycle of the per-Block random streams used by urbplanbb and techplacement. The seed
+        #does not depend on the inputs, so a scenario change only alters the streams of the Blocks it touches
+        if int(self.rng_seed) == 0:
+            map_attr.addAttribute("RNGSeed", rand.randint(1, 2147483647))
+        else:
+            map_attr.addAttribute("RNGSeed", int(self.rng_seed))
+        map_attr.addAttribute("RNGCycle", int(self.rng_cycle))
+        
         city.addComponent(map_attr, self.mapattributes)                 #DYNAMIND: add the component list map_attr to the View self.mapattributes        
         
         #Look up long and lat of CBD if need to be considered
@@ -672,17 +742,87 @@ class Delinblocks(Module):      #DYNAMIND
         x_adj = 0               #these track the position of the 'draw cursor', these offset the cursor
         y_adj = 0               #can be used to offset the drawing completely from (0,0)
         
+        #Neighbour IDs of all Blocks [N, S, W, E, NE, NW, SE, SW], kept on the module for all terrain routines
+        self.neighbourtable = ubterr.buildNeighbourTable(widthnew, heightnew)
+        
+        ########################################################################
+        ### AGGREGATE INPUT DATA TO BLOCKS                                   ###
+        ########################################################################
+        #All input rasters are read once and all Block statistics are computed in a few array passes
+        #the Block loop below then only looks up the values for the current Block. When streaming,
+        #only one strip of cellsinblock raster rows is resident at a time, read at the start of each row of Blocks
+        datasources = [landuseraster, population, elevationraster, soilraster, plan_map, employment, groundwater, socpar1, socpar2]
+        blockdata = {"ElevationHash" : hashlib.sha1(), "Digests" : {}}
+        
+        #Incremental delineation: Blocks whose input raster windows are unchanged since the last run reuse
+        #their cached values and patches, only the Blocks that redeveloped are aggregated and delineated again
+        blockcache = None
+        packedpatches = []
+        if self.incremental_delin:
+            blockcachekey = ubagg.getBlockCacheKey([cs, inputres, widthnew, heightnew, self.soildatatype, self.soildataunits,
+                                                    self.soildictionary, self.popdatatype, self.jobdatatype, self.elevdatadatum,
+                                                    self.elevdatacustomref, self.groundwater_datum, self.patchdelin,
+                                                    [source != 0 for source in datasources]])
+            blockcache = self.retrieveBlockCacheFromFile(self.BlockCacheFilename, blockcachekey, numblocks)
+        
+        #Aggregate pyramid: the Block sums of a run at a finer Block size are summed up 2x2 per level, if the
+        #current Block size is a power of two multiple of it only a lattice of raster cells is read for the
+        #rasters' fingerprints (see rasterFingerprint). Patches and the block cache need the raster cells,
+        #so the pyramid is only read without them
+        pyramid = None
+        pyramidsums = None
+        if self.aggregate_pyramid:
+            pyramidkey = ubagg.getPyramidKey([inputres, width, height, self.soildatatype, self.soildataunits, self.soildictionary,
+                                              [source != 0 for source in datasources]],
+                                             [ubagg.rasterFingerprint(source) for source in datasources if source != 0])
+            pyramid = self.retrievePyramidFromFile(self.PyramidFilename, pyramidkey)
+            if pyramid is not None and not self.patchdelin and not self.incremental_delin:
+                pyramidsums = ubagg.getPyramidLevel(pyramid, cs, cellsinblock, (heightnew, widthnew))
+        
+        if pyramidsums is not None:
+            self.storeBlockSums(pyramidsums, blockdata, slice(0, numblocks), numblocks, cellsinblock, inputres)
+            blockdata["ElevationHash"].update(pyramidkey)
+            blockdata["ElevationHash"].update(np.ascontiguousarray(pyramidsums["ElevSum"]).tostring())
+            print "Block data derived from the aggregate pyramid in", self.PyramidFilename
+        elif not self.stream_rasters:
+            celldata = self.aggregateBlockData(datasources, blockdata, blockcache, widthnew, heightnew, 0, heightnew, cellsinblock, inputres)
+            blockpatches = self.delineateBlockPatches(celldata, blockdata, blockcache, widthnew, cellsinblock)
+            if self.incremental_delin: packedpatches.append(ubpat.packPatches(blockpatches))
+        
         ########################################################################
         ### DRAW BLOCKS AND ASSIGN INFO                                      ###
         ######################################################################## 
+        riverblocks = np.zeros(numblocks, dtype = np.int32)     #HasRiv of every Block for the terrain store
+        
+        #Distance and direction from the CBD, calculated for all Blocks at once
+        if self.considerCBD:
+            cbddist, cbddir = self.calcCBDDistances(cityeasting, citynorthing, widthnew, numblocks, cs)
+        
+        #Spatial index of the vector data, all points are binned into their Blocks once
+        gridxorigin = x_adj*cs + self.xllcorner
+        gridyorigin = y_adj*cs + self.yllcorner
+        if self.include_rivers and self.river_import == "L": rivercrossed, riverlength = ubagg.walkLinesThroughBlocks(riverpoints, gridxorigin, gridyorigin, cs, widthnew, heightnew)
+        elif self.include_rivers: riverindex = ubagg.binPointsToBlocks(riverpoints, 0, 1, gridxorigin, gridyorigin, cs, widthnew, heightnew)
+        if self.include_lakes: lakeindex = ubagg.binPointsToBlocks(lakepoints, 0, 1, gridxorigin, gridyorigin, cs, widthnew, heightnew)
+        if self.include_local_map: localityindex = ubagg.binPointsToBlocks(localitymap, 1, 2, gridxorigin, gridyorigin, cs, widthnew, heightnew)
+        
         blockIDcount = 1     #counts through Block ID, initialize this variable here
         for y in range(heightnew):              #outer loop scans through rows
+            if self.stream_rasters and pyramidsums is None:
+                celldata = None                 #drop the previous strip before reading the next one
+                celldata = self.aggregateBlockData(datasources, blockdata, blockcache, widthnew, heightnew, y, y+1, cellsinblock, inputres)
+                blockpatches = self.delineateBlockPatches(celldata, blockdata, blockcache, widthnew, cellsinblock)
+                if self.incremental_delin: packedpatches.append(ubpat.packPatches(blockpatches))
+            
             for x in range(widthnew):           #inner loop scans through columns
 
                 print "CURRENT BLOCK ID: "+str(blockIDcount)           #DYNAMIND                
 #                self.printc("CURRENT BLOCK ID: "+str(blockIDcount))     #UBCORE
 
                 block_attr = self.createBlockFace(city, x, y, cs, x_adj, y_adj, blockIDcount)   #DYNAMIND                
+                if self.blockstore is not None:
+                    block_attr = self.blockstore.record(blockIDcount)        #the face only keeps geometry and BlockID
+                    block_attr.addAttribute("BlockID", blockIDcount)
 #                block_attr = self.createBlockFace(x, y, cs, x_adj, y_adj, blockIDcount)         #UBCORE
                 
                 xcentre = x*cs+0.5*cs       #Centre point               
@@ -705,7 +845,7 @@ class Delinblocks(Module):      #DYNAMIND
                 ####################################################
                 ### 1.1 DETERMINE BLOCK NEIGHBOURHOOD            ###
                 ####################################################
-                blockNHD = self.findNeighbourhood(blockIDcount, x, y, numblocks, widthnew, heightnew)
+                blockNHD = self.getBlockNeighbourhood(blockIDcount)      #Neighbours are taken from the precomputed table
                 block_attr.addAttribute("Nhd_N", blockNHD[0])             #North neighbour Block ID
                 block_attr.addAttribute("Nhd_S", blockNHD[1])             #South neighbour Block ID
                 block_attr.addAttribute("Nhd_W", blockNHD[2])             #West neighbour Block ID
@@ -720,37 +860,18 @@ class Delinblocks(Module):      #DYNAMIND
                 ### 1.2 CALCULATE DISTANCE FROM CBD IF NECESSARY ###
                 ####################################################
                 if self.considerCBD:
-                    currenteasting = xcentre + self.xllcorner
-                    currentnorthing = ycentre + self.yllcorner
-                    
-                    #Calculate distance and angle
-                    dist = math.sqrt(math.pow((cityeasting-currenteasting),2)+math.pow((citynorthing-currentnorthing),2))
-                    theta = math.degrees(math.atan((currentnorthing - citynorthing)/(currenteasting - cityeasting)))
-                    
-                    block_attr.addAttribute("CBDdist", dist)
-                    block_attr.addAttribute("CBDdir", theta)
+                    block_attr.addAttribute("CBDdist", float(cbddist[blockIDcount-1]))
+                    block_attr.addAttribute("CBDdir", float(cbddir[blockIDcount-1]))
                 
                 
                 ####################################################
-                ### 1.3 RETRIEVE EXACT VALUES FROM INPUT DATA    ###
+                ### 1.3 RETRIEVE AGGREGATED VALUES FOR BLOCK     ###
                 ####################################################
-                datasources = [landuseraster, population, elevationraster, soilraster, plan_map, employment, groundwater, socpar1, socpar2]
-                datamatrices = self.retrieveData(datasources, [x_start, y_start], cellsinblock)
-                
-                lucdatamatrix = datamatrices[0]         #holds land use data from input 
-                popdatamatrix = datamatrices[1]         #holds population data from input 
-                elevdatamatrix = datamatrices[2]        #holds elevation data from input
-                soildatamatrix = datamatrices[3]        #holds soil data from input
-                
-                planmapmatrix = datamatrices[4]
-                employmentmatrix = datamatrices[5]
-                groundwatermatrix = datamatrices[6]
-                                
-                socpar1matrix = datamatrices[7]
-                socpar2matrix = datamatrices[8]
+                bindex = blockIDcount - 1       #position of the current Block in the aggregated block arrays
                 
-                #Determine frequency of land class occurrences
-                landclassprop, activity = self.frequencyLUC(lucdatamatrix)
+                #Frequency of land class occurrences
+                landclassprop = list(blockdata["LUC"][:,bindex])
+                activity = blockdata["Active"][bindex]
                 
                 if activity == 0:
                     blockstatus = 0
@@ -792,172 +913,75 @@ class Delinblocks(Module):      #DYNAMIND
                 block_attr.addAttribute("pLU_NA", landclassprop[12])                
                 
                 #Averages & Counts for Soil, Elevation, Population and additional inputs
-                raster_sum_soil, total_n_soil = 0, 0
-                raster_sum_elev, total_n_elev = 0, 0
-                pop_sum_total = 0
-                soc_par1, total_n_soc_par1 = 0, 0       #to tally up an average in case
-                soc_par2, total_n_soc_par2 = 0, 0       #to tally up an average in case    
-                job_sum_total = 0
-                
-                plan_map_sums = [0,0,0,0]       #4 categories of planner's map dependent on RES, COM, LI, HI
-                plan_map_counts = [0,0,0,0]
-                
-                elevlist = []
-                
-                for a in range(cellsinblock):        #Loop across all cells in the block
-                    for b in range(cellsinblock):
-                        if soildatamatrix[a][b] != -9999:
-                            raster_sum_soil += soildatamatrix[a][b]
-                            total_n_soil += 1
-                        if elevdatamatrix[a][b] != -9999:
-                            total_n_elev += 1
-                            elevlist.append(elevdatamatrix[a][b])
-                            if self.elevdatadatum == "S":
-                                raster_sum_elev += elevdatamatrix[a][b]
-                            elif self.elevdatadatum == "C":
-                                raster_sum_elev += elevdatamatrix[a][b] + self.elevdatacustomref #bring it back to sea level
-                            
-                        if popdatamatrix[a][b] != -9999:
-                            if self.popdatatype == "C":                         #If population data is a count
-                                pop_sum_total += popdatamatrix[a][b]
-                            else:                                               #Else population data is a density [pax/ha]
-                                pop_sum_total += popdatamatrix[a][b] * (inputres*inputres)/10000
-                        
-                        #PLANNER'S MAP
-                        if self.include_plan_map:
-                            lucplanindex = [1, 2, 4, 5]     #numbers are LUC categories that planner's map deals with
-                            if lucdatamatrix[a][b] in lucplanindex:
-                                lucindex = lucplanindex.index(lucdatamatrix[a][b])
-                                if len(planmapmatrix) != 0 and planmapmatrix[a][b] != -9999:
-                                    plan_map_sums[lucindex] += planmapmatrix[a][b]
-                                    plan_map_counts[lucindex] += 1
-                                    
-                        #EMPLOYMENT - Like Population
-                        if self.include_employment:
-                            if employmentmatrix[a][b] != -9999:
-                                if self.jobdatatype == "C":
-                                    job_sum_total += employmentmatrix[a][b]
-                                else:
-                                    job_sum_total += employmentmatrix[a][b] * (inputres*inputres)/10000
-                            
-                        #GROUNDWATER TABLE - Like Elevation, but scaled based on correct datum
-                        if self.include_groundwater:
-                            gwdepthcumu = 0
-                            gwcount = 0
-                            if groundwatermatrix[a][b] != -9999:
-                                gwdepthcumu += groundwatermatrix[a][b]
-                                gwcount += 1
-                        
-                        #SOCIAL PARAMETERS - Like Population if proportion, if Binary, based on majority
-                        if self.include_soc_par1:
-                            if len(socpar1matrix) != 0:
-                                if socpar1matrix[a][b] != -9999:
-                                    soc_par1 += socpar1matrix[a][b]
-                                    total_n_soc_par1 += 1
-                        if self.include_soc_par2:
-                            if len(socpar2matrix) != 0 :
-                                if socpar2matrix[a][b] != -9999:
-                                    soc_par2 += socpar2matrix[a][b]
-                                    total_n_soc_par2 += 1
-                               
-                #Adjust the total count in case it is zero to prevent division by zero. If count = 0, then sum = 0 because nothing was found
-                total_n_soil = self.adjustCount(total_n_soil)
-                total_n_elev = self.adjustCount(total_n_elev)
-                total_n_soc_par1 = self.adjustCount(total_n_soc_par1)
-                total_n_soc_par2 = self.adjustCount(total_n_soc_par2)
-                for a in range(len(plan_map_counts)):
-                    plan_map_counts[a] = self.adjustCount(plan_map_counts[a])
-                
-                block_attr.addAttribute("Soil_k", raster_sum_soil/total_n_soil)
-                block_attr.addAttribute("AvgElev", raster_sum_elev/total_n_elev)
-                block_attr.addAttribute("Pop", pop_sum_total)
+                avgelev = blockdata["AvgElev"][bindex]
+                block_attr.addAttribute("Soil_k", blockdata["Soil_k"][bindex])
+                block_attr.addAttribute("AvgElev", avgelev)
+                block_attr.addAttribute("Pop", blockdata["Pop"][bindex])
                 
                 if blockstatus == 1:
 #                    curblock_node = ubdata.UBVector([(xcentre,ycentre,0)])              #UBCORE
                     curblock_node = city.addNode(xcentre,ycentre,0, self.blocknodes)    #DYNAMIND
                     curblock_node.addAttribute("BlockID", blockIDcount)
-                    curblock_node.addAttribute("AvgElev", raster_sum_elev/total_n_elev)
+                    curblock_node.addAttribute("AvgElev", avgelev)
                     curblock_node.addAttribute("Type", "Block")
 #                    self.activesim.addAsset("CPBlockID"+str(blockIDcount), curblock_node)   #UBCORE
                 
                 if self.include_soc_par1:
-                    block_attr.addAttribute("SocPar1", soc_par1/total_n_soc_par1)
+                    block_attr.addAttribute("SocPar1", blockdata["SocPar1"][bindex])
                 if self.include_soc_par2:
-                    block_attr.addAttribute("SocPar2", soc_par2/total_n_soc_par2)
+                    block_attr.addAttribute("SocPar2", blockdata["SocPar2"][bindex])
                 if self.include_plan_map:
-                    block_attr.addAttribute("PM_RES", plan_map_sums[0]/plan_map_counts[0])
-                    block_attr.addAttribute("PM_COM", plan_map_sums[1]/plan_map_counts[1])
-                    block_attr.addAttribute("PM_LI", plan_map_sums[2]/plan_map_counts[2])
-                    block_attr.addAttribute("PM_HI", plan_map_sums[3]/plan_map_counts[3])
+                    block_attr.addAttribute("PM_RES", blockdata["PM_RES"][bindex])
+                    block_attr.addAttribute("PM_COM", blockdata["PM_COM"][bindex])
+                    block_attr.addAttribute("PM_LI", blockdata["PM_LI"][bindex])
+                    block_attr.addAttribute("PM_HI", blockdata["PM_HI"][bindex])
                 if self.include_employment:
-                    block_attr.addAttribute("Employ", job_sum_total)           #Total people EMPLOYED in block
+                    block_attr.addAttribute("Employ", blockdata["Employ"][bindex])           #Total people EMPLOYED in block
                 if self.include_groundwater:
-                    if self.groundwater_datum == "Sea":
-                        if total_n_elev == 0 or gwcount == 0:
-                            gwdepth = -9999
-                        else:
-                            gwdepth = float(raster_sum_elev/total_n_elev) - float(gwdepthcumu/gwcount)
-                    elif self.groundwater_datum == "Surf":
-                        if gwcount == 0:
-                            gwdepth = -9999
-                        else:
-                            gwdepth = float(gwdepthcumu/gwcount)
-                    block_attr.addAttribute("GWDepth", gwdepth)
+                    block_attr.addAttribute("GWDepth", blockdata["GWDepth"][bindex])
                     
-                #Rivers, Lakes & Locality Map Data Locate for Block and Assign
-                blockxmin = xorigin + self.xllcorner            #Grab the corners of the current block
-                blockxmax = xorigin + self.xllcorner + cs
-                blockymin = yorigin + self.yllcorner
-                blockymax = yorigin + self.yllcorner + cs
-                
-                #RIVERS - At least one point within Block
+                #Rivers, Lakes & Locality Map Data Locate for Block and Assign, points come from the spatial index
+                #RIVERS - A river line crosses the Block (L) or at least one river point within Block (P)
                 hasriver = 0
-                if self.include_rivers:
-                    pointcount = 0
-                    while pointcount != len(riverpoints):
-                        pointset = riverpoints[pointcount]
-                        pointcount += 1
-                        if pointset[0] >= blockxmin and pointset[0] < blockxmax:
-                            if pointset[1] >= blockymin and pointset[1] < blockymax:
-                                hasriver = 1
-                                pointcount = len(riverpoints)
+                if self.include_rivers and self.river_import == "L":
+                    if rivercrossed[bindex]:
+                        hasriver = 1
                     block_attr.addAttribute("HasRiv", hasriver)
+                    block_attr.addAttribute("RivLength", float(riverlength[bindex]))
+                elif self.include_rivers:
+                    if len(ubagg.getBlockPoints(riverindex, bindex)) > 0:
+                        hasriver = 1
+                    block_attr.addAttribute("HasRiv", hasriver)
+                riverblocks[bindex] = hasriver
                 
                 #LAKES - Centroid within Block
                 haslake = 0
                 lakearea = 0
                 if self.include_lakes:
-                    pointcount = 0
-                    while pointcount != len(lakepoints):
-                        pointset = lakepoints[pointcount]
-                        pointcount += 1
-                        if pointset[0] >= blockxmin and pointset[0] < blockxmax:
-                            if pointset[1] >= blockymin and pointset[1] < blockymax:
-                                haslake = 1
-                                lakearea = pointset[2]
-                                pointcount = len(lakepoints)
+                    blocklakes = ubagg.getBlockPoints(lakeindex, bindex)
+                    if len(blocklakes) > 0:
+                        haslake = 1
+                        lakearea = lakepoints[blocklakes[0]][2]
                     block_attr.addAttribute("HasLake", haslake)
                     block_attr.addAttribute("LakeAr", lakearea)
                     
-                #LOCALITY MAP - Must scan each point and place in Block!
+                #LOCALITY MAP - Place each facility in its Block
                 haslocal = 0
                 facilcount = 0
                 if self.include_local_map:
-                    for locfeature in localitymap:
-                        if locfeature[1] >= blockxmin and locfeature[1] < blockxmax:
-                            if locfeature[2] >= blockymin and locfeature[2] < blockymax:
-                                haslocal = 1
-                                facilcount += 1
-                                fac_attr = city.addNode(locfeature[1]-self.xllcorner, locfeature[2]-self.yllcorner, 0, self.blocklocality)  #DYNAMIND                                
-#                                fac_attr = ubdata.UBVector([(locfeature[1]-self.xllcorner, locfeature[2]-self.yllcorner, 0, self.blocklocality)])   #UBCORE
-                                fac_attr.addAttribute("BlockID", blockIDcount)
-                                fac_attr.addAttribute("Type", locfeature[0])
-                                fac_attr.addAttribute("Area", locfeature[3])
-                                fac_attr.addAttribute("TIF", locfeature[4])
-                                fac_attr.addAttribute("ARoof", locfeature[5])
-                                fac_attr.addAttribute("AvgWD", locfeature[6])
-#                                self.activesim.addAsset("FacilityID"+str(facilcount))       #UBCORE
-                                localitymap.remove(locfeature)  #Remove this entry from the matrix to make it shorter for next time
+                    for i in ubagg.getBlockPoints(localityindex, bindex):
+                        locfeature = localitymap[i]
+                        haslocal = 1
+                        facilcount += 1
+                        fac_attr = city.addNode(locfeature[1]-self.xllcorner, locfeature[2]-self.yllcorner, 0, self.blocklocality)  #DYNAMIND                                
+#                        fac_attr = ubdata.UBVector([(locfeature[1]-self.xllcorner, locfeature[2]-self.yllcorner, 0, self.blocklocality)])   #UBCORE
+                        fac_attr.addAttribute("BlockID", blockIDcount)
+                        fac_attr.addAttribute("Type", locfeature[0])
+                        fac_attr.addAttribute("Area", locfeature[3])
+                        fac_attr.addAttribute("TIF", locfeature[4])
+                        fac_attr.addAttribute("ARoof", locfeature[5])
+                        fac_attr.addAttribute("AvgWD", locfeature[6])
+#                        self.activesim.addAsset("FacilityID"+str(facilcount))       #UBCORE
                                 
                     block_attr.addAttribute("HasLoc", haslocal)
                     block_attr.addAttribute("NFacil", facilcount)
@@ -968,7 +992,7 @@ class Delinblocks(Module):      #DYNAMIND
                 ####################################################
                 #Call the function using the current Block's Patch information
                 if self.patchdelin:
-                    patchdict = ubpat.landscapePatchDelineation(lucdatamatrix, elevdatamatrix, soildatamatrix)
+                    patchdict = blockpatches[bindex - celldata["FirstRow"]*widthnew]    #delineated ahead, see delineateBlockPatches
                     #Draw the patches and save info to view
                     for i in range(len(patchdict)):
                         panodes = patchdict["PatchID"+str(i+1)][4]
@@ -996,16 +1020,33 @@ class Delinblocks(Module):      #DYNAMIND
         #DynaMind's Block Views are saved using a special encoding - the UUID, we therefore have to reference
         #Block ID with the View's UUID.
         self.initBLOCKIDtoUUID(city)    #DYNAMIND: gets all UUIDs of each block and sets up a dictionary to refer to.
-                
-        if self.demsmooth_choose:
-            for currentpass in range(int(self.demsmooth_passes)):
-                self.smoothDEM(numblocks, neighbourhood_type) 
-        
-        #Determine whether terrain delineation already exists or whether it needs to be done
-        if self.obtain_flowbasins == "F":               #F = file
-            self.retrieveFlowBasinsFromFile(filename, city, numblocks)          #DYNAMIND
-#            self.retrieveFlowBasinsFromFile(filename, numblocks)                #UBCORE
-        elif self.obtain_flowbasins == "D":             #D = delineate
+        
+        if self.incremental_delin:
+            self.saveBlockCacheToFile(self.BlockCacheFilename, blockcachekey, blockdata, packedpatches)
+            packedpatches = None
+        
+        if self.aggregate_pyramid and pyramidsums is None and (pyramid is None or cs < pyramid[0]):
+            self.savePyramidToFile(self.PyramidFilename, pyramidkey, cs, cellsinblock, blockdata, widthnew, heightnew)
+        
+        #All terrain algorithms work on the terrain store, results are written back to the Blocks once at the end
+        terrain = ubterr.createTerrainStore(blockdata["Active"] > 0, blockdata["AvgElev"], riverblocks, widthnew, heightnew, cs)
+        
+        #Sparse index of the active Blocks, all later modules only loop over these
+        map_attr.addAttribute("ActiveBlockIDs", ubactive.encodeActiveBlockIDs(terrain["Status"]))
+        map_attr.addAttribute("NumActiveBlocks", int(np.count_nonzero(terrain["Status"])))
+        
+        celldata = None
+        flowbasinskey = ubterr.getFlowBasinsKey(blockdata["ElevationHash"].hexdigest(), terrain, [cs, inputres, neighbourhood_type, self.flow_method,
+                                                self.demsmooth_choose, int(self.demsmooth_passes), self.elevdatadatum,
+                                                self.elevdatacustomref, int(self.dinf_realizations), int(self.dinf_seed), self.sink_method])
+        
+        #Determine whether terrain delineation already exists or whether it needs to be done. D-infinity
+        #with a random seed draws new realizations every run, these are never cached or reused
+        useflowcache = self.FlowBasinsFilename != "" and not (self.flow_method == "DI" and int(self.dinf_seed) == 0)
+        if useflowcache and self.obtain_flowbasins == "F" and self.retrieveFlowBasinsFromFile(self.FlowBasinsFilename, flowbasinskey, terrain):   #F = file
+            print "Flow paths and basins loaded from ", self.FlowBasinsFilename
+            totalbasins = terrain["Basins"]["TotalBasins"]
+        else:                                           #D = delineate, or no valid file
 #            #-----> UBCORE
 #            self.delineateFlowPaths(numblocks, cs, neighbourhood_type)         
 #            hash_table = self.createBlockHashTable(numblocks)                   
@@ -1013,14 +1054,44 @@ class Delinblocks(Module):      #DYNAMIND
 #            map_attr.addAttribute("TotalBasins", totalbasins)
 #            #-------> UBCORE
 
-            #DYNAMIND -------------->            
-            self.delineateFlowPaths(city, numblocks, cs, neighbourhood_type)
-            hash_table = self.createBlockHashTable(city, numblocks)
-            totalbasins = self.delineateBasins(city, numblocks, hash_table)
-            map_attr.addAttribute("TotalBasins", totalbasins)
+            #DYNAMIND -------------->
+            if self.demsmooth_choose:
+                self.smoothDEM(terrain, neighbourhood_type, int(self.demsmooth_passes))
+            
+            self.delineateFlowPaths(terrain, cs, neighbourhood_type)
+            hash_table = self.createBlockHashTable(terrain)
+            totalbasins = self.delineateBasins(terrain, hash_table)
             #------------> DYNAMIND
             
-            self.saveFlowBasinsToFile(numblocks, hash_table)
+            if useflowcache:
+                self.saveFlowBasinsToFile(self.FlowBasinsFilename, flowbasinskey, terrain)
+        
+        map_attr.addAttribute("TotalBasins", totalbasins)
+        self.writeTerrainToBlocks(city, terrain)        #DYNAMIND: single bulk write-back of all terrain results
+        
+        ########################################################################
+        ### 4.) NEIGHBOURHOOD STATISTICS                                     ###
+        ########################################################################
+        #Context of each Block: land use shares and population within nhd_radius, from summed-area tables
+        if self.nhd_stats:
+            nhdstats = self.calcNeighbourhoodStats(blockdata, widthnew, heightnew, cs, cellsinblock)
+            self.writeBlockArraysToBlocks(city, nhdstats, terrain["Status"] != 0)
+            map_attr.addAttribute("NhdRadius", self.nhd_radius)
+        else:
+            map_attr.addAttribute("NhdRadius", 0)
+        
+        ########################################################################
+        ### 5.) PROXIMITY TO RIVERS, LAKES AND FACILITIES                    ###
+        ########################################################################
+        #Feature locations are rasterised onto the Block grid, one distance transform per feature type
+        proximity = {}
+        if self.include_rivers: proximity["RivDist"] = riverblocks > 0
+        if self.include_lakes: proximity["LakeDist"] = np.diff(lakeindex[1]) > 0
+        if self.include_local_map: proximity["FacDist"] = np.diff(localityindex[1]) > 0
+        for name in proximity:
+            proximity[name] = self.calcProximity(proximity[name], widthnew, heightnew, cs)
+        if len(proximity) > 0:
+            self.writeBlockArraysToBlocks(city, proximity, terrain["Status"] != 0)
             
     ########################################    
 #        #UBCORE ----------------------------------------->       
@@ -1119,88 +1190,221 @@ class Delinblocks(Module):      #DYNAMIND
             return coordinates[0], coordinates[1]   #easting, northing
 
     
-    def retrieveData(self, datasources, startextents, cellsinblock):
-        """Scans the original data range and retrieves all the data values contained
-        therein:
-                   - datasources: the Views containing the rasters
-                   - startextents: [xstart, ystart] coordinates
+    def aggregateBlockData(self, datasources, blockdata, blockcache, widthnew, heightnew, ystart, yend, cellsinblock, inputres):
+        """Reads the rows of Blocks ystart...yend-1 from all input rasters, i.e. a strip of
+        cellsinblock raster rows per row of Blocks, and calculates the statistics of all its
+        Blocks in a few masked array passes:
+                   - datasources: the rasters [luc, pop, elev, soil, planmap, employment,
+                     groundwater, socpar1, socpar2], additional inputs are 0 if not used
+                   - blockdata: dictionary of flat arrays indexed by [BlockID-1] that the Block
+                     attributes are written to (land use proportions under "LUC" as a
+                     [13, numblocks] array), arrays are created on the first call
+                   - blockcache: the block cache of the previous run or None, if none of the
+                     strip's raster windows changed its cached Block values are copied
+                   - widthnew, heightnew: size of the Block grid [#Blocks]
+                   - ystart, yend: rows of Blocks to read, (0, heightnew) reads the whole map
                    - cellsinblock: how many cells are in one block (defines extents)
+                   - inputres: input data resolution [m]
+        Returns celldata, the cell arrays of land use, elevation and soil of the strip for the
+        patches, "FirstRow" is the row of Blocks the strip starts at. The raw elevation is
+        also added to blockdata["ElevationHash"], so the hash covers the whole raster once all
+        strips have been read, the digest of each Block's window of every raster is kept in
+        blockdata["Digests"]. The Block sums the values are derived from are kept too, see
+        calcBlockSums.
         """
-        #Base Inputs
-        lucdatamatrix = []
-        popdatamatrix = []
-        elevdatamatrix = []
-        soildatamatrix = []
-        
-        #Additional Inputs
-        planmapmatrix = []
-        employmentmatrix = []
-        groundwatermatrix = []
-        socpar1matrix = []
-        socpar2matrix = []
-        
-        
-        x_start = startextents[0]
-        y_start = startextents[1]
-        
-        for i in range(cellsinblock):
-            lucdatamatrix.append([])
-            popdatamatrix.append([])
-            elevdatamatrix.append([])
-            soildatamatrix.append([])
-            planmapmatrix.append([])
-            employmentmatrix.append([])
-            groundwatermatrix.append([])
-            socpar1matrix.append([])
-            socpar2matrix.append([])
-            
-            for j in range(cellsinblock):
-                lucdatamatrix[i].append(datasources[0].getValue(x_start+i, y_start+j))
-                popdatamatrix[i].append(datasources[1].getValue(x_start+i, y_start+j))
-                elevdatamatrix[i].append(datasources[2].getValue(x_start+i, y_start+j))
-                
-                if self.soildatatype == "C":
-                    if datasources[3].getValue(x_start+i, y_start+j) != -9999:
-                        soildatamatrix[i].append(self.soildictionary[int(datasources[3].getValue(x_start+i, y_start+j))-1])        #look up mm/hr value
-                    else:
-                        soildatamatrix[i].append(-9999)
-                elif self.soildataunits == "hrs":
-                    soildatamatrix[i].append(datasources[3].getValue(x_start+i, y_start+j))     #keep as mm/hr
-                elif self.soildataunits == "sec":
-                    soildatamatrix[i].append((datasources[3].getValue(x_start+i, y_start+j))*1000*60*60)        #convert to mm/hr
-                
-                if datasources[4] != 0: planmapmatrix[i].append(datasources[4].getValue(x_start+i, y_start+j))
-                if datasources[5] != 0: employmentmatrix[i].append(datasources[5].getValue(x_start+i, y_start+j))
-                if datasources[6] != 0: groundwatermatrix[i].append(datasources[6].getValue(x_start+i, y_start+j))
-                if datasources[7] != 0: socpar1matrix[i].append(datasources[7].getValue(x_start+i, y_start+j))
-                if datasources[8] != 0: socpar2matrix[i].append(datasources[8].getValue(x_start+i, y_start+j))
-                
-        datamatrices = [lucdatamatrix, popdatamatrix, elevdatamatrix, soildatamatrix, planmapmatrix, employmentmatrix, groundwatermatrix, socpar1matrix, socpar2matrix]
-        return datamatrices
-
-
-    def frequencyLUC(self, lucdatamatrix):
-        #Determine size of matrix
-        matsize = len(lucdatamatrix)
-        #'RES', 'COM', 'ORC', 'LI', 'HI', 'CIV', 'SVU', 'RD', 'TR', 'PG', 'REF', 'UND', 'NA'
-        lucprop = [0,0,0,0,0,0,0,0,0,0,0,0,0]
-        total_n_luc = 0
-        for i in range(matsize):
-            for j in range(matsize):
-                landclass = lucdatamatrix[i][j]
-                if landclass == -9999:
-                    pass
-                else:
-                    lucprop[int(landclass-1)] += 1
-                    total_n_luc += 1
-        
-        #Convert frequency to proportion
-        if total_n_luc == 0:
-            return [0,0,0,0,0,0,0,0,0,0,0,0,0], 0
-        for i in range(len(lucprop)):
-            lucprop[i] = float(lucprop[i])/total_n_luc
-        activity = float(total_n_luc) / float((matsize * matsize))
-        return lucprop, activity
+        ncols = widthnew * cellsinblock
+        nrows = (yend - ystart) * cellsinblock
+        rowstart = ystart * cellsinblock
+        numblocks = widthnew * heightnew
+        stripblocks = slice(ystart * widthnew, yend * widthnew)
+        
+        rasters = {}
+        for name, source in zip(ubagg.DATASOURCE_NAMES, datasources):
+            if source == 0:
+                continue
+            rasters[name] = ubagg.rasterToArray(source, ncols, nrows, rowstart)
+            if name not in blockdata["Digests"]:
+                blockdata["Digests"][name] = np.zeros((numblocks, 20), dtype = np.uint8)
+            blockdata["Digests"][name][stripblocks] = ubagg.blockDigests(rasters[name], cellsinblock)
+        lucdata = rasters["LandUse"]
+        elevdata = rasters["Elevation"]
+        soilraw = rasters["Soil"]
+        blockdata["ElevationHash"].update(elevdata.tostring())
+        
+        #Convert soil data to mm/hr, NODATA cells remain untouched
+        soilmask = ubagg.validMask(soilraw)
+        if self.soildatatype == "C":
+            soillookup = np.array([ubagg.NODATA] + self.soildictionary, dtype = np.float64)
+            soilclass = np.where(soilmask, soilraw, 0).astype(np.int64)
+            soilclass[(soilclass < 1) | (soilclass > len(self.soildictionary))] = 0
+            soildata = soillookup[soilclass]
+            soilmask = soilclass != 0
+        elif self.soildataunits == "sec":
+            soildata = np.where(soilmask, soilraw*1000*60*60, ubagg.NODATA)
+        else:
+            soildata = soilraw          #keep as mm/hr
+        celldata = {"LandUse" : lucdata, "Elevation" : elevdata, "Soil" : soildata, "FirstRow" : ystart}
+        
+        #None of the strip's Blocks changed since the last run, take their values from the block cache
+        if blockcache is not None and not ubagg.changedBlocks(blockdata["Digests"], blockcache["Digests"], rasters.keys(), stripblocks).any():
+            for key, values in blockcache["Records"].items():
+                if key not in blockdata:
+                    blockdata[key] = np.zeros(values.shape)
+                blockdata[key][..., stripblocks] = values[..., stripblocks]
+            return celldata
+        
+        sums = self.calcBlockSums(rasters, soildata, soilmask, cellsinblock)
+        self.storeBlockSums(sums, blockdata, stripblocks, numblocks, cellsinblock, inputres)
+        return celldata
+    
+    
+    def calcBlockSums(self, rasters, soildata, soilmask, cellsinblock):
+        """Land use class counts and the sums and valid cell counts of all other rasters within
+        every Block as (..., blocks_y, blocks_x) arrays. Unlike means and proportions these add
+        up over groups of Blocks, so the aggregate pyramid derives larger Blocks from them.
+        The Planner's Map is summed separately on RES, COM, LI and HI land."""
+        lucdata = rasters["LandUse"]
+        sums = {}
+        sums["LUCount"] = ubagg.blockClassFrequency(lucdata, 13, cellsinblock)
+        sums["SoilSum"] = ubagg.blockSum(soildata, soilmask, cellsinblock)
+        sums["SoilCount"] = ubagg.blockCount(soilmask, cellsinblock)
+        for name, key in [["Elevation", "Elev"], ["Population", "Pop"], ["Employment", "Job"], ["Groundwater", "GW"],
+                          ["SocPar1", "SocPar1"], ["SocPar2", "SocPar2"]]:
+            if name not in rasters:
+                continue
+            datamask = ubagg.validMask(rasters[name])
+            sums[key+"Sum"] = ubagg.blockSum(rasters[name], datamask, cellsinblock)
+            sums[key+"Count"] = ubagg.blockCount(datamask, cellsinblock)
+        if "PlanMap" in rasters:
+            planmapdata = rasters["PlanMap"]
+            datamask = ubagg.validMask(planmapdata)
+            lucplanindex = [1, 2, 4, 5]     #numbers are LUC categories that planner's map deals with
+            sums["PMSum"] = np.array([ubagg.blockSum(planmapdata, datamask & (lucdata == c), cellsinblock) for c in lucplanindex])
+            sums["PMCount"] = np.array([ubagg.blockCount(datamask & (lucdata == c), cellsinblock) for c in lucplanindex])
+        return sums
+    
+    
+    def storeBlockSums(self, sums, blockdata, stripblocks, numblocks, cellsinblock, inputres):
+        """Derives the Block values from the Block sums of calcBlockSums and writes both to the
+        flat arrays of blockdata (sums under "Sum_" + name), the Blocks of stripblocks only.
+        Arrays are created on the first call."""
+        cellarea = inputres * inputres
+        values = {}
+        for key in sums:
+            values["Sum_"+key] = sums[key]
+        
+        #Land use frequencies, proportions and block activity
+        total_n_luc = sums["LUCount"].sum(axis = 0)
+        values["LUC"] = sums["LUCount"] / np.maximum(total_n_luc, 1).astype(np.float64)
+        values["Active"] = total_n_luc / float(cellsinblock * cellsinblock)
+        
+        #Soil, Elevation and Population
+        values["Soil_k"] = sums["SoilSum"] / np.maximum(sums["SoilCount"], 1)
+        avgelev = sums["ElevSum"] / np.maximum(sums["ElevCount"], 1)
+        if self.elevdatadatum == "C":
+            avgelev = np.where(sums["ElevCount"] > 0, avgelev + self.elevdatacustomref, 0)   #bring it back to sea level
+        values["AvgElev"] = avgelev
+        
+        values["Pop"] = sums["PopSum"]
+        if self.popdatatype != "C":             #population data is a density [pax/ha]
+            values["Pop"] = sums["PopSum"] * cellarea/10000
+        
+        #PLANNER'S MAP - averaged separately for RES, COM, LI and HI land
+        if "PMSum" in sums:
+            for i, key in enumerate(["PM_RES", "PM_COM", "PM_LI", "PM_HI"]):
+                values[key] = sums["PMSum"][i] / np.maximum(sums["PMCount"][i], 1)
+        
+        #EMPLOYMENT - Like Population
+        if "JobSum" in sums:
+            values["Employ"] = sums["JobSum"]
+            if self.jobdatatype != "C":
+                values["Employ"] = sums["JobSum"] * cellarea/10000
+        
+        #GROUNDWATER TABLE - Like Elevation, but scaled based on correct datum
+        if "GWSum" in sums:
+            gwmean = sums["GWSum"] / np.maximum(sums["GWCount"], 1)
+            if self.groundwater_datum == "Sea":
+                values["GWDepth"] = np.where((sums["ElevCount"] == 0) | (sums["GWCount"] == 0), ubagg.NODATA, avgelev - gwmean)
+            else:
+                values["GWDepth"] = np.where(sums["GWCount"] == 0, ubagg.NODATA, gwmean)
+        
+        #SOCIAL PARAMETERS - average of the proportion or binary values
+        for key in ["SocPar1", "SocPar2"]:
+            if key+"Sum" in sums:
+                values[key] = sums[key+"Sum"] / np.maximum(sums[key+"Count"], 1)
+        
+        for key in values:
+            if key not in blockdata:
+                blockdata[key] = np.zeros(values[key].shape[:-2] + (numblocks,))
+            blockdata[key][..., stripblocks] = values[key].reshape(values[key].shape[:-2] + (-1,))
+        return True
+    
+    
+    def delineateBlockPatches(self, celldata, blockdata, blockcache, widthnew, cellsinblock):
+        """Delineates the patches of all Blocks in the cell data held in memory (the whole map
+        or the current strip) before the Block loop draws them. Blocks are independent, so with
+        parallel_workers > 1 they are delineated in bands of Block IDs in a process pool, the
+        patches are still drawn in Block ID order by the main process. With a block cache, only
+        Blocks whose land use, elevation or soil windows changed are delineated, all others
+        reuse their cached patches. Returns the list of patchdicts of the Blocks in celldata,
+        or an empty list if patches are not delineated."""
+        if not self.patchdelin:
+            return []
+        if blockcache is None or len(blockcache["Patches"]) == 0:
+            return ubpat.delineateBlockPatches(celldata["LandUse"], celldata["Elevation"], celldata["Soil"], cellsinblock, int(self.parallel_workers))
+        
+        firstblock = celldata["FirstRow"] * widthnew
+        numstripblocks = celldata["LandUse"].size // (cellsinblock * cellsinblock)
+        changed = ubagg.changedBlocks(blockdata["Digests"], blockcache["Digests"], ["LandUse", "Elevation", "Soil"],
+                                      slice(firstblock, firstblock + numstripblocks))
+        redelineate = np.flatnonzero(changed)
+        blockpatches = [None if changed[i] else ubpat.unpackPatches(blockcache["Patches"], firstblock + i) for i in range(numstripblocks)]
+        newpatches = ubpat.delineateBlockPatches(celldata["LandUse"], celldata["Elevation"], celldata["Soil"], cellsinblock,
+                                                 int(self.parallel_workers), redelineate)
+        for i, patchdict in zip(redelineate, newpatches):
+            blockpatches[i] = patchdict
+        print "Patches delineated for", len(redelineate), "changed Blocks, reused for", numstripblocks - len(redelineate)
+        return blockpatches
+    
+    
+    def calcNeighbourhoodStats(self, blockdata, widthnew, heightnew, cs, cellsinblock):
+        """Calculates the land use shares and the population within nhd_radius of every Block,
+        the neighbourhood is the square of Blocks within the radius in x and y. One summed-area
+        table per land use class and one of population give every Block's window sums with four
+        lookups each, independent of the radius. Returns a dictionary of flat arrays indexed by
+        [BlockID-1] with the names of the Block attributes."""
+        radius = int(round(self.nhd_radius / cs))
+        shape = (heightnew, widthnew)
+        luccount = blockdata["LUC"] * blockdata["Active"] * cellsinblock * cellsinblock    #cells of each class in each Block
+        nhdcount = ubagg.windowSum(ubagg.summedAreaTable(luccount.reshape((-1,) + shape)), radius).reshape(luccount.shape)
+        nhdtotal = np.maximum(nhdcount.sum(axis = 0), 1)
+        
+        nhdstats = {}
+        for i, luc in enumerate(ubagg.LANDUSE_CLASSES):
+            nhdstats["NhdLU_"+luc] = nhdcount[i] / nhdtotal
+        nhdstats["NhdPop"] = ubagg.windowSum(ubagg.summedAreaTable(blockdata["Pop"].reshape(shape)), radius).ravel()
+        return nhdstats
+    
+    
+    def calcCBDDistances(self, cityeasting, citynorthing, widthnew, numblocks, cs):
+        """Returns the distance [m] and direction [degrees] from the CBD to the centre of every
+        Block as flat arrays indexed by [BlockID-1]. The direction is the angle of the line
+        to the CBD, 0 for a Block centre right on the CBD."""
+        blockeasting = (np.arange(numblocks) % widthnew)*cs + 0.5*cs + self.xllcorner
+        blocknorthing = (np.arange(numblocks) // widthnew)*cs + 0.5*cs + self.yllcorner
+        cbddist = np.hypot(cityeasting - blockeasting, citynorthing - blocknorthing)
+        olderr = np.seterr(divide = "ignore", invalid = "ignore")
+        cbddir = np.degrees(np.arctan((blocknorthing - citynorthing)/(blockeasting - cityeasting)))
+        np.seterr(**olderr)
+        return cbddist, np.where(np.isnan(cbddir), 0, cbddir)
+    
+    
+    def calcProximity(self, features, widthnew, heightnew, cs):
+        """Distance [m] from the centre of every Block to the centre of the nearest Block where
+        features is True (a flat array indexed by [BlockID-1]), using an exact Euclidean
+        distance transform of the Block grid. NODATA if there is no such Block."""
+        distance = ubagg.distanceTransform(np.asarray(features).reshape(heightnew, widthnew)).ravel()
+        return np.where(distance == ubagg.NODATA, ubagg.NODATA, distance * cs)
     
     
     def calcRichness(self, landclassprop):
@@ -1235,115 +1439,6 @@ class Delinblocks(Module):      #DYNAMIND
         return shandiv, shandom, shaneven
     
     
-    def findNeighbourhood(self, ID, x, y, numblocks, widthnew, heightnew):
-        """NEIGHBOURHOODs - Search for all 8 neighbours. """
-        neighbour_assign = 0
-        #check neighbour IDs
-        #check for corner pieces
-        if ID - 1 == 0:                            #bottom left
-            neighbour_assign = 1
-            N_neighbour = ID + widthnew 
-            S_neighbour = 0
-            W_neighbour = 0
-            E_neighbour = ID + 1
-            NE_neighbour = N_neighbour + 1
-            NW_neighbour = 0
-            SE_neighbour = 0
-            SW_neighbour = 0
-        if ID + 1 == numblocks+1:                  #top right
-            neighbour_assign = 1
-            N_neighbour = 0
-            S_neighbour = ID - widthnew
-            W_neighbour = ID - 1
-            E_neighbour = 0
-            NE_neighbour = 0
-            NW_neighbour = 0
-            SE_neighbour = 0
-            SW_neighbour = S_neighbour - 1
-        if ID - widthnew == 0:                     #bottom right
-            neighbour_assign = 1
-            N_neighbour = ID + widthnew
-            S_neighbour = 0
-            W_neighbour = ID - 1
-            E_neighbour = 0
-            NE_neighbour = 0
-            NW_neighbour = N_neighbour - 1
-            SE_neighbour = 0
-            SW_neighbour = 0
-        if ID + widthnew == numblocks+1:           #top left
-            neighbour_assign = 1
-            N_neighbour = 0
-            S_neighbour = ID - widthnew
-            W_neighbour = 0
-            E_neighbour = ID + 1
-            NE_neighbour = 0
-            NW_neighbour = 0
-            SE_neighbour = S_neighbour + 1
-            SW_neighbour = 0
-        
-        #check for edge piece
-        if neighbour_assign == 1:
-            pass
-        else:
-            if float(ID)/widthnew == y+1:                  #East edge
-                neighbour_assign = 1
-                N_neighbour = ID + widthnew
-                S_neighbour = ID - widthnew
-                W_neighbour = ID - 1
-                E_neighbour = 0
-                NE_neighbour = 0
-                NW_neighbour = N_neighbour - 1
-                SE_neighbour = 0
-                SW_neighbour = S_neighbour - 1
-            if float(ID-1)/widthnew == y:                  #West edge
-                neighbour_assign = 1
-                N_neighbour = ID + widthnew
-                S_neighbour = ID - widthnew
-                W_neighbour = 0
-                E_neighbour = ID + 1
-                NE_neighbour = N_neighbour + 1
-                NW_neighbour = 0
-                SE_neighbour = S_neighbour + 1
-                SW_neighbour = 0
-            if ID - widthnew < 0:                          #South edge
-                neighbour_assign = 1
-                N_neighbour = ID + widthnew
-                S_neighbour = 0
-                W_neighbour = ID - 1
-                E_neighbour = ID + 1
-                NE_neighbour = N_neighbour + 1
-                NW_neighbour = N_neighbour - 1
-                SE_neighbour = 0
-                SW_neighbour = 0
-            if ID + widthnew > numblocks+1:                #North edge
-                neighbour_assign = 1
-                N_neighbour = 0
-                S_neighbour = ID - widthnew
-                W_neighbour = ID - 1
-                E_neighbour = ID + 1
-                NE_neighbour = 0
-                NW_neighbour = 0
-                SE_neighbour = S_neighbour + 1
-                SW_neighbour = S_neighbour - 1
-        
-        #if there is still no neighbours assigned then assume standard cross
-        if neighbour_assign == 1:
-            pass
-        else:
-            neighbour_assign = 1
-            N_neighbour = ID + widthnew
-            S_neighbour = ID - widthnew
-            W_neighbour = ID - 1
-            E_neighbour = ID + 1
-            NE_neighbour = N_neighbour + 1
-            NW_neighbour = N_neighbour - 1
-            SE_neighbour = S_neighbour + 1
-            SW_neighbour = S_neighbour - 1
-        
-        blockNHD = [N_neighbour, S_neighbour, W_neighbour, E_neighbour, NE_neighbour, NW_neighbour, SE_neighbour, SW_neighbour]    
-        return blockNHD                
-    
-    
     def adjustCount(self, total_count):
         if total_count == 0:
             total_count = 1
@@ -1431,41 +1526,11 @@ class Delinblocks(Module):      #DYNAMIND
 #        return True #END OF UBCORE VERSION ----------------------------------------------------------------------------------------
 
 
-    def smoothDEM(self, city, numblocks, nhd_type): #DYNAMIND VERSION ------------------------------------------------------------
-        new_elevs = []
-        for i in range(int(numblocks)):
-            nhd_count = 1
-            currentID = i+1
-            currentAttList = city.getFace(uuid = self.getBlockUUID(currentID, city))
-            if currentAttList.getAttribute("Status").getDouble() == 0:
-                new_elevs.append(0)
-                continue
-            
-            new_elev = currentAttList.getAttribute("AvgElev").getDouble()
-            
-            neighbourhood = self.getBlockNeighbourhood(currentAttList)
-            neighbourhoodZ = self.getNeighbourhoodZ(neighbourhood, city)
-            
-            if nhd_type == 4:
-                #only vonNeumann cells
-                for k in range(len(neighbourhoodZ)-4):
-                    if k == 99999:
-                        continue
-                    new_elev += k
-                    nhd_count += 1
-            else:
-                for k in neighbourhoodZ:                #Scan all neighbour cells
-                    if k == 99999:                      #if the value is 99999, it means the cell isn't active
-                        continue
-                    new_elev += k
-                    nhd_count += 1
-                    
-                new_elevs.append(new_elev/nhd_count)    #calculate average, add to the new matrix
-        
-        for i in range(int(numblocks)):     #write all new elevations to replace the existing value
-            currentID = i+1
-            currentAttList = city.getFace(self.getBlockUUID(currentID, city))
-            currentAttList.modifyAttribute("AvgElev", new_elevs[i])
+    def smoothDEM(self, terrain, nhd_type, passes): #DYNAMIND VERSION ------------------------------------------------------------
+        """Averages the elevation of each active Block with its active neighbours. All passes
+        are run as masked convolutions over the Block grid on the terrain store, inactive
+        Blocks are excluded from the averages."""
+        terrain["AvgElev"] = ubterr.smoothElevation(terrain["AvgElev"], terrain["Status"], terrain["Shape"], nhd_type, passes)
         return True #END OF DYNAMIND VERSION -------------------------------------------------------------------------------------------
 
 
@@ -1484,18 +1549,11 @@ class Delinblocks(Module):      #DYNAMIND
 #        current_neighb = [ID_N, ID_S, ID_W, ID_E, ID_NE, ID_NW, ID_SE, ID_SW]
 #        return current_neighb   #END OF UBCORE VERSION -----------------------------------------------------------------------
 
-    def getBlockNeighbourhood(self, currentAttList):        #DYNAMIND VERSION -----------------------------------------------
+    def getBlockNeighbourhood(self, currentID):        #DYNAMIND VERSION -----------------------------------------------
         """Returns the Moore neighbouhoord for the Block (8 neighbours in all cardinal
-        directions, the order is North, South, West, Est, followed by NE, NW, SE, SW"""
-        ID_N = int(round(currentAttList.getAttribute("Nhd_N").getDouble()))
-        ID_S = int(round(currentAttList.getAttribute("Nhd_S").getDouble()))
-        ID_W = int(round(currentAttList.getAttribute("Nhd_W").getDouble()))
-        ID_E = int(round(currentAttList.getAttribute("Nhd_E").getDouble()))
-        ID_NE = int(round(currentAttList.getAttribute("Nhd_NE").getDouble()))
-        ID_NW = int(round(currentAttList.getAttribute("Nhd_NW").getDouble()))
-        ID_SE = int(round(currentAttList.getAttribute("Nhd_SE").getDouble()))
-        ID_SW = int(round(currentAttList.getAttribute("Nhd_SW").getDouble()))
-        current_neighb = [ID_N, ID_S, ID_W, ID_E, ID_NE, ID_NW, ID_SE, ID_SW]
+        directions, the order is North, South, West, Est, followed by NE, NW, SE, SW.
+        IDs are looked up in the neighbour table built at the start of the run"""
+        current_neighb = [int(nhdID) for nhdID in self.neighbourtable[int(currentID)-1]]
         return current_neighb   #END OF DYNAMIND VERSION -------------------------------------------------------------------
 
     
@@ -1512,118 +1570,19 @@ class Delinblocks(Module):      #DYNAMIND
 #                current_neighbdZ.append(curface.getAttribute("AvgElev"))
 #        return current_neighbdZ #END OF UBCORE VERSION -----------------------------------------------------------------------
 
-    def getNeighbourhoodZ(self, nhdIDs, city):      #DYNAMIND VERSION -------------------------------------------------------
+    def getNeighbourhoodZ(self, nhdIDs, terrain):      #DYNAMIND VERSION -------------------------------------------------------
         current_neighbdZ = []
         for i in nhdIDs:       #scan all 8 neighbours
-            uuid = self.getBlockUUID(i, city)
-            if uuid == "":   #if not found because of some error, then return a very high number
+            if i == 0:      #if the Neighbourhood ID == 0, the neighbour is outside the map
                 current_neighbdZ.append(99999)
                 continue
-            curface = city.getFace(uuid)
-            if int(round(curface.getAttribute("Status").getDouble())) == 0:
+            if terrain["Status"][i-1] == 0:
                 current_neighbdZ.append(99999) #works based on Sea Level, so nothing can really be higher than Everest :)
             else:
-                current_neighbdZ.append(curface.getAttribute("AvgElev").getDouble())
+                current_neighbdZ.append(terrain["AvgElev"][i-1])
         return current_neighbdZ #END OF DYNAMIND VERSION --------------------------------------------------------------------
 
 
-    def findDownstreamD8(self, currentZ, neighboursZ, neighbourhood_type):
-        if neighbourhood_type == 4:
-            neighboursZ[4] = 999999
-            neighboursZ[5] = 999999
-            neighboursZ[6] = 999999
-            neighboursZ[7] = 999999
-        for i in range(len(neighboursZ)):            #D8 is simply the largest drop
-            neighboursZ[i] = currentZ - neighboursZ[i]
-        max_Zdrop = max(neighboursZ)
-        if max_Zdrop <= 0:
-            direction = -9999  #-9999 means that the current block is a sink
-        else:
-            direction = neighboursZ.index(max_Zdrop)
-        return direction, max_Zdrop
-
-
-    def findDownstreamDinf(self, currentZ, blocksize, neighboursZ, neighbourhood_type):
-        """D-infinity method adapted to only direct water in one direction based on the steepest
-        slope of the 8 triangular facets surrounding a Block's neighbourhood and a probabilistic
-        choice weighted by the proportioning of flow. This is the stochastic option of flowpath
-        delineation for UrbanBEATS and ONLY works with Moore neighbourhood"""
-
-        facetdict = {}      #Stores all the information about the 8 facets
-        facetdict["e1"] = ["E","N","N","W","W","S","S","E"]
-        facetdict["e2"] = ["NE","NE","NW","NW","SW","SW","SE","SE"]
-        facetdict["ac"] = [0,1,1,2,2,3,3,4]
-        facetdict["af"] = [1,-1,1,-1,1,-1,1,-1]
-        cardin = { "E":0, "NE":1, "N":2, "NW":3, "W":4, "SW":5, "S":6, "SE":7 }
-        
-        e0 = currentZ               #CONSTANT PARAMETERS (because of constant block grid and centre point)
-        d1 = blocksize
-        d2 = d1
-        facetangles = [0, math.pi/4, math.pi/2, 3*math.pi/4, math.pi, 5*math.pi/4, 3*math.pi/2, 7*math.pi/4]
-        
-        #Re-sort the neighbours matrix based on polar angle
-        sortedneighb = [neighboursZ[3],neighboursZ[4],neighboursZ[0],neighboursZ[5],neighboursZ[2],neighboursZ[7],neighboursZ[1],neighboursZ[6]]
-        rmatrix = []
-        smatrix = []
-
-        for i in range(len(sortedneighb)):  #Calculate slopes of all 8 facets
-            currentfacet = i
-            
-            e1 = sortedneighb[cardin[facetdict["e1"][currentfacet]]]        #e1 elevation:  (1) get cardinal direction from dictionary, 
-                                                                            #               (2) get the index from cardin and 
-            e2 = sortedneighb[cardin[facetdict["e2"][currentfacet]]]        #               (3) get the value from neighbz
-            
-            ac = facetdict["ac"][currentfacet]
-            af = facetdict["af"][currentfacet]
-            
-            s1 = (e0 - e1)/d1
-            s2 = (e1 - e2)/d2
-            r = math.atan(s2/s1)
-            s = math.sqrt(math.pow(s1,2) + math.pow(s2, 2))
-            
-            if r < 0:
-                r = 0
-                s = s1
-            elif r > math.atan(d2/d1):
-                r = math.atan(d2/d1)
-                s = (e0 - e2)/math.sqrt(math.pow(d1, 2) + math.pow(d2, 2))
-            
-            rmatrix.append(r)
-            smatrix.append(s)
-        
-        #Find the maximum slope and get the angle
-        rmax = max(rmatrix)
-        rg = af*rmax + ac*math.pi/2.0
-        
-        #Find the facet
-        for i in range(len(facetangles)):
-            if rg > facetangles[i]:
-                continue
-            else:
-                facet = i-1
-                theta1 = facetangles[i-1]
-                theta2 = facetangles[i]
-        #Adjust angles based on rg to get proportions
-        alpha1 = rg - theta1
-        alpha2 = theta2 - rg
-        p1 = alpha1/(alpha1 + alpha2)
-        p2 = alpha2/(alpha2 + alpha1)
-        
-        print "Proportioned Flows:", p1, p2
-        
-        if rand.random() < p1:
-            choice = p1
-            directionfacet = int(theta1/(math.pi/4))
-        else:
-            choice = p2
-            directionfacet = int(theta2/(math.pi/4))
-            
-        print "Choice:", choice
-        
-        direction = neighboursZ.index(sortedneighb[directionfacet-1])
-        return direction, max_Zdrop
-    
-    
 #    def drawFlowPaths(self, currentID, downstreamID, currentAttList, max_Zdrop, avg_slope, typenum):    #UBCORE VERSION ------------
 #        f = self.activesim.getAssetWithName("BlockID"+str(int(downstreamID)))
             
@@ -1648,21 +1607,19 @@ class Delinblocks(Module):      #DYNAMIND
 #        self.activesim.addAsset("NetworkID"+str(currentID), network_attr)
 #        return True #END OF UBCORE VERSION ------------------------------------------------------------------------------
     
-    def drawFlowPaths(self, city, currentID, downstreamID, currentAttList, max_Zdrop, avg_slope, typenum):  #DYNAMIND VERSION ------
-        uuid = self.getBlockUUID(downstreamID,city)
-        if  uuid == "":
+    def drawFlowPaths(self, city, terrain, currentID, downstreamID, max_Zdrop, avg_slope, typenum):  #DYNAMIND VERSION ------
+        if downstreamID <= 0 or downstreamID > len(terrain["Status"]):
             print "Block not found, is an outlet: " + str(downstreamID)
             return True
         
-        f = city.getFace(uuid)
-        x_up = currentAttList.getAttribute("CentreX").getDouble()
-        y_up = currentAttList.getAttribute("CentreY").getDouble()
-        z_up = currentAttList.getAttribute("AvgElev") .getDouble()
+        x_up = terrain["CentreX"][currentID-1]
+        y_up = terrain["CentreY"][currentID-1]
+        z_up = terrain["AvgElev"][currentID-1]
         upNode = city.addNode(x_up,y_up,z_up)
         
-        x_down = f.getAttribute("CentreX").getDouble()
-        y_down = f.getAttribute("CentreY").getDouble()
-        z_down = f.getAttribute("AvgElev").getDouble()
+        x_down = terrain["CentreX"][downstreamID-1]
+        y_down = terrain["CentreY"][downstreamID-1]
+        z_down = terrain["AvgElev"][downstreamID-1]
         downNode = city.addNode(x_down,y_down,z_down)
         
         network_attr = city.addEdge(upNode,downNode,self.network)         
@@ -1741,72 +1698,63 @@ class Delinblocks(Module):      #DYNAMIND
 #        self.connectRiverBlocks(riverIDs, numblocks)
 #        return True #END OF UBCORE VERSION ----------------------------------------------------------------------------------
     
-    def delineateFlowPaths(self, city, numblocks, cs, neighbourhood_type): #DYNAMIND VERSION ------------------------------------
-        sinkIDs = []
-        riverIDs = []
-        lakeIDs = []
-
-        for i in range(numblocks):
-            currentID = i+1
-            print currentID, "going to get UUID ---"
-            uuid = self.getBlockUUID(int(currentID), city)
-            if uuid == "":
-                print "Error, Block"+ str(currentID)+" not found."
-                continue
-            
-            #CONDITION 1 - Block is Active in Simulation
-            currentAttList = city.getFace(uuid)
-            if currentAttList.getAttribute("Status").getDouble() == 0:
-                #print "BlockID"+str(currentID)+" not active in simulation"
-                continue
-            
-            #CONDITION 2 - Block already contains a sink e.g. river/etc.
-            if currentAttList.getAttribute("HasRiv").getDouble() == 1:
-                hasRiver = 1
-                riverIDs.append(currentID)
-                continue
-            
-            
-            currentZ = currentAttList.getAttribute("AvgElev").getDouble()
-            
-            #Neighbours array: [N, S, W, E, NE, NW, SE, SW], the last four are 0 if only vonNeumann Nhd used.
-            neighbours = self.getBlockNeighbourhood(currentAttList)
-            neighboursZ = self.getNeighbourhoodZ(neighbours, city)
-            
-            #Find Downstream Block - The Functions return the Index of the Cardinal Direction
-            if self.flow_method == "D8":
-                flow_direction, max_Zdrop = self.findDownstreamD8(currentZ, neighboursZ, neighbourhood_type)
-            elif self.flow_method == "DI":
-                flow_direction, max_Zdrop = self.findDownstreamDinf(currentZ, cs, neighboursZ, neighbourhood_type)
-            
-            if flow_direction == -9999:
-                sinkIDs.append(currentID)
-                downstreamID = -1
+    def delineateFlowPaths(self, terrain, cs, neighbourhood_type): #DYNAMIND VERSION ------------------------------------
+        #CONDITION 1 - Block is Active in Simulation, CONDITION 2 - Block already contains a sink e.g. river/etc.
+        active = terrain["Status"] != 0
+        riverIDs = list(np.flatnonzero(active & (terrain["HasRiv"] == 1)) + 1)
+        routed = active & (terrain["HasRiv"] != 1)
+        
+        #Flow paths follow the DEM or, with priority-flood, the DEM with all depressions filled
+        if self.sink_method == "PF":
+            surface = self.fillDepressions(terrain, neighbourhood_type)
+        else:
+            surface = terrain["AvgElev"]
+        
+        #Find Downstream Block - D8 is solved for the whole grid at once
+        if self.flow_method == "D8":
+            flow_direction, max_Zdrop, avg_slope, downstreamID = ubterr.findDownstreamD8Grid(surface, terrain["Status"], terrain["Shape"], neighbourhood_type, cs)
+            terrain["downID"][routed] = downstreamID[routed]
+            terrain["maxdZ"][routed] = max_Zdrop[routed]
+            terrain["slope"][routed] = avg_slope[routed]
+            sinkIDs = list(np.flatnonzero(routed & (flow_direction == -9999)) + 1)
+        elif self.flow_method == "DI":
+            #All facets are solved at once, then a batch of realizations is drawn from seeded RNG streams
+            if neighbourhood_type == 4:
+                print "D-infinity always uses the Moore neighbourhood, von Neumann setting ignored"
+            if int(self.dinf_seed) == 0:
+                seed = rand.randint(1, 2147483647)
             else:
-                downstreamID = neighbours[flow_direction]
-            
-            #Grab Distance/Slope between two Block IDs
-            if flow_direction == -9999:
-                dx = 0
-            elif flow_direction <= 3:
-                dx = cs
-            elif flow_direction > 3:
-                dx = math.sqrt(2*cs*cs)                        #diagonal
-                
-            if dx == 0: avg_slope = 0
-            else: avg_slope = max_Zdrop/dx
-            
-            currentAttList.addAttribute("downID", downstreamID)
-            currentAttList.addAttribute("maxdZ", max_Zdrop)
-            currentAttList.addAttribute("slope", avg_slope)
-            
-            #DRAW NETWORKS OF PATHS THAT ARE NOT SINKS
-            if downstreamID != -1 or downstreamID != 0:
-                self.drawFlowPaths(city, currentID, downstreamID, currentAttList, max_Zdrop, avg_slope, 1)
-            
-        
-        self.unblockSinks(sinkIDs, city, numblocks)
-        #self.connectRiverBlocks(riverIDs, city, numblocks)
+                seed = int(self.dinf_seed)
+            dinf = ubterr.findDownstreamDinfGrid(surface, terrain["Status"], terrain["Shape"], cs)
+            realizations = ubterr.drawDinfRealizations(dinf, max(int(self.dinf_realizations), 1), seed)
+            choice = ubterr.chooseMostLikelyRealization(dinf, realizations, routed)
+            print "D-infinity: using realization", choice+1, "of", len(realizations), "(seed "+str(seed)+")"
+            
+            flow_direction = realizations[choice]
+            max_Zdrop, avg_slope, downstreamID, probability = ubterr.getDinfRealizationFlow(dinf, flow_direction, terrain["Shape"], cs)
+            terrain["downID"][routed] = downstreamID[routed]
+            terrain["maxdZ"][routed] = max_Zdrop[routed]
+            terrain["slope"][routed] = avg_slope[routed]
+            terrain["downProb"][routed] = probability[routed]
+            terrain["FlowProb"] = dinf["FlowProb"]                  #per-Block flow-direction probabilities
+            terrain["DinfRealizations"] = realizations
+            altDownID, altProb, outAgree = ubterr.getDinfSensitivity(dinf, realizations, choice, routed, terrain["Shape"], cs)
+            terrain["altDownID"][routed] = altDownID[routed]
+            terrain["altProb"][routed] = altProb[routed]
+            terrain["outAgree"][routed] = outAgree[routed]
+            sinkIDs = list(np.flatnonzero(routed & (flow_direction == -9999)) + 1)
+        
+        #NETWORKS OF PATHS THAT ARE NOT SINKS, these are drawn when writing back to the Blocks
+        for i in np.flatnonzero(routed & (terrain["downID"] > 0)):
+            terrain["Network"].append([i+1, int(terrain["downID"][i]), terrain["maxdZ"][i], terrain["slope"][i], 1])
+        
+        if self.sink_method == "PF":
+            #Only Blocks the flood started from can still be sinks, these are outlets
+            print "A total of: "+str(len(sinkIDs))+" outlets remain after depression filling!"
+            terrain["drainID"][np.array(sinkIDs, dtype = np.int64) - 1] = -1
+        else:
+            self.unblockSinks(sinkIDs, terrain)
+        #self.connectRiverBlocks(riverIDs, numblocks)
         return True    #END OF DYNAMIND VERSION ----------------------------------------------------------------------------------
     
     
@@ -1846,46 +1794,56 @@ class Delinblocks(Module):      #DYNAMIND
 #                currentAttList.addAttribute("drainID", -1)      #-1 in drainID = outlet or sub-outlet        
 #        return True #END OF UBCORE VERSION ---------------------------------------------------------------------------------------------------    
     
-    def unblockSinks(self, sinkIDs, city, numblocks):   #DYNAMIND VERSION ---------------------------------------------------------------------
+    def unblockSinks(self, sinkIDs, terrain):   #DYNAMIND VERSION ---------------------------------------------------------------------
         total_sinks = len(sinkIDs)
         print "A total of: "+str(total_sinks)+" sinks found in map!"
         
         #Sink unblocking algorithm for immediate neighbourhood
         for i in sinkIDs:
             currentID = i
-            currentAttList = city.getFace(self.getBlockUUID(currentID,city))           
-            currentZ = currentAttList.getAttribute("AvgElev").getDouble()    
+            currentZ = terrain["AvgElev"][currentID-1]
             
-            current_neighb = self.getBlockNeighbourhood(currentAttList)
+            current_neighb = self.getBlockNeighbourhood(currentID)
             
             possible_IDdrains = []
             possible_IDdZ = []
             possibility = 0
             
             for j in current_neighb:
-                uuid = self.getBlockUUID(j,city)
-                if len(uuid)!= 0:
-                    f = city.getFace(uuid)
-                    testdownID = int(round(f.getAttribute("downID").getDouble()))
-                    if  testdownID not in [currentID, -1] and testdownID not in current_neighb and int(round(f.getAttribute("Status").getDouble())) != 0:
-                        possible_IDdrains.append(j)
-                        possible_IDdZ.append(f.getAttribute("AvgElev").getDouble()-currentZ)
-                        possibility += 1
+                if j == 0:
+                    continue
+                testdownID = terrain["downID"][j-1]
+                if  testdownID not in [currentID, -1] and testdownID not in current_neighb and terrain["Status"][j-1] != 0:
+                    possible_IDdrains.append(j)
+                    possible_IDdZ.append(terrain["AvgElev"][j-1]-currentZ)
+                    possibility += 1
             
             if possibility > 0:         #if algorithm found a possible pathway for sink to unblock, then get the ID and connect network
                 sink_path = min(possible_IDdZ)
                 sink_drainID = possible_IDdrains[possible_IDdZ.index(sink_path)]
-                currentAttList.addAttribute("drainID", sink_drainID)            
-                currentAttList.addAttribute("h_pond", sink_path)
-                self.drawFlowPaths(city, currentID, sink_drainID, currentAttList, sink_path, 0, -1) 
+                terrain["drainID"][currentID-1] = sink_drainID
+                terrain["h_pond"][currentID-1] = sink_path
+                terrain["Network"].append([currentID, sink_drainID, sink_path, 0, -1])
                 continue
             
             else:
                 #IF the model reaches this point, the identified cell is either most definitely an outlet or a very troublesome sink
-                currentAttList.addAttribute("drainID", -1)      #-1 in drainID = outlet or sub-outlet        
+                terrain["drainID"][currentID-1] = -1      #-1 in drainID = outlet or sub-outlet        
         return True #END OF DYNAMIND VERSION ---------------------------------------------------------------------------------------------------    
     
     
+    def fillDepressions(self, terrain, nhd_type):   #DYNAMIND FUNCTION
+        """Resolves all depressions of the Block DEM with a priority-flood fill started from
+        the map edge, inactive areas and rivers. The fill depth of each Block is its ponding
+        height h_pond, returns the filled surface that flow paths are delineated on. Unlike
+        unblockSinks, no depression is left as a pseudo-outlet."""
+        flood_outlets = ubterr.getFloodOutlets(terrain["Status"], terrain["HasRiv"], self.neighbourtable, nhd_type)
+        filled = ubterr.priorityFloodFill(terrain["AvgElev"], terrain["Status"], flood_outlets, self.neighbourtable, nhd_type)
+        terrain["h_pond"] = np.where(terrain["Status"] != 0, filled - terrain["AvgElev"], 0.0)
+        print "Priority-flood raised "+str(int(np.sum(terrain["h_pond"] > ubterr.FILL_EPSILON)))+" Blocks in depressions"
+        return filled
+    
+    
     def connectRiverBlocks(self, riverIDs, numblocks):
         print "A total of: "+str(len(riverIDs))+" Blocks contain a river body!"
         riverbodycount = 0        
@@ -1916,35 +1874,12 @@ class Delinblocks(Module):      #DYNAMIND
 #        print hash_table
 #        return hash_table #END OF UBCORE VERSION --------------------------------------------------------------------
 
-    def createBlockHashTable(self, city, numblocks):    #DYNAMIND VERSION ----------------------------------------------
-        """Indexes through the list of blocks and finds the downstream blocks that each
-        block flows into (0 = outlet). This hash table is required for finding basins
-        within the case study area.
+    def createBlockHashTable(self, terrain):    #DYNAMIND VERSION ----------------------------------------------
+        """Finds the downstream block that each block flows into (0 = outlet) and returns
+        them as one pointer array indexed by [BlockID-1] (-1 = Block not active). This
+        table is required for finding basins within the case study area.
         """
-        hash_table = [[],[]]    #COLUMN1: BLOCK ID (UP), COLUMN2: DOWNSTREAM ID (DOWN)
-        for i in range(int(numblocks)):
-            currentID = i+1
-            uuid = self.getBlockUUID(currentID, city)
-            if uuid == "":
-                print "Error, Block"+ str(currentID)+" not found"
-                continue
-            
-            currentAttList = city.getFace(uuid)
-            if currentAttList.getAttribute("Status").getDouble() == 0:
-                #print "BlockID"+str(currentID)+" not active in simulation"
-                continue
-            
-            hash_table[0].append(int(currentID))
-            
-            if currentAttList.getAttribute("downID").getDouble() not in [0, -1]:
-                hash_table[1].append(int(currentAttList.getAttribute("downID").getDouble()))
-            elif currentAttList.getAttribute("drainID").getDouble() not in [0, -1]:
-                hash_table[1].append(int(currentAttList.getAttribute("drainID").getDouble()))
-            else:
-                hash_table[1].append(int(0))
-        
-        print hash_table
-        return hash_table   #END OF DYNAMIND VERSION --------------------------------------------------------------------
+        return ubterr.getDownstreamPointers(terrain)   #END OF DYNAMIND VERSION --------------------------------------------------------------------
     
     
 #    def delineateBasins(self, numblocks, hash_table): #UBCORE VERSION ------------------------------------------------------
@@ -1996,87 +1931,138 @@ class Delinblocks(Module):      #DYNAMIND
         
 #        return basinID #UBCORE VERSION ------------------------------------------------------------------------------------
     
-    def delineateBasins(self, city, numblocks, hash_table): #DYNAMIND VERSION ------------------------------------------------------
-        basinID = 0
-        for i in range(numblocks):
+    def delineateBasins(self, terrain, hash_table): #DYNAMIND VERSION ------------------------------------------------------
+        """Assigns basin IDs and outlets and finds all upstream and downstream Blocks from
+        the downstream pointers in linear time. Upstream and downstream sets are kept as
+        CSR arrays in the terrain store and only turned into strings on write-back."""
+        basins = ubterr.delineateBasinGraph(hash_table)
+        terrain["BasinID"] = basins["BasinID"]
+        terrain["Outlet"] = basins["Outlet"]
+        terrain["Basins"] = basins
+        
+        print "Total Basins in Case Study: ", basins["TotalBasins"]
+        return basins["TotalBasins"]  #DYNAMIND VERSION ------------------------------------------------------------------------------------
+    
+    def writeTerrainToBlocks(self, city, terrain):     #DYNAMIND FUNCTION
+        """Writes the results of the terrain analysis from the terrain store back to the
+        Block faces in a single pass and draws the flow path network. This is the only
+        place where the terrain algorithms touch the City. With a Block attribute store, the
+        numeric results are written to its columns in bulk instead."""
+        if self.blockstore is not None:
+            active = terrain["Status"] != 0
+            for name in ["AvgElev", "downID", "maxdZ", "slope", "downProb", "altDownID", "altProb", "outAgree", "drainID", "h_pond",
+                         "BasinID", "Outlet"]:
+                if name in terrain:
+                    self.blockstore.setColumn(name, terrain[name], active)
+        
+        for i in range(len(terrain["Status"])):
+            if terrain["Status"][i] == 0:
+                continue
             currentID = i+1
             uuid = self.getBlockUUID(currentID, city)
             if uuid == "":
                 print "Error, Block"+ str(currentID)+" not found"
                 continue
-                
-            currentAttList = city.getFace(uuid)
-            if currentAttList.getAttribute("Status").getDouble() == 0:
-                #print "BlockID"+str(currentID)+" not active in simulation"
-                continue
             
-            if currentID not in hash_table[1]:
-                currentAttList.addAttribute("UpstrIDs", "")
-                if currentID in hash_table[0]:
-                    if hash_table[1][hash_table[0].index(currentID)] == 0:
-                        print "Found a single block basin at Block: ", currentID
-                        basinID += 1   #transfer currentID to all blocks
-                        currentAttList.addAttribute("BasinID", basinID)
-                        currentAttList.addAttribute("Outlet", 1)
+            if self.blockstore is not None:
+                currentAttList = self.blockstore.record(currentID)
+                if "Basins" in terrain:
+                    currentAttList.addAttribute("UpstrIDs", "".join([str(j)+"," for j in ubterr.getUpstreamIDs(terrain["Basins"], currentID)]))
+                    currentAttList.addAttribute("DownstrIDs", "".join([str(j)+"," for j in ubterr.getDownstreamIDs(terrain["Basins"], currentID)]))
                 continue
             
-            upstreamIDs = [currentID]
-            for id in upstreamIDs:
-                for j in range(len(hash_table[1])):
-                    if id == hash_table[1][j]:
-                        if hash_table[0][j] not in upstreamIDs:
-                            upstreamIDs.append(hash_table[0][j])
-            
-            upstreamIDs.remove(currentID)
-            print "BlockID", currentID, "Upstream: ", upstreamIDs
-            
-            outputstring = ""
-            for j in upstreamIDs:
-                outputstring += str(j)+","
-            currentAttList.addAttribute("UpstrIDs", outputstring)
-            
-            downstreamIDs = [currentID]
-            for id in downstreamIDs:
-                for j in range(len(hash_table[0])):
-                    if id == hash_table[0][j]:
-                        if hash_table[1][j] not in downstreamIDs:
-                            downstreamIDs.append(hash_table[1][j])
-            downstreamIDs.remove(currentID)
-            downstreamIDs.remove(0)
-            print "BlockID", currentID, "Downstream: ", downstreamIDs
-            
-            outputstring = ""
-            for j in downstreamIDs:
-                outputstring += str(j)+","
-            currentAttList.addAttribute("DownstrIDs", outputstring)
-            
-            #Set Basin IDs
-            if hash_table[1][hash_table[0].index(currentID)] == 0:
-                print "Found a basin outlet at Block: ", currentID
-                basinID += 1   #transfer currentID to all blocks
-                currentAttList.addAttribute("Outlet", 1)
-                currentAttList.addAttribute("BasinID", basinID)
-                for j in upstreamIDs:
-                    upblock = city.getFace(self.getBlockUUID(j, city))
-                    upblock.addAttribute("BasinID", basinID)
-                    upblock.addAttribute("Outlet", 0)
-        
-        print "Total Basins in Case Study: ", basinID
-        
-        return basinID  #DYNAMIND VERSION ------------------------------------------------------------------------------------
+            currentAttList = city.getFace(uuid)
+            currentAttList.addAttribute("AvgElev", float(terrain["AvgElev"][i]))
+            currentAttList.addAttribute("downID", int(terrain["downID"][i]))
+            currentAttList.addAttribute("maxdZ", float(terrain["maxdZ"][i]))
+            currentAttList.addAttribute("slope", float(terrain["slope"][i]))
+            currentAttList.addAttribute("downProb", float(terrain["downProb"][i]))
+            currentAttList.addAttribute("altDownID", int(terrain["altDownID"][i]))
+            currentAttList.addAttribute("altProb", float(terrain["altProb"][i]))
+            currentAttList.addAttribute("outAgree", float(terrain["outAgree"][i]))
+            currentAttList.addAttribute("drainID", int(terrain["drainID"][i]))
+            currentAttList.addAttribute("h_pond", float(terrain["h_pond"][i]))
+            currentAttList.addAttribute("BasinID", int(terrain["BasinID"][i]))
+            currentAttList.addAttribute("Outlet", int(terrain["Outlet"][i]))
+            if "Basins" in terrain:
+                currentAttList.addAttribute("UpstrIDs", "".join([str(j)+"," for j in ubterr.getUpstreamIDs(terrain["Basins"], currentID)]))
+                currentAttList.addAttribute("DownstrIDs", "".join([str(j)+"," for j in ubterr.getDownstreamIDs(terrain["Basins"], currentID)]))
+        
+        for path in terrain["Network"]:
+            self.drawFlowPaths(city, terrain, path[0], path[1], path[2], path[3], path[4])
+        return True
     
-    def saveFlowBasinsToFile(self, numblocks, hash_table):
-        #f = open("simulationflowbasins.txt", 'w')
-        pass
-#        f.close()
+    def writeBlockArraysToBlocks(self, city, blockarrays, mask):     #DYNAMIND FUNCTION
+        """Writes flat arrays indexed by [BlockID-1] to the attributes of the same name of all
+        Blocks where mask is True, in bulk into the Block attribute store if one is used."""
+        if self.blockstore is not None:
+            for name in blockarrays:
+                self.blockstore.setColumn(name, blockarrays[name], mask)
+            return True
+        for i in np.flatnonzero(mask):
+            uuid = self.getBlockUUID(i+1, city)
+            if uuid == "":
+                continue
+            currentAttList = city.getFace(uuid)
+            for name in blockarrays:
+                currentAttList.addAttribute(name, float(blockarrays[name][i]))
         return True
     
-    def retrieveFlowBasinsFromFile(filename, numblocks):
-        f = open(filename, 'r')
-        
-        f.close()        
+    def saveFlowBasinsToFile(self, filename, key, terrain):
+        """Saves the delineated flow paths and basins together with the key of the terrain
+        and settings they were delineated for, so that later runs can skip the delineation."""
+        try:
+            ubterr.saveFlowBasins(filename, key, terrain)
+        except IOError:
+            print "Could not save flow paths and basins to ", filename
+            return False
+        return True
+    
+    def retrieveFlowBasinsFromFile(self, filename, key, terrain):
+        """Loads the flow paths and basins into the terrain store if the file exists and was
+        saved for the same key, returns False if they have to be delineated again."""
+        return ubterr.loadFlowBasins(filename, key, terrain)
+    
+    def saveBlockCacheToFile(self, filename, key, blockdata, packedpatches):
+        """Saves the raster window digests, aggregated values and patches of all Blocks so that
+        the next run (e.g. the next cycle of a dynamic simulation) only has to redo the Blocks
+        whose input data changed."""
+        records = dict((name, values) for name, values in blockdata.items() if name not in ["ElevationHash", "Digests"])
+        patches = ubpat.concatenatePackedPatches(packedpatches) if self.patchdelin else {}
+        try:
+            ubagg.saveBlockCache(filename, key, blockdata["Digests"], records, patches)
+        except IOError:
+            print "Could not save block cache to ", filename
+            return False
         return True
     
+    def savePyramidToFile(self, filename, key, cs, cellsinblock, blockdata, widthnew, heightnew):
+        """Builds the aggregate pyramid from the Block sums of this run and saves it, so that
+        later runs at power of two multiples of this Block size skip the raster aggregation."""
+        sums = {}
+        for name in blockdata:
+            if name.startswith("Sum_"):
+                sums[name[4:]] = blockdata[name].reshape(blockdata[name].shape[:-1] + (heightnew, widthnew))
+        try:
+            ubagg.savePyramid(filename, key, cs, cellsinblock, ubagg.buildAggregatePyramid(sums))
+        except IOError:
+            print "Could not save the aggregate pyramid to ", filename
+            return False
+        return True
+    
+    def retrievePyramidFromFile(self, filename, key):
+        """Loads the aggregate pyramid if the file exists and was saved for the same key,
+        returns None otherwise."""
+        return ubagg.loadPyramid(filename, key)
+    
+    def retrieveBlockCacheFromFile(self, filename, key, numblocks):
+        """Loads the block cache of the previous run if the file exists and was saved for the
+        same settings, returns None if all Blocks have to be aggregated and delineated."""
+        blockcache = ubagg.loadBlockCache(filename, key, numblocks)
+        if blockcache is not None:
+            print "Block cache loaded from ", filename
+        return blockcache
+    
     ########################################################
     #LINK WITH GUI                                         #
     ########################################################        
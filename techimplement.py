@@ -29,6 +29,8 @@ from PyQt4.QtGui import *
 from pydynamind import *
 import math
 import numpy as np
+import ubactiveblocks as ubactive
+import ubblockstore as ubstore
 
 class Techimplement(Module):
     """Loads the Blocks and Patches Shapefile and transfers all relevant information into
@@ -107,6 +109,8 @@ class Techimplement(Module):
 	#Views - From Urbplanbb
         self.mapattributes = View("GlobalMapAttributes", COMPONENT, WRITE)
 	self.mapattributes.getAttribute("NumBlocks")
+	self.mapattributes.getAttribute("ActiveBlockIDs")
+	self.mapattributes.getAttribute("BlockStore")
 	self.mapattributes.getAttribute("BlockSize")
 	self.mapattributes.getAttribute("WidthBlocks")
 	self.mapattributes.getAttribute("HeightBlocks")
@@ -193,6 +197,7 @@ class Techimplement(Module):
         self.addData("City", datastream)
 	
 	self.BLOCKIDtoUUID = {}
+	self.blockstore = None
         self.prevBLOCKIDtoUUID = {}     #DYNAMIND
         
     def run(self):
@@ -206,6 +211,7 @@ class Techimplement(Module):
         #Get global map attributes
 	strvec = city.getUUIDsOfComponentsInView(self.mapattributes)
         map_attr = city.getComponent(strvec[0])
+        self.blockstore = ubstore.getBlockStore(map_attr)      #None if the Block attributes are kept on the faces
         
         #Find out how many systems are in the list of systems to be implemented
 	strvec = city.getUUIDsOfComponentsInView(self.sysGlobal)
@@ -235,9 +241,8 @@ class Techimplement(Module):
                 
         #print sysList
         
-        #Begin looping across blocks
-        for i in range(int(blocks_num)):
-            currentID = i + 1
+        #Begin looping across the active blocks
+        for currentID in ubactive.getActiveBlockIDs(map_attr, blocks_num):
             currentAttList = self.getBlockUUID(currentID,city) #attribute list of current block structure
             masterplanAttList = self.getPrevBlockUUID(currentID, city)
             
@@ -585,6 +590,8 @@ class Techimplement(Module):
             self.prevBLOCKIDtoUUID[ID] = uuid
 
     def getBlockUUID(self, blockid,city):
+	if self.blockstore is not None:
+		return self.blockstore.record(blockid)     #attributes are read and written through the Block attribute store
 	try:
 		key = self.BLOCKIDtoUUID[blockid]
 	except KeyError:
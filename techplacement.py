@@ -28,10 +28,13 @@ import tech_designbydcv as dcv          #sub-functions that design based on desi
 import tech_designbyeq as deq           #sub-functions that design based on design equations
 import tech_designbysim as dsim         #sub-functions that design based on miniature simulations
 import ubseriesread as ubseries         #sub-functions responsible for processing climate data
+import ubactiveblocks as ubactive       #sparse index of the active Blocks
+import ubblockstore as ubstore          #memory-mapped Block attribute store
+import ubrandom as ubrand               #per-Block random streams
 
 from techplacementguic import *
 
-import os, sqlite3, gc, random
+import os, sqlite3, gc
 import numpy as np
 
 from PyQt4.QtCore import *
@@ -739,6 +742,10 @@ class Techplacement(Module):
 
 	self.mapattributes = View("GlobalMapAttributes", COMPONENT, WRITE)
 	self.mapattributes.getAttribute("NumBlocks")
+	self.mapattributes.getAttribute("ActiveBlockIDs")
+	self.mapattributes.getAttribute("BlockStore")
+	self.mapattributes.getAttribute("RNGSeed")
+	self.mapattributes.getAttribute("RNGCycle")
         self.mapattributes.addAttribute("OutputStrats")
 	
 	self.sysGlobal = View("SystemGlobal", COMPONENT, READ)
@@ -795,12 +802,16 @@ class Techplacement(Module):
 	self.addData("City", datastream)
 	
 	self.BLOCKIDtoUUID = {}
+	self.blockstore = None
+	self.rng = None
 
     def run(self):
         city = self.getData("City")
 	self.initBLOCKIDtoUUID(city)
         strvec = city.getUUIDsOfComponentsInView(self.mapattributes)
         map_attr = city.getComponent(strvec[0])
+        self.blockstore = ubstore.getBlockStore(map_attr)      #None if the Block attributes are kept on the faces
+        self.rng = ubrand.getStreamManager(map_attr, "techplacement")  #all random draws come from per-Block streams
         
         #CALCULATE SOME GLOBAL VARIABLES RELATING TO TARGETS
         self.system_tarQ = self.ration_runoff * self.targets_runoff
@@ -822,6 +833,7 @@ class Techplacement(Module):
 	
         #GET NECESSARY GLOBAL DATA TO DO ANALYSIS
         blocks_num = map_attr.getAttribute("NumBlocks").getDouble()     #number of blocks to loop through
+        activeIDs = ubactive.getActiveBlockIDs(map_attr, blocks_num)    #only the active Blocks are looped through
         self.block_size = map_attr.getAttribute("BlockSize").getDouble()    #size of block
         map_w = map_attr.getAttribute("WidthBlocks").getDouble()        #num of blocks wide
         map_h = map_attr.getAttribute("HeightBlocks").getDouble()       #num of blocks tall
@@ -858,8 +870,7 @@ class Techplacement(Module):
         ###-------------------------------------------------------------------###
         #  FIRST LOOP - WATER DEMANDS AND EFFICIENCY                            #
         ###-------------------------------------------------------------------###
-        for i in range(int(blocks_num)):
-            currentID = i+1
+        for currentID in activeIDs:
             currentAttList = self.getBlockUUID(currentID, city)
             if currentAttList.getAttribute("Status").getDouble() == 0:
                 continue
@@ -913,8 +924,7 @@ class Techplacement(Module):
             system_list[locate].append(curSys)  #Block ID [5], [curSys, curSys, curSys]
             
         #Do the retrofitting
-        for i in range(int(blocks_num)):
-            currentID = i+1
+        for currentID in activeIDs:
             currentAttList = self.getBlockUUID(currentID, city) #QUIT CONDITION #1 - status=0
             if currentAttList.getAttribute("Status").getDouble() == 0:
                 continue
@@ -967,8 +977,7 @@ class Techplacement(Module):
             self.evapscale = ubseries.convertVectorToScalingFactors(self.evapdata)
             self.raindata = ubseries.removeDateStampFromSeries(self.raindata)             #Remove the date stamps
             
-        for i in range(int(blocks_num)):
-            currentID = i+1
+        for currentID in activeIDs:
             print "Current on Block ",currentID
             currentAttList = self.getBlockUUID(currentID, city)
             if currentAttList.getAttribute("Status").getDouble() == 0:
@@ -1032,7 +1041,7 @@ class Techplacement(Module):
             currentBasinID = i+1
             print "Currently on Basin ID"+str(currentBasinID)
             
-            basinBlockIDs, outletID = self.getBasinBlockIDs(currentBasinID, blocks_num, city)
+            basinBlockIDs, outletID = self.getBasinBlockIDs(currentBasinID, activeIDs, city)
             basinEIA = self.retrieveAttributeFromIDs(city, basinBlockIDs, "Blk_EIA", "sum")
             #basinDem = self.retrieveAttributeFromIDs(city, basinBlockIDs, "Pop", "sum")        #>>> FUture
             
@@ -1065,7 +1074,8 @@ class Techplacement(Module):
             
             if len(basinBlockIDs) == 1: #if we are dealing with a single-block basin, reduce the number of iterations
                 iterations = 10
-            #Begin Monte Carlo
+            #Begin Monte Carlo, the basin samples from the streams of its outlet Block
+            strategystream = self.rng.stream(outletID, "Strategy")
             basin_strategies = []
             for iteration in range(iterations):   #1000 monte carlo simulations
                 print "Current Iteration No. ", iteration+1
@@ -1083,7 +1093,7 @@ class Techplacement(Module):
                     basinblockIDssampler.append(id)
                 
                 #Draw Samples
-                subbas_chosenIDs, inblocks_chosenIDs = self.selectTechLocationsByRandom(partakeIDssampler, basinblockIDssampler)
+                subbas_chosenIDs, inblocks_chosenIDs = self.selectTechLocationsByRandom(partakeIDssampler, basinblockIDssampler, strategystream)
                 #print subbas_chosenIDs
                 #Create the Basin Management Strategy Object
                 basinDem = np.inf
@@ -1093,7 +1103,7 @@ class Techplacement(Module):
                 
                 #Populate Basin Management Strategy Object based on the current sampled values
                 self.populateBasinWithTech(current_bstrategy, subbas_chosenIDs, inblocks_chosenIDs, 
-                                           partakeIDstracker, inblock_options, subbas_options, basinBlockIDs, city)
+                                           partakeIDstracker, inblock_options, subbas_options, basinBlockIDs, city, strategystream)
                 tt.updateBasinService(current_bstrategy)
                 
                 tt.calculateBasinStrategyMCAScores(current_bstrategy,self.priorities, self.mca_techlist, self.mca_tech, \
@@ -1131,12 +1141,13 @@ class Techplacement(Module):
             #Choose final option
             numselect = min(topcount, self.num_output_strats)   #Determines how many options out of the matrix it should select
             final_selection = []
+            selectionstream = self.rng.stream(outletID, "StrategySelect")
             for j in range(int(numselect)):            
                 score_matrix = []       #Create the score matrix
                 for opt in acceptable_options:
                     score_matrix.append(opt[2])
                 selection_cdf = self.createCDF(score_matrix)    #Creat the CDF
-                choice = self.samplefromCDF(selection_cdf)
+                choice = self.samplefromCDF(selection_cdf, selectionstream)
                 final_selection.append(acceptable_options[choice][3])   #Add ONLY the strategy_object
                 acceptable_options.pop(choice)  #Pop the option at the selected index from the matrix
                 #Repeat for as many options as requested
@@ -2690,14 +2701,14 @@ class Techplacement(Module):
 #                    continue
         return max(self.subbas_incr)
         
-    def getBasinBlockIDs(self, currentBasinID, numblocks, city):
+    def getBasinBlockIDs(self, currentBasinID, blockIDs, city):
         """Retrieves all blockIDs within the single basin and returns them in the order
-        of upstream to downstream based on the length of the upstream strings."""
+        of upstream to downstream based on the length of the upstream strings. Only the
+        Blocks in blockIDs are searched (the active Blocks, inactive ones have no basin)."""
         basinblocksortarray = []
         basinblockIDs = []
         outletID = 0
-        for i in range(int(numblocks)):
-            currentID = i+1
+        for currentID in blockIDs:
             currentAttList = self.getBlockUUID(currentID, city)
             if currentAttList.getAttribute("BasinID").getDouble() != currentBasinID:
                 continue
@@ -2730,22 +2741,22 @@ class Techplacement(Module):
         return partake_IDs
 
     
-    def selectTechLocationsByRandom(self, partakeIDs, basinblockIDs):
-        """Samples by random a number of sub-basin scale technologies and in-block locations
-        for the model to place technologies in, returns two arrays: one of the chosen
-        sub-basin IDs and one of the chosen in-block locations"""
-        techs_subbas = random.randint(0,len(partakeIDs))
+    def selectTechLocationsByRandom(self, partakeIDs, basinblockIDs, rng):
+        """Samples by random (from the random stream rng) a number of sub-basin scale technologies
+        and in-block locations for the model to place technologies in, returns two arrays: one of
+        the chosen sub-basin IDs and one of the chosen in-block locations"""
+        techs_subbas = rng.randint(0,len(partakeIDs))
         subbas_chosenIDs = []
         for j in range(techs_subbas):
-            sample_index = random.randint(0,len(partakeIDs)-1)
+            sample_index = rng.randint(0,len(partakeIDs)-1)
             subbas_chosenIDs.append(partakeIDs[sample_index])
             basinblockIDs.remove(partakeIDs[sample_index]) #remove from blocks posisbilities
             partakeIDs.pop(sample_index) #pop the value from the partake list
         
-        techs_blocks = random.randint(0, len(basinblockIDs))
+        techs_blocks = rng.randint(0, len(basinblockIDs))
         inblocks_chosenIDs = []
         for j in range(techs_blocks):
-            sample_index = random.randint(0,len(basinblockIDs)-1)       #If sampling an index, must subtract 1 from len()
+            sample_index = rng.randint(0,len(basinblockIDs)-1)       #If sampling an index, must subtract 1 from len()
             inblocks_chosenIDs.append(basinblockIDs[sample_index])
             basinblockIDs.pop(sample_index)
         
@@ -2756,7 +2767,7 @@ class Techplacement(Module):
         return subbas_chosenIDs, inblocks_chosenIDs
     
     def populateBasinWithTech(self, current_bstrategy, subbas_chosenIDs, inblocks_chosenIDs, 
-                              partakeIDstracker, inblock_options, subbas_options, basinBlockIDs, city):
+                              partakeIDstracker, inblock_options, subbas_options, basinBlockIDs, city, rng):
         """Scans through all blocks within a basin from upstream to downstream end and populates the
         various areas selected in chosenIDs arrays with possible technologies available from the 
         options arrays. Returns an updated current_bstrategy object completed with all details.
@@ -2876,7 +2887,7 @@ class Techplacement(Module):
             
             #PICK A SUB-BASIN TECHNOLOGY
             if currentBlockID in subbas_chosenIDs:              #PART A - first the degree
-                deg, obj, treatedAimp, treatedDem = self.pickOption(currentBlockID, max_degree, subbas_options, totalAimp_subbasin) 
+                deg, obj, treatedAimp, treatedDem = self.pickOption(currentBlockID, max_degree, subbas_options, totalAimp_subbasin, rng) 
                 subbas_treatedAimpQty += treatedAimp
                 subbas_treatedAimpWQ += treatedAimp
                 subbas_treatedDem += treatedDem
@@ -2899,7 +2910,7 @@ class Techplacement(Module):
                 max_degree = min(remainAimp_subbasinQty/block_Aimp, 
                                  remainAimp_subbasinWQ/block_Aimp, remainDem_subbasinRec/block_Dem, 1.0)+float(self.service_redundancy/100.0)  #PART A - first the degree
                 
-                deg, obj, treatedAimp, treatedDem = self.pickOption(rbID,max_degree,inblock_options, block_Aimp) 
+                deg, obj, treatedAimp, treatedDem = self.pickOption(rbID,max_degree,inblock_options, block_Aimp, rng) 
                 subbas_treatedAimpQty += treatedAimp
                 subbas_treatedAimpWQ += treatedAimp
                 subbas_treatedDem += treatedDem
@@ -2948,7 +2959,7 @@ class Techplacement(Module):
             performance = -1       #One objective at least, not fulfilled
         return performance
     
-    def pickOption(self, blockID, max_degree, options_collection, Aimp):
+    def pickOption(self, blockID, max_degree, options_collection, Aimp, rng):
         """Picks and returns a random option based on the input impervious area and maximum
         treatment degree. Can be used on either the in-block strategies or larger precinct 
         strategies. If it cannot pick anything, it will return zeros all around.
@@ -2959,7 +2970,7 @@ class Techplacement(Module):
             if deg <= max_degree:
                 indices.append(deg)
         if len(indices) != 0:
-            choice = random.randint(0, len(indices)-1)
+            choice = rng.randint(0, len(indices)-1)
             chosen_deg = self.subbas_incr[choice]
         else:
             return 0,0,0
@@ -2967,7 +2978,7 @@ class Techplacement(Module):
         Nopt = len(options_collection["BlockID"+str(blockID)][chosen_deg])
         if chosen_deg != 0 and Nopt != 0:
             treatedAimp = chosen_deg * Aimp
-            choice = random.randint(0, Nopt-1)
+            choice = rng.randint(0, Nopt-1)
             chosen_obj = options_collection["BlockID"+str(blockID)][chosen_deg][choice]
             return chosen_deg, chosen_obj, treatedAimp, treatedDem
         else:
@@ -2989,10 +3000,11 @@ class Techplacement(Module):
         return cdf
         return cdf
     
-    def samplefromCDF(self, selection_cdf):
+    def samplefromCDF(self, selection_cdf, rng):
         """Samples one sample from a cumulative distribution function and returns
-        the index. Sampling is uniform, probabilities are determined by the CDF"""
-        p_sample = random.random()
+        the index. Sampling is uniform (from the random stream rng), probabilities
+        are determined by the CDF"""
+        p_sample = rng.random()
         for i in range(len(selection_cdf)):
             if p_sample <= selection_cdf[i]:
                 return i
@@ -3133,9 +3145,10 @@ class Techplacement(Module):
             city.addComponent(loc, self.wsudAttr)
         return True
     
-    def determineBlockWaterRating(self):
+    def determineBlockWaterRating(self, rng):
         """Determine the efficiency of the indoor appliances based on user 
-        inputs. Several options available including different sampling distirbutions."""
+        inputs. Several options available including different sampling distirbutions,
+        samples are drawn from the Block's random stream rng."""
         if self.WEFstatus == 0:
             return 0
         elif self.WEF_method == "C":
@@ -3146,18 +3159,18 @@ class Techplacement(Module):
             if self.WEF_includezero:
                 minrating = 0
             if self.WEF_distribution == "UF":
-                return int(random.randint(minrating, maxrating))
+                return int(rng.randint(minrating, maxrating))
             #Not uniform distribution --> Use Normal Variations instead
             mu = (minrating + maxrating)/2         #mean is in the 'centre of the distribution'
             sigma = (maxrating - minrating)*0.63/2      #63% of data lies within +/- 1 stdev of the mean
             samplerating = -1   #initialize
             while samplerating < minrating or samplerating > maxrating:
                 if self.WEF_distribution == "NM":
-                    samplerating = int(random.normalvariate(mu, sigma))
+                    samplerating = int(rng.normalvariate(mu, sigma))
                 elif self.WEF_distribution == "LL":
-                    samplerating = int(random.normalvariate(log(mu), log(sigma)))
+                    samplerating = int(rng.normalvariate(log(mu), log(sigma)))
                 elif self.WEF_distribution == "LH":
-                    samplerating = int(random.normalvariate(log(mu), log(sigma)))
+                    samplerating = int(rng.normalvariate(log(mu), log(sigma)))
                     samplerating = (maxrating + minrating) - samplerating #Reverse the rating
             return samplerating
         print "Error with blockwater rating function"
@@ -3183,9 +3196,10 @@ class Techplacement(Module):
                     frdAS6400["Shower"][int(rating)], frdAS6400["Laundry"][int(rating)]]
         return True
 
-    def getResIndoorDemands(self, occup, flowrates, flowvary):
-        """Calculates and varies indoor demands based on input occupancy and flowrates.
-        Returns four values of demands for kitchen, shower, toilet and laundry end uses"""
+    def getResIndoorDemands(self, occup, flowrates, flowvary, rng):
+        """Calculates and varies indoor demands based on input occupancy and flowrates, the
+        variations are drawn from the random stream rng. Returns four values of demands for
+        kitchen, shower, toilet and laundry end uses"""
         kitchendem = self.freq_kitchen * self.dur_kitchen * occup * flowrates[0]
         showerdem = self.freq_shower * self.dur_shower * occup * flowrates[1]
         toiletdem = self.freq_toilet * occup * flowrates[2]
@@ -3194,33 +3208,34 @@ class Techplacement(Module):
         #Vary demands
         kitchendemF = -1
         while kitchendemF <= 0:
-            kitchendemF = kitchendem + random.uniform(kitchendem*flowvary[0]*(-1),
+            kitchendemF = kitchendem + rng.uniform(kitchendem*flowvary[0]*(-1),
                                                  kitchendem*flowvary[0])
         showerdemF = -1
         while showerdemF <= 0:
-            showerdemF = showerdem + random.uniform(showerdem*flowvary[1]*(-1),
+            showerdemF = showerdem + rng.uniform(showerdem*flowvary[1]*(-1),
                                                showerdem*flowvary[1])
         toiletdemF = -1
         while toiletdemF <= 0:
-            toiletdemF = toiletdem + random.uniform(toiletdem*flowvary[2]*(-1),
+            toiletdemF = toiletdem + rng.uniform(toiletdem*flowvary[2]*(-1),
                                                toiletdem*flowvary[2])
         laundrydemF = -1
         while laundrydemF <= 0:
-            laundrydemF = laundrydem + random.uniform(laundrydem*flowvary[3]*(-1),
+            laundrydemF = laundrydem + rng.uniform(laundrydem*flowvary[3]*(-1),
                                                  laundrydem*flowvary[3])
         return kitchendemF, showerdemF, toiletdemF, laundrydemF
     
-    def getNonResIndoorDemand(self, unitvariable, demand, vary):
+    def getNonResIndoorDemand(self, unitvariable, demand, vary, rng):
         """Calculates the total indoor demand based on a single value of [L/sqm/day] and
         adds variation to this value if specified
             - unitvariable = total floor space of the facility [sqm] or total employed at facility [cap]
             - demand = total indoor demand rate [L/sqm/day]
             - vary = proportionate variation +/- value * demand
+            - rng = random stream the variation is drawn from
         """
         demand = unitvariable * demand  #either L/cap/day x capita or L/sqm/day x sqm
         demandF = -1
         while demandF < 0:
-            demandF = demand + random.uniform(demand*vary*(-1), demand*vary)
+            demandF = demand + rng.uniform(demand*vary*(-1), demand*vary)
         return demandF
 
     def calculateBlockWaterDemand(self, currentAttList):
@@ -3238,8 +3253,9 @@ class Techplacement(Module):
         totalBlockNonResWD = 0      #Block total nonresidential demand
         waterDemandDict = {}
         
-        #Determine Efficiency
-        blockrating = self.determineBlockWaterRating()
+        #Determine Efficiency, every end use draws from its own stream of the Block
+        currentID = int(currentAttList.getAttribute("BlockID").getDouble())
+        blockrating = self.determineBlockWaterRating(self.rng.stream(currentID, "WaterRating"))
         waterDemandDict["Efficiency"] = blockrating
         flowratesEff = self.retrieveFlowRates(blockrating)  #for areas with water efficiency
         flowratesZero = self.retrieveFlowRates(0)        #for areas without water efficiency
@@ -3254,7 +3270,7 @@ class Techplacement(Module):
                 resflows = flowratesZero
                 
             occup = currentAttList.getAttribute("HouseOccup").getDouble()
-            kitchendem, showerdem, toiletdem, laundrydem = self.getResIndoorDemands(occup, resflows, flowratesVary)
+            kitchendem, showerdem, toiletdem, laundrydem = self.getResIndoorDemands(occup, resflows, flowratesVary, self.rng.stream(currentID, "DemandHouse"))
             totalHouseIndoor = (kitchendem + showerdem + toiletdem + laundrydem)/1000 #[kL/hh/day]
             totalIndoorAnn = totalHouseIndoor*365*currentAttList.getAttribute("ResHouses").getDouble()
             waterDemandDict["RESkitchen"] = round(kitchendem,2)
@@ -3295,7 +3311,7 @@ class Techplacement(Module):
                 resflows = flowratesZero
             
             occup = currentAttList.getAttribute("HDROccup").getDouble()
-            kitchendem, showerdem, toiletdem, laundrydem = self.getResIndoorDemands(occup, resflows, flowratesVary)
+            kitchendem, showerdem, toiletdem, laundrydem = self.getResIndoorDemands(occup, resflows, flowratesVary, self.rng.stream(currentID, "DemandFlats"))
             totalFlatIndoor = (kitchendem + showerdem + toiletdem + laundrydem)/1000        #[kL/day]
             totalIndoorAnn = totalFlatIndoor*365*currentAttList.getAttribute("HDRFlats").getDouble()
             waterDemandDict["HDRkitchen"] = round(kitchendem,2)
@@ -3337,10 +3353,10 @@ class Techplacement(Module):
                 Afloor = currentAttList.getAttribute("LIAeBldg").getDouble() * \
                     currentAttList.getAttribute("LIFloors").getDouble() * \
                         currentAttList.getAttribute("LIestates").getDouble()
-                demand = self.getNonResIndoorDemand(Afloor, self.li_demand, self.li_demandvary/100)
+                demand = self.getNonResIndoorDemand(Afloor, self.li_demand, self.li_demandvary/100, self.rng.stream(currentID, "DemandLI"))
             elif self.li_demandunits == 'cap':
                 employed = currentAttList.getAttribute("LIjobs").getDouble()
-                demand = self.getNonResIndoorDemand(employed, self.li_demand, self.li_demandvary/100)
+                demand = self.getNonResIndoorDemand(employed, self.li_demand, self.li_demandvary/100, self.rng.stream(currentID, "DemandLI"))
             lipublic = currentAttList.getAttribute("avLt_LI").getDouble()*currentAttList.getAttribute("LIestates").getDouble()
             waterDemandDict["LIDemand"] = demand/1000
             totalBlockNonResWD += demand/1000
@@ -3352,10 +3368,10 @@ class Techplacement(Module):
                 Afloor = currentAttList.getAttribute("HIAeBldg").getDouble() * \
                     currentAttList.getAttribute("HIFloors").getDouble()* \
                         currentAttList.getAttribute("HIestates").getDouble()
-                demand = self.getNonResIndoorDemand(Afloor, self.hi_demand, self.hi_demandvary/100)
+                demand = self.getNonResIndoorDemand(Afloor, self.hi_demand, self.hi_demandvary/100, self.rng.stream(currentID, "DemandHI"))
             elif self.hi_demandunits == 'cap':
                 employed = currentAttList.getAttribute("HIjobs").getDouble()
-                demand = self.getNonResIndoorDemand(employed, self.hi_demand, self.hi_demandvary/100)
+                demand = self.getNonResIndoorDemand(employed, self.hi_demand, self.hi_demandvary/100, self.rng.stream(currentID, "DemandHI"))
             hipublic = currentAttList.getAttribute("avLt_HI").getDouble()*currentAttList.getAttribute("HIestates").getDouble()
             waterDemandDict["HIDemand"] = demand/1000
             totalBlockNonResWD += demand/1000
@@ -3367,10 +3383,10 @@ class Techplacement(Module):
                 Afloor = currentAttList.getAttribute("COMAeBldg").getDouble() * \
                     currentAttList.getAttribute("COMFloors").getDouble()* \
                         currentAttList.getAttribute("COMestates").getDouble()
-                demand = self.getNonResIndoorDemand(Afloor, self.com_demand, self.com_demandvary/100)
+                demand = self.getNonResIndoorDemand(Afloor, self.com_demand, self.com_demandvary/100, self.rng.stream(currentID, "DemandCOM"))
             elif self.com_demandunits == 'cap':
                 employed = currentAttList.getAttribute("COMjobs").getDouble()
-                demand = self.getNonResIndoorDemand(employed, self.com_demand, self.com_demandvary/100)
+                demand = self.getNonResIndoorDemand(employed, self.com_demand, self.com_demandvary/100, self.rng.stream(currentID, "DemandCOM"))
             compublic = currentAttList.getAttribute("avLt_COM").getDouble()*currentAttList.getAttribute("COMestates").getDouble()
             waterDemandDict["COMDemand"] = demand/1000
             totalBlockNonResWD += demand/1000
@@ -3382,10 +3398,10 @@ class Techplacement(Module):
                 Afloor = currentAttList.getAttribute("ORCAeBldg").getDouble() * \
                     currentAttList.getAttribute("ORCFloors").getDouble() * \
                         currentAttList.getAttribute("ORCestates").getDouble()
-                demand = self.getNonResIndoorDemand(Afloor, self.com_demand, self.com_demandvary/100)
+                demand = self.getNonResIndoorDemand(Afloor, self.com_demand, self.com_demandvary/100, self.rng.stream(currentID, "DemandORC"))
             elif self.com_demandunits == 'cap':
                 employed = currentAttList.getAttribute("ORCjobs").getDouble()
-                demand = self.getNonResIndoorDemand(employed, self.com_demand, self.com_demandvary/100)
+                demand = self.getNonResIndoorDemand(employed, self.com_demand, self.com_demandvary/100, self.rng.stream(currentID, "DemandORC"))
             orcpublic = currentAttList.getAttribute("avLt_ORC").getDouble()*currentAttList.getAttribute("ORCestates").getDouble()
             waterDemandDict["ORCDemand"] = demand/1000
             totalBlockNonResWD += demand/1000
@@ -3794,6 +3810,8 @@ class Techplacement(Module):
         return True  
 
     def getBlockUUID(self, blockid,city):
+	if self.blockstore is not None:
+            return self.blockstore.record(blockid)      #attributes are read and written through the Block attribute store
 	try:
             key = self.BLOCKIDtoUUID[blockid]
 	except KeyError:
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+@file
+@author  Peter M Bach <peterbach@gmail.com>
+@version 1.0
+@section LICENSE
+
+This file is part of UrbanBEATS (www.urbanbeatsmodel.com)
+Copyright (C) 2011, 2012, 2013  Peter M Bach
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+import numpy as np
+
+#Sparse active Block index: irregular catchments leave large parts of the Block grid inactive.
+#Delinblocks publishes the ordered IDs of all active Blocks as the map attribute "ActiveBlockIDs"
+#(written like UpstrIDs, e.g. "3,4,9,"), later modules loop over these IDs only instead of
+#fetching the Status of every Block in the grid.
+
+def encodeActiveBlockIDs(status):
+    """Returns the ActiveBlockIDs string of the Block status array (indexed [BlockID-1])"""
+    return "".join([str(i+1)+"," for i in np.flatnonzero(np.asarray(status) != 0)])
+
+
+def getActiveBlockIDs(map_attr, blocks_num):
+    """Returns the list of active Block IDs in ascending order from the map attributes. If the
+    map has no active Block index (e.g. it was not created by this version of Delinblocks),
+    all Block IDs are returned and the modules' own Status checks skip the inactive Blocks."""
+    activestring = map_attr.getAttribute("ActiveBlockIDs").getString()
+    if activestring == "":
+        return range(1, int(blocks_num)+1)
+    return [int(ID) for ID in activestring.split(",") if ID != ""]
+
+
+def getInactiveBlockIDs(activeIDs, blocks_num):
+    """Returns the list of all Block IDs that are not in activeIDs, in ascending order"""
+    isactive = np.zeros(int(blocks_num)+1, dtype = bool)
+    isactive[activeIDs] = True
+    return [int(ID) for ID in np.flatnonzero(~isactive[1:]) + 1]
+
+
+def getActiveBlockIndex(activeIDs, blocks_num):
+    """Reverse map of the active Block index: returns an array indexed by Block ID that holds
+    the position of the Block in activeIDs, -1 for inactive Blocks, so that per-Block data of
+    the active Blocks can be kept in compact arrays."""
+    index = np.empty(int(blocks_num)+1, dtype = np.int64)
+    index.fill(-1)
+    index[activeIDs] = np.arange(len(activeIDs))
+    return index
@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+"""
+@file
+@author  Peter M Bach <peterbach@gmail.com>
+@version 1.0
+@section LICENSE
+
+This file is part of UrbanBEATS (www.urbanbeatsmodel.com)
+Copyright (C) 2011, 2012, 2013  Peter M Bach
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+import hashlib, math, os
+import numpy as np
+
+NODATA = -9999
+BLOCKCACHE_VERSION = 2
+PYRAMID_VERSION = 2
+FINGERPRINT_SAMPLES = 256        #cells sampled along each axis of a raster for its fingerprint
+LANDUSE_CLASSES = ["RES", "COM", "ORC", "LI", "HI", "CIV", "SVU", "RD", "TR", "PG", "REF", "UND", "NA"]     #land use classes 1...13
+DATASOURCE_NAMES = ["LandUse", "Population", "Elevation", "Soil", "PlanMap", "Employment", "Groundwater", "SocPar1", "SocPar2"]
+
+def rasterToArray(raster, ncols, nrows, rowstart = 0):
+    """Reads a window of raster rows into a NumPy array of shape (nrows, ncols), indexed
+    [y, x]. The array is padded with NODATA wherever the block grid extends beyond the
+    raster extents, so that it can be split evenly into blocks. The DynaMind raster offers
+    Python no bulk accessor for rows or the whole grid, so every cell is still one getValue
+    call, made only once per run; all later statistics work on the array.
+        - raster: the raster data object (supports getWidth, getHeight and getValue)
+        - ncols: number of columns of the padded array (blocks wide * cells in block)
+        - nrows: number of rows to read (blocks tall * cells in block for the whole map)
+        - rowstart: first raster row of the window, 0 reads from the start of the map
+    """
+    data = np.empty((nrows, ncols), dtype = np.float64)
+    data.fill(NODATA)
+    rwidth = min(int(raster.getWidth()), ncols)
+    rheight = min(int(raster.getHeight()) - rowstart, nrows)
+    for j in range(rheight):
+        data[j, :rwidth] = np.fromiter((raster.getValue(i, rowstart + j) for i in range(rwidth)), dtype = np.float64, count = rwidth)
+    return data
+
+
+def blockView(data, cellsinblock):
+    """Returns a (blocks_y, cells, blocks_x, cells) view of the [y, x] data array, no
+    data is copied. Reductions over axes (1, 3) return one value per block."""
+    nrows, ncols = data.shape
+    return data.reshape(nrows//cellsinblock, cellsinblock, ncols//cellsinblock, cellsinblock)
+
+
+def blockMatrix(data, x, y, cellsinblock):
+    """Returns the cells of Block (x, y) as a matrix indexed [x][y], i.e. the layout
+    used by the patch delineation and all previous per-block data matrices."""
+    return data[y*cellsinblock:(y+1)*cellsinblock, x*cellsinblock:(x+1)*cellsinblock].T
+
+
+def validMask(data):
+    """Returns a boolean array that is True wherever data holds a valid (non-NODATA) value"""
+    return data != NODATA
+
+
+def blockCount(mask, cellsinblock):
+    """Counts the True cells of a mask within each block, returns a (blocks_y, blocks_x) array"""
+    return blockView(mask, cellsinblock).sum(axis = (1, 3))
+
+
+def blockSum(data, mask, cellsinblock):
+    """Sums all values of data within each block where the mask is True"""
+    return blockView(np.where(mask, data, 0.0), cellsinblock).sum(axis = (1, 3))
+
+
+def blockMean(data, mask, cellsinblock):
+    """Masked mean within each block. Blocks without any valid cell return 0, which is
+    identical to the previous behaviour of dividing a zero sum by an adjusted count of 1."""
+    total = blockSum(data, mask, cellsinblock)
+    count = blockCount(mask, cellsinblock)
+    return total / np.maximum(count, 1), count
+
+
+def blockClassFrequency(data, numclasses, cellsinblock):
+    """Counts how many cells of each class 1...numclasses are found in every block.
+    Returns an array of shape (numclasses, blocks_y, blocks_x). Cells with NODATA or
+    with a class outside the range are ignored."""
+    by, bx = data.shape[0]//cellsinblock, data.shape[1]//cellsinblock
+    classes = np.where(validMask(data), data, 0).astype(np.int64)
+    classes[(classes < 1) | (classes > numclasses)] = 0
+    #Flatten the block index and the class index into one key and count them all at once
+    blockindex = np.arange(by*bx).reshape(by, 1, bx, 1)
+    blockindex = np.broadcast_to(blockindex, (by, cellsinblock, bx, cellsinblock))
+    keys = blockindex.ravel() * (numclasses + 1) + blockView(classes, cellsinblock).ravel()
+    counts = np.bincount(keys, minlength = by*bx*(numclasses + 1)).reshape(by, bx, numclasses + 1)
+    return np.rollaxis(counts[:, :, 1:], 2)
+
+
+def blockClassMean(data, classes, classlist, cellsinblock):
+    """Calculates the mean of data within each block separately for the cells that fall
+    into each class of classlist (e.g. Planner's Map values on RES, COM, LI, HI land).
+    Returns a list of (mean, count) tuples in the order of classlist."""
+    datamask = validMask(data)
+    results = []
+    for c in classlist:
+        results.append(blockMean(data, datamask & (classes == c), cellsinblock))
+    return results
+
+
+def summedAreaTable(grid):
+    """Integral image of a Block grid of shape (..., blocks_y, blocks_x), e.g. one grid per
+    land use class. It has one extra leading row and column of zeros, so that entry [y, x]
+    holds the sum of all Blocks above and left of Block (x, y) and windows need no special
+    case at the map edges."""
+    grid = np.asarray(grid, dtype = np.float64)
+    sat = np.zeros(grid.shape[:-2] + (grid.shape[-2]+1, grid.shape[-1]+1))
+    sat[..., 1:, 1:] = grid.cumsum(axis = -2).cumsum(axis = -1)
+    return sat
+
+
+def windowSum(sat, radius):
+    """Moving window sums from a summedAreaTable(): returns for every Block the sum of all
+    Blocks within radius Blocks in x and y (a square of 2*radius+1 Blocks, cut off at the
+    map edges). Each window costs four lookups, independent of the radius."""
+    height, width = sat.shape[-2]-1, sat.shape[-1]-1
+    y0 = np.clip(np.arange(height) - radius, 0, height)[:, np.newaxis]
+    y1 = np.clip(np.arange(height) + radius + 1, 0, height)[:, np.newaxis]
+    x0 = np.clip(np.arange(width) - radius, 0, width)[np.newaxis, :]
+    x1 = np.clip(np.arange(width) + radius + 1, 0, width)[np.newaxis, :]
+    return sat[..., y1, x1] - sat[..., y0, x1] - sat[..., y1, x0] + sat[..., y0, x0]
+
+
+def distanceTransform(features):
+    """Exact Euclidean distance transform of the Block grid: returns the distance [#Blocks]
+    from every Block centre to the centre of the nearest Block where features is True, or
+    NODATA everywhere if there is no such Block. Two separable passes in linear time: the
+    distance to the nearest feature along each column, then per row the lower envelope of
+    the parabolas of these distances (Felzenszwalb & Huttenlocher, 2012).
+        - features: boolean array of shape (blocks_y, blocks_x)
+    """
+    height, width = features.shape
+    nofeature = height + width          #longer than any distance along a column
+    coldist = np.where(features, 0, nofeature).astype(np.float64)
+    for y in range(1, height):
+        coldist[y] = np.minimum(coldist[y], coldist[y-1] + 1)
+    for y in range(height-2, -1, -1):
+        coldist[y] = np.minimum(coldist[y], coldist[y+1] + 1)
+    
+    sqdist = np.empty((height, width))
+    for y in range(height):
+        sqdist[y] = lowerEnvelope1D((coldist[y]**2).tolist())
+    if not features.any():
+        sqdist.fill(NODATA)
+        return sqdist
+    return np.sqrt(sqdist)
+
+
+def lowerEnvelope1D(f):
+    """Squared 1D distance transform of the sampled function f (a list): returns for every q
+    the minimum over all p of (q-p)^2 + f[p], see distanceTransform()"""
+    n = len(f)
+    v = [0] * n                     #positions of the parabolas in the lower envelope
+    z = [0.0] * (n + 1)             #boundaries between them
+    z[0] = -float("inf")
+    z[1] = float("inf")
+    k = 0
+    for q in range(1, n):
+        s = ((f[q] + q*q) - (f[v[k]] + v[k]*v[k])) / (2.0*q - 2.0*v[k])
+        while s <= z[k]:
+            k -= 1
+            s = ((f[q] + q*q) - (f[v[k]] + v[k]*v[k])) / (2.0*q - 2.0*v[k])
+        k += 1
+        v[k] = q
+        z[k] = s
+        z[k+1] = float("inf")
+    d = [0.0] * n
+    k = 0
+    for q in range(n):
+        while z[k+1] < q:
+            k += 1
+        d[q] = (q - v[k])*(q - v[k]) + f[v[k]]
+    return d
+
+
+def walkLinesThroughBlocks(lines, xorigin, yorigin, cs, widthnew, heightnew):
+    """Rasterises polylines (e.g. rivers) onto the Block grid by walking every segment from
+    Block boundary to Block boundary (a DDA / supercover traversal): each step moves to the
+    next Block boundary the segment crosses, so the cost is proportional to the number of
+    Blocks crossed and no Block the line passes through can be missed. Where a segment runs
+    exactly through a Block corner, the two Blocks touching the corner are marked as well.
+        - lines: list of lines, each a list of [x, y] vertices
+        - xorigin, yorigin: real-world coordinates of the bottom-left corner of Block 1
+        - cs: Block size [m]
+        - widthnew, heightnew: size of the Block grid [#Blocks]
+    Returns (crossed, length): flat arrays indexed by [BlockID-1], True for every Block the
+    lines pass through and the length of line within each Block [m]. Parts of the lines
+    outside the Block grid are ignored.
+    """
+    numblocks = widthnew * heightnew
+    crossed = np.zeros(numblocks, dtype = bool)
+    length = np.zeros(numblocks)
+    
+    def visit(bx, by, seglength):
+        if 0 <= bx < widthnew and 0 <= by < heightnew:
+            crossed[by*widthnew + bx] = True
+            length[by*widthnew + bx] += seglength
+    
+    for line in lines:
+        for k in range(len(line) - 1):
+            x0, y0 = (line[k][0] - xorigin)/cs, (line[k][1] - yorigin)/cs          #in Block units
+            x1, y1 = (line[k+1][0] - xorigin)/cs, (line[k+1][1] - yorigin)/cs
+            dx, dy = x1 - x0, y1 - y0
+            seglength = math.hypot(dx, dy) * cs
+            if seglength == 0:
+                continue
+            bx, by = int(math.floor(x0)), int(math.floor(y0))
+            stepx = 1 if dx > 0 else -1
+            stepy = 1 if dy > 0 else -1
+            #t (0...1 along the segment) at the next vertical and horizontal Block boundary
+            tdeltax = abs(1.0/dx) if dx != 0 else float("inf")
+            tdeltay = abs(1.0/dy) if dy != 0 else float("inf")
+            tmaxx = ((bx + 1 - x0) if dx > 0 else (x0 - bx)) * tdeltax if dx != 0 else float("inf")
+            tmaxy = ((by + 1 - y0) if dy > 0 else (y0 - by)) * tdeltay if dy != 0 else float("inf")
+            t = 0.0
+            while True:
+                tnext = min(tmaxx, tmaxy, 1.0)
+                if tnext > t:
+                    visit(bx, by, (tnext - t) * seglength)
+                if tnext >= 1.0:
+                    break
+                if tmaxx < tmaxy:
+                    bx += stepx
+                    t = tmaxx
+                    tmaxx += tdeltax
+                elif tmaxy < tmaxx:
+                    by += stepy
+                    t = tmaxy
+                    tmaxy += tdeltay
+                else:                   #through a corner, mark both Blocks touching it
+                    visit(bx + stepx, by, 0.0)
+                    visit(bx, by + stepy, 0.0)
+                    bx += stepx
+                    by += stepy
+                    t = tmaxx
+                    tmaxx += tdeltax
+                    tmaxy += tdeltay
+    return crossed, length
+
+
+def binPointsToBlocks(points, xcol, ycol, xorigin, yorigin, cs, widthnew, heightnew):
+    """Spatial index of point features (river points, lake centroids, facilities): bins
+    every point into the Block it falls in with integer arithmetic, so that each Block can
+    fetch its points directly instead of scanning the whole list. A point belongs to the
+    Block with xmin <= x < xmax and ymin <= y < ymax, points outside the grid are dropped.
+        - points: list of point features, e.g. [[x, y, ...], ...]
+        - xcol, ycol: positions of the x and y coordinates within each feature
+        - xorigin, yorigin: real-world coordinates of the bottom-left corner of Block 1
+        - cs: Block size [m]
+        - widthnew, heightnew: size of the Block grid [#Blocks]
+    Returns (order, ptr): the indices of the points in Block i+1 are order[ptr[i]:ptr[i+1]],
+    kept in their original list order.
+    """
+    numblocks = widthnew * heightnew
+    xcoords = np.array([p[xcol] for p in points], dtype = np.float64)
+    ycoords = np.array([p[ycol] for p in points], dtype = np.float64)
+    xblock = np.floor((xcoords - xorigin) / cs).astype(np.int64)
+    yblock = np.floor((ycoords - yorigin) / cs).astype(np.int64)
+    inside = (xblock >= 0) & (xblock < widthnew) & (yblock >= 0) & (yblock < heightnew)
+    blockindex = yblock * widthnew + xblock
+    
+    pointIDs = np.flatnonzero(inside)
+    order = pointIDs[np.argsort(blockindex[inside], kind = "mergesort")]
+    ptr = np.concatenate([[0], np.cumsum(np.bincount(blockindex[inside], minlength = numblocks))])
+    return order, ptr
+
+
+def getBlockPoints(pointindex, bindex):
+    """Returns the indices of all points in Block bindex+1 from a binPointsToBlocks() index"""
+    order, ptr = pointindex
+    return order[ptr[bindex]:ptr[bindex+1]]
+
+
+def blockDigests(data, cellsinblock):
+    """Content hash of every Block's window of a raster: the SHA-1 digest of the cells of
+    each block, returned as a (blocks, 20) array of bytes in Block ID order. Two windows
+    with the same digest hold identical cell values."""
+    by, bx = data.shape[0]//cellsinblock, data.shape[1]//cellsinblock
+    windows = np.ascontiguousarray(blockView(data, cellsinblock).transpose(0, 2, 1, 3)).reshape(by*bx, -1)
+    digests = "".join([hashlib.sha1(w.tostring()).digest() for w in windows])
+    return np.frombuffer(digests, dtype = np.uint8).reshape(by*bx, 20)
+
+
+def changedBlocks(digests, cacheddigests, names, blockslice):
+    """Returns a boolean array that is True for every Block of blockslice whose window of any
+    of the rasters in names differs from the cache (or if there is no cache at all).
+        - digests: dictionary of the current blockDigests() arrays of the whole map
+        - cacheddigests: the same dictionary from the block cache, or None
+        - names: the rasters the compared values depend on
+        - blockslice: the Blocks to compare, e.g. the Blocks of the current strip
+    """
+    numblocks = len(digests[names[0]][blockslice])
+    if cacheddigests is None:
+        return np.ones(numblocks, dtype = bool)
+    changed = np.zeros(numblocks, dtype = bool)
+    for name in names:
+        if name in cacheddigests:
+            changed |= (digests[name][blockslice] != cacheddigests[name][blockslice]).any(axis = 1)
+        else:
+            changed[:] = True
+    return changed
+
+
+def getBlockCacheKey(settings):
+    """Returns the key of a block cache, a SHA-1 hash of all settings the aggregated Block
+    values depend on (Block size, resolution, data types, units, datums, ...). Cached
+    Blocks are only reused if the keys match."""
+    keyhash = hashlib.sha1()
+    keyhash.update(str(BLOCKCACHE_VERSION))
+    keyhash.update(repr([str(s) for s in settings]))
+    return keyhash.hexdigest()
+
+
+def saveBlockCache(filename, key, digests, records, patches):
+    """Saves the per-Block window digests of all input rasters, the aggregated Block values
+    (records) and the packed patches of all Blocks (see ubpatchdelin.packPatches, an empty
+    dictionary if no patches are delineated) to a compressed NumPy archive (.npz)."""
+    archive = {}
+    archive["Key"] = np.array(key)
+    for name in digests:
+        archive["Digest_"+name] = digests[name]
+    for name in records:
+        archive["Record_"+name] = records[name]
+    for name in patches:
+        archive["Patch_"+name] = patches[name]
+    f = open(filename, 'wb')
+    np.savez_compressed(f, **archive)
+    f.close()
+    return True
+
+
+def loadBlockCache(filename, key, numblocks):
+    """Loads a block cache saved with saveBlockCache. Returns None if the file is missing,
+    unreadable, was saved for a different key or a different number of Blocks, otherwise a
+    dictionary with the "Digests", "Records" and "Patches" dictionaries."""
+    if not os.path.isfile(filename):
+        return None
+    try:
+        archive = np.load(filename)
+        if str(archive["Key"]) != key:
+            return None
+        blockcache = {"Digests" : {}, "Records" : {}, "Patches" : {}}
+        groups = {"Digest" : "Digests", "Record" : "Records", "Patch" : "Patches"}
+        for name in archive.files:
+            group, sep, field = name.partition("_")
+            if group in groups:
+                blockcache[groups[group]][field] = archive[name]
+        archive.close()
+    except (IOError, KeyError, ValueError):
+        return None
+    if any(len(d) != numblocks for d in blockcache["Digests"].values()):
+        return None
+    return blockcache
+
+
+def coarsenBlockSums(sums):
+    """One level up the aggregate pyramid: sums every 2x2 group of Blocks of a dictionary of
+    (..., blocks_y, blocks_x) arrays of class counts and value sums, i.e. Blocks of twice the
+    size. An odd last row or column of Blocks is padded with empty Blocks, just like the
+    raster is padded with NODATA to fill the coarser Block grid."""
+    coarse = {}
+    for name, grid in sums.items():
+        h, w = grid.shape[-2:]
+        padded = np.zeros(grid.shape[:-2] + (h + h%2, w + w%2), dtype = grid.dtype)
+        padded[..., :h, :w] = grid
+        coarse[name] = padded.reshape(grid.shape[:-2] + ((h+1)//2, 2, (w+1)//2, 2)).sum(axis = -1).sum(axis = -2)
+    return coarse
+
+
+def buildAggregatePyramid(sums):
+    """Returns the list of the levels of the aggregate pyramid, level 0 holds the Block sums
+    at the Block size they were aggregated at, level k those of Blocks 2**k times as large,
+    up to the level with a single Block."""
+    levels = [sums]
+    while max(levels[-1]["LUCount"].shape[-2:]) > 1:
+        levels.append(coarsenBlockSums(levels[-1]))
+    return levels
+
+
+def getPyramidLevel(pyramid, blocksize, cellsinblock, shape):
+    """Returns the Block sums of the pyramid level of the given Block size, or None if the
+    Block size is not a power of two multiple of the pyramid's base Block size or the
+    level's Block grid does not match shape (blocks_y, blocks_x)."""
+    basesize, basecells, levels = pyramid
+    if blocksize < basesize:
+        return None
+    k = int(round(math.log(float(blocksize) / basesize, 2)))
+    if k >= len(levels) or abs(basesize * 2**k - blocksize) > 1e-6 or basecells * 2**k != cellsinblock:
+        return None
+    if levels[k]["LUCount"].shape[-2:] != tuple(shape):
+        return None
+    return levels[k]
+
+
+def rasterFingerprint(raster, samples = FINGERPRINT_SAMPLES):
+    """Cheap identity of a raster: SHA-1 hash of its dimensions, cell size and the values of a
+    lattice of at most samples x samples cells spread evenly over the whole raster. Reading
+    the full raster is what the aggregate pyramid saves, the lattice costs a fixed number of
+    getValue calls whatever the raster size. Every lattice row is shifted by a different
+    offset, so that the samples do not all fall onto the same few columns."""
+    width = int(raster.getWidth())
+    height = int(raster.getHeight())
+    keyhash = hashlib.sha1()
+    keyhash.update(repr([width, height, float(raster.getCellSize())]))
+    if width == 0 or height == 0:
+        return keyhash.hexdigest()
+    xstep = max(width // samples, 1)
+    ystep = max(height // samples, 1)
+    for k, j in enumerate(range(0, height, ystep)):
+        shift = (k * 7919) % xstep          #7919 is prime, shifts cycle through the whole step
+        values = np.fromiter((raster.getValue(i, j) for i in range(shift, width, xstep)), dtype = np.float64)
+        keyhash.update(values.tostring())
+    return keyhash.hexdigest()
+
+
+def getPyramidKey(settings, fingerprints):
+    """Returns the key of an aggregate pyramid, a SHA-1 hash of the input settings the Block
+    sums depend on (resolution, extents, soil data types, inputs used, ...) and of the
+    rasterFingerprint() of every input raster. A pyramid built from rasters with other
+    dimensions or other values at the sampled cells has a different key and is rejected."""
+    keyhash = hashlib.sha1()
+    keyhash.update(str(PYRAMID_VERSION))
+    keyhash.update(repr([str(s) for s in settings]))
+    keyhash.update(repr(list(fingerprints)))
+    return keyhash.hexdigest()
+
+
+def savePyramid(filename, key, blocksize, cellsinblock, levels):
+    """Saves all levels of an aggregate pyramid together with its base Block size and the
+    number of cells per Block at that size to a compressed NumPy archive (.npz)."""
+    archive = {}
+    archive["Key"] = np.array(key)
+    archive["BlockSize"] = np.array(float(blocksize))
+    archive["CellsInBlock"] = np.array(int(cellsinblock))
+    archive["NumLevels"] = np.array(len(levels))
+    for k, sums in enumerate(levels):
+        for name in sums:
+            archive["L"+str(k)+"_"+name] = sums[name]
+    f = open(filename, 'wb')
+    np.savez_compressed(f, **archive)
+    f.close()
+    return True
+
+
+def loadPyramid(filename, key):
+    """Loads an aggregate pyramid saved with savePyramid. Returns None if the file is missing,
+    unreadable or was saved for a different key, otherwise (blocksize, cellsinblock, levels)."""
+    if not os.path.isfile(filename):
+        return None
+    try:
+        archive = np.load(filename)
+        if str(archive["Key"]) != key:
+            return None
+        levels = [{} for k in range(int(archive["NumLevels"]))]
+        for name in archive.files:
+            level, sep, field = name.partition("_")
+            if level.startswith("L") and level[1:].isdigit():
+                levels[int(level[1:])][field] = archive[name]
+        pyramid = (float(archive["BlockSize"]), int(archive["CellsInBlock"]), levels)
+        archive.close()
+    except (IOError, KeyError, ValueError, IndexError):
+        return None
+    return pyramid
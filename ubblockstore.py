@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+@file
+@author  Peter M Bach <peterbach@gmail.com>
+@version 1.0
+@section LICENSE
+
+This file is part of UrbanBEATS (www.urbanbeatsmodel.com)
+Copyright (C) 2011, 2012, 2013  Peter M Bach
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+import os
+import numpy as np
+try:
+    import fcntl
+except ImportError:         #Windows
+    fcntl = None
+    import msvcrt
+
+#Out-of-core Block attribute store: instead of keeping all Block attributes on the DynaMind faces,
+#every numeric attribute is one column (a memory-mapped file, float32 unless more precision is
+#needed) indexed by Block ID. Text attributes (UpstrIDs, ...) are kept in slots of a blob file per
+#attribute, with a memory-mapped (offset, length, capacity) index per Block, so they are neither held in
+#memory nor lost to other processes reopening the store. Delinblocks
+#creates the store if its block_store directory is set and publishes the directory as the map
+#attribute "BlockStore". The modules' getBlockUUID() then returns a BlockRecord of the store
+#instead of the face, so all attribute calls go through the store, and the values are only
+#copied onto the faces when the Blocks are exported.
+
+FLOAT64_ATTRIBUTES = ["CentreX", "CentreY", "OriginX", "OriginY"]       #need more than float32 precision
+_openstores = {}        #all modules of a simulation share one store object per directory
+_storelocks = {}        #lock files of the stores created by this process, held until it exits
+
+class BlockAttribute(object):
+    """Value of one attribute of a BlockRecord, offers the DynaMind Attribute calls"""
+    def __init__(self, value):
+        self.value = value
+    
+    def getDouble(self):
+        if isinstance(self.value, basestring):
+            return 0.0
+        return float(self.value)
+    
+    def getString(self):
+        if isinstance(self.value, basestring):
+            return self.value
+        return ""
+
+
+class BlockRecord(object):
+    """All attributes of one Block in the store, used by the modules in place of its face"""
+    def __init__(self, store, blockID):
+        self.store = store
+        self.blockID = int(blockID)
+    
+    def getAttribute(self, name):
+        return BlockAttribute(self.store.getValue(self.blockID, name))
+    
+    def addAttribute(self, name, value):
+        self.store.setValue(self.blockID, name, value)
+    
+    def changeAttribute(self, name, value):
+        self.store.setValue(self.blockID, name, value)
+
+
+def getSlotSize(length):
+    """Capacity of a new text slot for a value of length bytes, the next power of two of at
+    least 16 bytes, so values that grow over the cycles rarely have to move"""
+    if length == 0:
+        return 0
+    return 1 << max(4, (length-1).bit_length())
+
+
+class StringColumn(object):
+    """Text attribute of Blocks 1...numblocks: the values are stored in <name>.txt and
+    <name>.idx holds the (offset, length, capacity) of every Block's slot (0, 0, 0 = ""). A
+    changed value is overwritten in its slot if it fits, otherwise it moves to a new slot at
+    the end of the blob. flush() compacts the blob once more than half of it is unused."""
+    def __init__(self, directory, name, numblocks, create):
+        mode = "w+" if create else "r+"
+        self.index = np.memmap(os.path.join(directory, name+".idx"), dtype = np.int64, mode = mode, shape = (numblocks+1, 3))
+        self.blob = open(os.path.join(directory, name+".txt"), "w+b" if create else "r+b", 0)   #unbuffered, other processes see every value
+    
+    def get(self, blockID):
+        offset, length, capacity = self.index[blockID]
+        if length == 0:
+            return ""
+        self.blob.seek(offset)
+        return self.blob.read(length)
+    
+    def set(self, blockID, value):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        offset, length, capacity = self.index[blockID]
+        if len(value) > capacity:
+            capacity = getSlotSize(len(value))
+            self.blob.seek(0, 2)
+            offset = self.blob.tell()
+            self.blob.write(value + "\0" * (capacity - len(value)))
+        else:
+            self.blob.seek(offset)
+            self.blob.write(value)
+        self.index[blockID] = (offset, len(value), capacity)      #only points to the value once it is written
+    
+    def compact(self):
+        """Rewrites the blob with the slots of all Blocks back to back, dropping the slots
+        left behind by values that moved"""
+        self.blob.seek(0)
+        data = self.blob.read()
+        used = np.flatnonzero(self.index[:, 2] > 0)
+        offsets = np.zeros(len(self.index), dtype = np.int64)
+        offsets[used] = np.cumsum(self.index[used, 2]) - self.index[used, 2]
+        self.blob.seek(0)
+        self.blob.write("".join([data[self.index[i, 0]:self.index[i, 0]+self.index[i, 2]] for i in used]))
+        self.blob.truncate()
+        self.index[:, 0] = offsets
+    
+    def flush(self):
+        if os.fstat(self.blob.fileno()).st_size > 2 * self.index[:, 2].sum():
+            self.compact()
+        self.blob.flush()
+        self.index.flush()
+
+
+class BlockStore(object):
+    """Columnar store of the attributes of Blocks 1...numblocks, see the module comment.
+    Columns already in the directory are reopened, so the store outlives the module that
+    created it, a new store (clear = True) removes them first."""
+    def __init__(self, directory, numblocks, clear = False):
+        self.directory = directory
+        self.numblocks = int(numblocks)
+        self.columns = {}
+        self.strings = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for filename in os.listdir(directory):
+            name, ext = os.path.splitext(filename)
+            path = os.path.join(directory, filename)
+            if ext in [".f32", ".f64"]:
+                dtype = np.float32 if ext == ".f32" else np.float64
+                if clear or os.path.getsize(path) != (self.numblocks+1) * np.dtype(dtype).itemsize:
+                    os.remove(path)
+                else:
+                    self.columns[name] = np.memmap(path, dtype = dtype, mode = "r+", shape = (self.numblocks+1,))
+            elif ext == ".idx":
+                blobpath = os.path.join(directory, name+".txt")
+                if clear or not os.path.exists(blobpath) or os.path.getsize(path) != (self.numblocks+1) * 24:
+                    os.remove(path)
+                    if os.path.exists(blobpath):
+                        os.remove(blobpath)
+                else:
+                    self.strings[name] = StringColumn(directory, name, self.numblocks, False)
+    
+    def column(self, name):
+        """Returns the column of an attribute indexed by Block ID (position 0 is unused),
+        a new column is created filled with zeros, like a missing DynaMind attribute"""
+        if name not in self.columns:
+            dtype, ext = (np.float64, ".f64") if name in FLOAT64_ATTRIBUTES else (np.float32, ".f32")
+            path = os.path.join(self.directory, name+ext)
+            self.columns[name] = np.memmap(path, dtype = dtype, mode = "w+", shape = (self.numblocks+1,))
+        return self.columns[name]
+    
+    def getValue(self, blockID, name):
+        if name in self.columns:
+            return self.columns[name][blockID]
+        if name in self.strings:
+            return self.strings[name].get(blockID)
+        return 0.0
+    
+    def setValue(self, blockID, name, value):
+        if isinstance(value, basestring):
+            if name not in self.strings:
+                self.strings[name] = StringColumn(self.directory, name, self.numblocks, True)
+            self.strings[name].set(blockID, value)
+        else:
+            self.column(name)[blockID] = value
+    
+    def setColumn(self, name, values, mask = None):
+        """Writes the values of all Blocks at once (values indexed by [BlockID-1]), only
+        where mask is True if a mask is given"""
+        column = self.column(name)
+        if mask is None:
+            column[1:] = values
+        else:
+            column[1:][mask] = np.asarray(values)[mask]
+    
+    def record(self, blockID):
+        return BlockRecord(self, blockID)
+    
+    def writeToFace(self, face):
+        """Materialises the attributes of a Block onto its face (e.g. for export), the Block
+        is identified by the face's BlockID attribute"""
+        blockID = int(face.getAttribute("BlockID").getDouble())
+        for name in self.columns:
+            face.addAttribute(name, float(self.columns[name][blockID]))
+        for name in self.strings:
+            face.addAttribute(name, self.strings[name].get(blockID))
+    
+    def flush(self):
+        for column in self.columns.values():
+            column.flush()
+        for column in self.strings.values():
+            column.flush()
+
+
+def lockBlockStore(directory):
+    """Takes the lock of the store in the directory for the rest of this process, raises an
+    IOError if another process (e.g. a concurrent simulation) holds it."""
+    if directory in _storelocks:
+        return True
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    lockfile = open(os.path.join(directory, "store.lock"), "a+b")
+    try:
+        if fcntl is not None:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            lockfile.seek(0)
+            msvcrt.locking(lockfile.fileno(), msvcrt.LK_NBLCK, 1)
+    except IOError:
+        lockfile.close()
+        raise IOError("Block store "+directory+" is in use by another simulation, choose a different block_store directory")
+    _storelocks[directory] = lockfile
+    return True
+
+
+def createBlockStore(directory, numblocks):
+    """Creates a new, empty store in the directory and registers it for the other modules.
+    The directory is locked first, a store in use by another process is never cleared."""
+    lockBlockStore(directory)
+    _openstores[directory] = BlockStore(directory, numblocks, clear = True)
+    return _openstores[directory]
+
+
+def getBlockStore(map_attr):
+    """Returns the store published in the map attributes or None if the Block attributes
+    are kept on the faces. Modules of the same simulation get the same store object."""
+    directory = map_attr.getAttribute("BlockStore").getString()
+    if directory == "":
+        return None
+    if directory not in _openstores:
+        _openstores[directory] = BlockStore(directory, map_attr.getAttribute("NumBlocks").getDouble())
+    return _openstores[directory]
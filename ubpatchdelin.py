@@ -23,6 +23,63 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
+import multiprocessing
+import numpy as np
+import ubblockaggregate as ubagg
+
+_sharedcells = {}       #cell arrays of the current patch delineation, set once per worker process
+PACKEDPATCH_ARRAYS = ["PatchCount", "PatchValues", "OutlineCount", "Outlines"]    #see packPatches
+
+def delineateBlockPatches(landuse, elevation, soil, cellsinblock, workers = 1, blocks = None):
+    """Delineates the patches of every Block found in the cell arrays (indexed [y, x], the
+    whole map or a strip of Block rows). With more than one worker the Blocks are split into
+    bands of consecutive Block IDs that are delineated in a process pool. The cell arrays are
+    handed to each worker once when the pool starts (shared read-only where processes are
+    forked) and only the patch dictionaries travel back. Returns the list of patchdicts in
+    Block ID order, independent of the number of workers. If blocks is given (positions of
+    Blocks within the cell arrays, counted row by row), only these Blocks are delineated.
+    """
+    if blocks is None:
+        blocks = np.arange((landuse.shape[0]//cellsinblock) * (landuse.shape[1]//cellsinblock))
+    numblocks = len(blocks)
+    if workers <= 1 or numblocks < 2:
+        initPatchWorker(landuse, elevation, soil, cellsinblock, blocks)
+        patchdicts = delineatePatchBand((0, numblocks))
+        _sharedcells.clear()
+        return patchdicts
+    
+    bandlimits = np.linspace(0, numblocks, min(numblocks, workers*4) + 1).astype(int)
+    bands = zip(bandlimits[:-1], bandlimits[1:])
+    pool = multiprocessing.Pool(workers, initPatchWorker, (landuse, elevation, soil, cellsinblock, blocks))
+    try:
+        results = pool.map(delineatePatchBand, bands)
+    finally:
+        pool.close()
+        pool.join()
+    return [patchdict for band in results for patchdict in band]
+
+def initPatchWorker(landuse, elevation, soil, cellsinblock, blocks):
+    _sharedcells["LandUse"] = landuse
+    _sharedcells["Elevation"] = elevation
+    _sharedcells["Soil"] = soil
+    _sharedcells["CellsInBlock"] = cellsinblock
+    _sharedcells["Blocks"] = blocks
+
+def delineatePatchBand(band):
+    """Delineates the patches of the Blocks band[0]...band[1]-1 of the shared list of Blocks
+    (positions counted row by row within the shared cell arrays), returns their patchdicts
+    in order"""
+    cellsinblock = _sharedcells["CellsInBlock"]
+    widthblocks = _sharedcells["LandUse"].shape[1]//cellsinblock
+    patchdicts = []
+    for i in _sharedcells["Blocks"][band[0]:band[1]]:
+        y, x = divmod(int(i), widthblocks)
+        lucdatamatrix = ubagg.blockMatrix(_sharedcells["LandUse"], x, y, cellsinblock)
+        elevdatamatrix = ubagg.blockMatrix(_sharedcells["Elevation"], x, y, cellsinblock)
+        soildatamatrix = ubagg.blockMatrix(_sharedcells["Soil"], x, y, cellsinblock)
+        patchdicts.append(landscapePatchDelineation(lucdatamatrix, elevdatamatrix, soildatamatrix))
+    return patchdicts
+
 def landscapePatchDelineation(landuse, elevation, soil):
     #Performs patch analysis and returns a full dictionary of the patches found, their properties
     #and all points contained therein to allow them to be drawn.
@@ -30,252 +87,193 @@ def landscapePatchDelineation(landuse, elevation, soil):
     #   - landuse: a square matrix of the landscape's land use classification
     #   - elevation: a matrix of the landscape's elevation (georeferenced to the land use map)
     #   - soil: a matrix of the landscape's soil (georeferenced to the land use map)
-    #   - nhd: the neighbourhood to use in the cellular automata
+    #Patches are the 8-connected regions of identical land use, all of them are labelled in
+    #one pass (see labelPatches) and their properties are reduced with bincount.
     
     patchdict = {}      #Holds the collection of patches labelled according to their IDs
     
+    landuse = np.asarray(landuse, dtype = np.float64)
+    elevation = np.asarray(elevation, dtype = np.float64)
+    soil = np.asarray(soil, dtype = np.float64)
+    
     #Test Condition for delineation:
-    x = len(landuse)
-    y = x
-    richness = 0
-    landusetypes = []
-    landusecount = 0
-    for i in range(x):
-        for j in range(y):
-            if landuse[i][j] == -9999:
-                continue
-            landusecount += 1
-            if landuse[i][j] in landusetypes:
-                pass
-            else:
-                landusetypes.append(landuse[i][j])
-                richness += 1
+    validluc = landuse != -9999
+    landusetypes = np.unique(landuse[validluc])
+    richness = len(landusetypes)
     if richness == 0:
         return patchdict
     elif richness == 1:
         #average out the elevation and soil
-        elev_sum = 0
-        elev_n = 0
-        soil_sum = 0
-        soil_n = 0
-        for i in range(x):
-            for j in range(y):
-                if elevation[i][j] != -9999:
-                    elev_sum += elevation[i][j]
-                    elev_n += 1
-                if soil[i][j] != -9999:
-                    soil_sum += soil[i][j]
-                    soil_n += 1
-        if elev_n == 0:
-            patchelev = -9999
-        else:
-            patchelev = elev_sum/elev_n
-        
-        if soil_n == 0:
-            patchsoil = -9999
-        else:
-            patchsoil = soil_sum/soil_n
-        patchdict["PatchID1"] = [landusecount, landusetypes[0],patchelev, patchsoil, [[0,0],[1,0],[1,1],[0,1]]]
+        patchelev = getMeanOrNodata(elevation)
+        patchsoil = getMeanOrNodata(soil)
+        nx, ny = landuse.shape      #the patch is the whole Block
+        patchdict["PatchID1"] = [int(validluc.sum()), float(landusetypes[0]), patchelev, patchsoil, np.array([[0,0],[nx,0],[nx,ny],[0,ny]], dtype = np.int32)]
         return patchdict
     
     #else, do patch delineation, continue
-    patchIDcounter = 0
-    finished_sign = 0
+    labels, seeds = labelPatches(landuse)
+    numpatches = len(seeds)
     
-    #Generate Status Matrix
-    statusmatrix = createZerosMatrix(x, y)
+    patcharea = np.bincount(labels.ravel(), minlength = numpatches)
+    elev_mean = getPatchMeans(elevation, labels, numpatches).tolist()      #plain floats, cheap to pass between processes
+    soil_mean = getPatchMeans(soil, labels, numpatches).tolist()
     
-    landpatchfreq = [0,0,0,0,0,0,0,0,0,0,0,0,0]
-    
-    while finished_sign == 0:
-        point_found = 0
-        
-        #Step 1: Find the start position and note the coordinate
-        xpos, ypos = findNextStart(statusmatrix)        #returns positions in matrix if point found, otherwise -1
-        patchface = [[xpos, ypos], [xpos+1, ypos], [xpos+1, ypos+1], [xpos, ypos+1]]
-        
-        #Check whether finished going through status matrix
-        if xpos == -1:
-            finished_sign = 1
-            break
-        
-        #Step 2: Conduct Cellular Automata from irow, jcol
-        statusmatrix[xpos][ypos] = 1    #mark out this position on the status matrix
-        currentCALU = landuse[xpos][ypos]       #will need this later, so define this now.
-        
-        camatrix, patcharea = patchCellularAutomata(x,y,xpos, ypos, statusmatrix, landuse, currentCALU)   #Run the CA Algo
-        
-        #Update status matrix with new data from CAMatrix and process the patch data in CAMatrix
-        patchIDcounter += 1     #Increment by one because we definitely have a new patch
-        for iCA in range(len(statusmatrix[0])):
-            for jCA in range(len(statusmatrix[0])):
-                if statusmatrix[iCA][jCA] == 1:
-                    continue
-                else:
-                    statusmatrix[iCA][jCA] = camatrix[iCA][jCA]
-        
-        #Grab elevation and soil data
-        elevation_tally = 0             #reset the tally
-        elev_patch_counter = 0          #counts the number of cells
-        soil_tally = 0                      #reset tally
-        soil_patch_counter = 0          #counts the number of valid soil cells
-        
-        #---- CODE NOT USED DUE TO LARGE COMPUTATIONAL REQUIREMENTS IN URBANBEATS ---
-        #patchedges = []
-        #---- CODE NOT USED DUE TO LARGE COMPUTATIONAL REQUIREMENTS IN URBANBEATS ---
-        
-        for iCA in range(len(camatrix[0])):
-            for jCA in range(len(camatrix[0])):
-                if camatrix[iCA][jCA] == 0:
-                    continue
-                if elevation[iCA][jCA] != -9999:
-                    elevation_tally += elevation[iCA][jCA]
-                    elev_patch_counter += 1
-                if soil[iCA][jCA] != -9999:
-                    soil_tally += soil[iCA][jCA]
-                    soil_patch_counter += 1
-                
-                #---- CODE NOT USED DUE TO LARGE COMPUTATIONAL REQUIREMENTS IN URBANBEATS ---
-                #patchedges.append([[iCA, jCA],[iCA+1, jCA]])
-                #patchedges.append([[iCA, jCA],[iCA, jCA+1]])
-                #patchedges.append([[iCA+1, jCA], [iCA+1, jCA+1]])
-                #patchedges.append([[iCA, jCA+1], [iCA+1, jCA+1]])
-                #---- CODE NOT USED DUE TO LARGE COMPUTATIONAL REQUIREMENTS IN URBANBEATS ---
-                
-        #---- CODE NOT USED DUE TO LARGE COMPUTATIONAL REQUIREMENTS IN URBANBEATS ---
-        #The following code runs through the entire patch's edges and returns the points
-        #that make up the outer edges of the patch, allowing you to draw the rectilinear polygon
-        #outeredges = []
-        #while len(patchedges) > 0:
-        #    currentedge = patchedges[0]            
-        #    patchedges.remove(currentedge)
-        #    if currentedge in patchedges:
-        #        for j in range(len(patchedges)):
-        #            try:
-        #                patchedges.remove(currentedge)
-        #            except ValueError as e:
-        #                pass
-        #    else:
-        #        outeredges.append(currentedge)
-        #        print outeredges
-        # 
-        #outeredges.sort()
-        #sortededges = []
-        #sortededges.append(outeredges[0])
-        #outeredges.remove(sortededges[0])
-        #while len(outeredges) > 0:
-        #    currentedge = sortededges[len(sortededges)-1]   #max
-        #    for edge in outeredges:
-        #        print edge
-        #        print edge[0]                
-        #        if currentedge[1] in edge or currentedge[0] in edge:
-        #            sortededges.append(edge)
-        #            outeredges.remove(edge)
-        #
-        #finalpoints = []
-        #for i in range(len(sortededges)):
-        #    if i < len(sortededges)-1:            
-        #        nexti = i+1
-        #    else:
-        #        nexti = 0
-        #    if sortededges[i][0] not in sortededges[nexti]:
-        #        finalpoints.append(sortededges[i][0])
-        #    else:
-        #        finalpoints.append(sortededges[i][1])
-        #---- CODE NOT USED DUE TO LARGE COMPUTATIONAL REQUIREMENTS IN URBANBEATS ---
-        
-        if elev_patch_counter == 0:
-            patchelev = -9999        
-        else:
-            patchelev = elevation_tally/elev_patch_counter
-        if soil_patch_counter == 0:
-            patchsoil = -9999
-        else:
-            patchsoil = soil_tally/soil_patch_counter
-        
-        patchdict["PatchID"+str(patchIDcounter)] = [patcharea, currentCALU, patchelev, patchsoil, patchface]
-        #Next iteration
+    patchfaces = tracePatchOutlines(labels, seeds, numpatches)
     
-    #END OF WHILE LOOP
-    del camatrix
-    del statusmatrix
+    ncols = landuse.shape[1]
+    for p in range(numpatches):
+        xpos, ypos = divmod(int(seeds[p]), ncols)
+        patchface = patchfaces[p]
+        patchdict["PatchID"+str(p+1)] = [int(patcharea[p]), float(landuse[xpos, ypos]), elev_mean[p], soil_mean[p], patchface]
     return patchdict
 
-def createZerosMatrix(x, y):
-    zerosmatrix = []
-    for i in range(x):
-        zerosmatrix.append([])
-        for j in range(y):
-            zerosmatrix[i].append(0)
-    return zerosmatrix
+def packPatches(patchdicts):
+    """Packs a list of patchdicts into four flat arrays that can be saved to a NumPy archive:
+    the number of patches of each Block ("PatchCount"), area, land use, elevation and soil of
+    every patch ("PatchValues", one row per patch), the number of corners of every outline
+    ("OutlineCount") and all outline corners one after the other ("Outlines")."""
+    values, outlinecount, outlines = [], [], []
+    for patchdict in patchdicts:
+        for i in range(len(patchdict)):
+            patch = patchdict["PatchID"+str(i+1)]
+            values.append(patch[:4])
+            outlinecount.append(len(patch[4]))
+            outlines.append(np.asarray(patch[4], dtype = np.int32).reshape(-1, 2))
+    packed = {}
+    packed["PatchCount"] = np.array([len(patchdict) for patchdict in patchdicts], dtype = np.int32)
+    packed["PatchValues"] = np.array(values, dtype = np.float64).reshape(-1, 4)
+    packed["OutlineCount"] = np.array(outlinecount, dtype = np.int32)
+    packed["Outlines"] = np.concatenate(outlines) if outlines else np.zeros((0, 2), dtype = np.int32)
+    return packed
 
-def findNextStart(statusmatrix):
-    point_found = 0    
-    for iCA in range(len(statusmatrix[0])):
-        for jCA in range(len(statusmatrix[0])):
-            if point_found == 1:
-                break
-            if statusmatrix[iCA][jCA] == 0:
-                point_found = 1
-                irow = iCA
-                jcol = jCA
-                #print "Next starting point: ", iCA,",", jCA
-                return irow, jcol
-            else:
-                point_found = 0
-    if point_found == 0:
-        return -1, -1
+def concatenatePackedPatches(packedlist):
+    """Joins packed patches of consecutive strips of Blocks, see packPatches()"""
+    return dict((name, np.concatenate([p[name] for p in packedlist])) for name in PACKEDPATCH_ARRAYS)
 
-def patchCellularAutomata(x, y, xpos, ypos, statusmatrix, landuse, currentCALU):
-    #print "CurrentLUC:", currentCALU
-    camatrix = createZerosMatrix(x, y)     #Create the cellular automata matrix
-    camatrix[xpos][ypos] = 1               #mark the first cell in CAmatrix for CA algorithm
-    patch_area_previous = 0
-    patch_area_current = -9999  #Initialize
-    
-    while patch_area_current != patch_area_previous:
-        patch_area_previous = patch_area_current
-        camatrix_new = camatrix
-        for iCA in range(len(camatrix[0])):
-            for jCA in range(len(camatrix[0])):
-                #check if current cell's value is identical to currentCALU
-                if statusmatrix[iCA][jCA] == 1:         #If the cell's already been considered, skip
-                    continue
-                if landuse[iCA][jCA] != currentCALU:    #If the cell's land use is not the same as current, skip
-                    continue
-                
-                #Get Cell's Neighbourhood
-                if jCA == 0:
-                    dx = [0,1]                  #if we have first column then only forward
-                elif jCA == (len(camatrix[0])-1):
-                    dx = [-1,0]             #if we have last column then only backward
-                else:
-                    dx = [-1,0,1]           #otherwise allow both
+def unpackPatches(packed, bindex):
+    """Returns the patchdict of Block bindex+1 from packed patches, see packPatches()"""
+    if "PatchPtr" not in packed:        #pointers to the first patch of each Block and first corner of each patch
+        packed["PatchPtr"] = np.concatenate([[0], np.cumsum(packed["PatchCount"])])
+        packed["OutlinePtr"] = np.concatenate([[0], np.cumsum(packed["OutlineCount"])])
+    patchdict = {}
+    first = packed["PatchPtr"][bindex]
+    for i in range(packed["PatchCount"][bindex]):
+        area, luc, elev, soil = packed["PatchValues"][first+i].tolist()
+        outline = packed["Outlines"][packed["OutlinePtr"][first+i]:packed["OutlinePtr"][first+i+1]]
+        patchdict["PatchID"+str(i+1)] = [int(area), luc, elev, soil, outline]
+    return patchdict
 
-                if iCA == 0:
-                    dy = [0,1]                  #if we have top row, only move down
-                elif iCA == (len(camatrix[0])-1):
-                    dy = [-1,0]             #if we have bottom row, only move up
-                else:
-                    dy = [-1,0,1]           #otherwise allow both
+def labelPatches(landuse):
+    """Labels all 8-connected patches of identical land use in a matrix at once. Every cell
+    starts as its own set, sets of neighbouring cells with the same land use are merged by
+    hooking the larger root onto the smaller one and compressing all paths, repeated until
+    no neighbouring pair is split between sets. Each patch therefore ends up with the
+    smallest flat index of its cells as root, i.e. its first cell in row-major order.
+    Returns (labels, seeds): a matrix of patch numbers 0...n-1 in the order patches are met
+    scanning the matrix row by row, and the flat index of each patch's first cell.
+    """
+    nrows, ncols = landuse.shape
+    index = np.arange(nrows*ncols).reshape(nrows, ncols)
+    
+    #All pairs of neighbouring cells with the same land use (E, S, SE and SW cover all 8 neighbours)
+    cellA = []
+    cellB = []
+    for a, b in [(np.s_[:, :-1], np.s_[:, 1:]), (np.s_[:-1, :], np.s_[1:, :]),
+                 (np.s_[:-1, :-1], np.s_[1:, 1:]), (np.s_[:-1, 1:], np.s_[1:, :-1])]:
+        same = landuse[a] == landuse[b]
+        cellA.append(index[a][same])
+        cellB.append(index[b][same])
+    cellA = np.concatenate(cellA)
+    cellB = np.concatenate(cellB)
+    
+    parent = np.arange(nrows*ncols)
+    while True:
+        rootA = parent[cellA]
+        rootB = parent[cellB]
+        split = rootA != rootB
+        if not split.any():
+            break
+        np.minimum.at(parent, np.maximum(rootA[split], rootB[split]), np.minimum(rootA[split], rootB[split]))
+        while True:         #compress paths until every cell points directly at its root
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+    
+    seeds, labels = np.unique(parent, return_inverse = True)
+    return labels.reshape(nrows, ncols), seeds
 
-                #Transfer Function - obtain the total sum of neighbours
-                total_neighbour_sum = 0
-                for a in dy:
-                    for b in dx:
-                        total_neighbour_sum += camatrix[iCA+a][jCA+b]
-                
-                #Determine if the cell belongs to the patch or not
-                if total_neighbour_sum >= 1:
-                    camatrix_new[iCA][jCA] = 1
-                else:
-                    camatrix_new[iCA][jCA] = 0
-                
-        camatrix = camatrix_new         #Transfer old camatrix into new one
-        patch_area_current = 0          #Initialize the current patch area
-        for i in range(len(camatrix[0])):       #Calculate the current patch area
-            patch_area_current += sum(camatrix[i])
+def tracePatchOutlines(labels, seeds, numpatches):
+    """Traces the outer boundary of every labelled patch as a simplified rectilinear polygon
+    in time linear in the boundary length. All cell sides between different patches are
+    found at once and turned into directed edges with the patch on their left; each patch's
+    edges are then followed from the west side of its seed cell (always on the outer
+    boundary) until the ring closes. Where two cells of a patch only touch diagonally, the
+    walk turns right to stay with the patch. Holes are not traced, the patches inside them
+    are drawn on top. Returns one (n, 2) array of counter-clockwise corner points [x, y] per
+    patch in cell units (only corners where the direction changes), without the closing point.
+    """
+    nx, ny = labels.shape
+    pad = np.pad(labels, 1, mode = "constant", constant_values = -1)
+    core = pad[1:-1, 1:-1]
     
-    return camatrix, patch_area_current
+    #Directed edges of all patch boundaries, directions: 0 = +x, 1 = +y, 2 = -x, 3 = -y
+    edgelabel = []
+    edgestart = []
+    edgedir = []
+    for neighbour, start, direction in [(pad[1:-1, :-2], (0, 0), 0),     #south side
+                                        (pad[2:, 1:-1], (1, 0), 1),      #east side
+                                        (pad[1:-1, 2:], (1, 1), 2),      #north side
+                                        (pad[:-2, 1:-1], (0, 1), 3)]:    #west side
+        i, j = np.nonzero(core != neighbour)
+        edgelabel.append(core[i, j])
+        edgestart.append(np.column_stack([i + start[0], j + start[1]]))
+        edgedir.append(np.repeat(direction, len(i)))
+    edgelabel = np.concatenate(edgelabel)
+    edgestart = np.concatenate(edgestart)
+    edgedir = np.concatenate(edgedir)
     
+    order = np.argsort(edgelabel, kind = "mergesort")
+    edgeptr = np.concatenate([[0], np.cumsum(np.bincount(edgelabel, minlength = numpatches))])
+    step = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+    
+    outlines = []
+    for p in range(numpatches):
+        outgoing = {}       #vertex -> directions of the boundary edges leaving it
+        for e in order[edgeptr[p]:edgeptr[p+1]]:
+            outgoing.setdefault((int(edgestart[e, 0]), int(edgestart[e, 1])), []).append(int(edgedir[e]))
+        
+        xpos, ypos = divmod(int(seeds[p]), ny)
+        start = (xpos, ypos+1)      #top of the seed cell's west side, never a diagonal contact
+        vertex = start
+        direction = 3
+        ring = []
+        while True:
+            outgoing[vertex].remove(direction)
+            ring.append((vertex, direction))
+            vertex = (vertex[0] + step[direction][0], vertex[1] + step[direction][1])
+            if vertex == start:
+                break
+            options = outgoing[vertex]
+            if len(options) > 1 and (direction - 1) % 4 in options:
+                direction = (direction - 1) % 4     #diagonal contact, turn right
+            else:
+                direction = options[0]
+        
+        outlines.append(np.array([v for k, (v, d) in enumerate(ring) if d != ring[k-1][1]], dtype = np.int32))
+    return outlines
+
+def getPatchMeans(data, labels, numpatches):
+    """Mean of the valid (non -9999) cells of data within each patch, -9999 for patches
+    without any valid cell"""
+    valid = (data != -9999).ravel()
+    patchsum = np.bincount(labels.ravel()[valid], weights = data.ravel()[valid], minlength = numpatches)
+    patchcount = np.bincount(labels.ravel()[valid], minlength = numpatches)
+    return np.where(patchcount > 0, patchsum / np.maximum(patchcount, 1), -9999)
 
+def getMeanOrNodata(data):
+    """Mean of all valid (non -9999) cells of data, -9999 if there are none"""
+    valid = data != -9999
+    if not valid.any():
+        return -9999
+    return float(data[valid].sum()/valid.sum())
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+@file
+@author  Peter M Bach <peterbach@gmail.com>
+@version 1.0
+@section LICENSE
+
+This file is part of UrbanBEATS (www.urbanbeatsmodel.com)
+Copyright (C) 2011, 2012, 2013  Peter M Bach
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+import hashlib, random, struct
+import numpy as np
+
+#Per-Block random streams: the n-th draw of a stream is a hash of (seed, module, cycle, purpose,
+#Block ID, n), so no RNG state is carried from one Block to the next. A Block's draws do not depend
+#on which or how many other Blocks were planned before it, the results are the same in full and
+#partial runs, in the Block loop and the batch planning and a scenario change only alters the Blocks it touches.
+#Delinblocks sets the seed and the cycle of the simulation (map attributes RNGSeed and RNGCycle).
+#Single draws use the same hash in plain Python integers (hashUniformInt), numpy only pays off on arrays.
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX2 = np.uint64(0x94D049BB133111EB)
+
+def mix64(x):
+    """SplitMix64 finaliser on an array of uint64, a bijective hash of every element"""
+    x = (x ^ (x >> np.uint64(30))) * MIX1
+    x = (x ^ (x >> np.uint64(27))) * MIX2
+    return x ^ (x >> np.uint64(31))
+
+
+def mix64Int(x):
+    """mix64() on a single Python integer, masked to 64 bits"""
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+def getStreamKey(seed, module, cycle, purpose):
+    """Returns the 64-bit key of the streams of one purpose (e.g. "HouseOccup") of a module
+    in a cycle, the streams of the individual Blocks are derived from it by their Block ID."""
+    digest = hashlib.md5("%d|%s|%d|%s" % (int(seed), module, int(cycle), purpose)).digest()
+    return np.uint64(struct.unpack("<Q", digest[:8])[0])
+
+
+def hashUniform(key, unitIDs, draw):
+    """Returns the draw-th uniform variate [0, 1) of the streams of key for every ID of unitIDs
+    (array), the counter-based core of all streams."""
+    ids = np.asarray(unitIDs, dtype = np.uint64)
+    counter = np.array([int(draw)], dtype = np.uint64) * GOLDEN        #arrays wrap around silently, scalars warn
+    x = mix64(mix64(ids * GOLDEN + key) + counter)
+    return (x >> np.uint64(11)) * (1.0 / 9007199254740992.0)      #top 53 bits
+
+
+def hashUniformInt(key, unitID, draw):
+    """hashUniform() for a single ID in pure Python integer arithmetic, the same variate without
+    the overhead of numpy on scalars (Block loops and rejection sampling draw one at a time)"""
+    x = mix64Int((int(unitID) * 0x9E3779B97F4A7C15 + int(key)) & MASK64)
+    x = mix64Int((x + int(draw) * 0x9E3779B97F4A7C15) & MASK64)
+    return (x >> 11) * (1.0 / 9007199254740992.0)
+
+
+def boxMuller(u1, u2, mu, sigma):
+    """Normal variate(s) with mean mu and standard deviation sigma from two uniform variates"""
+    return mu + sigma * np.sqrt(-2.0 * np.log(1.0 - u1)) * np.cos(2.0 * np.pi * u2)
+
+
+class BlockStream(random.Random):
+    """A random.Random drawing from the counter-based stream of one Block (or any other unit with
+    a fixed ID, e.g. a basin's outlet Block) and purpose, for sequential sampling such as
+    rejection loops. All methods of random.Random (randint, uniform, ...) draw from random()."""
+    def __new__(cls, key, unitID):
+        return random.Random.__new__(cls)
+
+    def __init__(self, key, unitID):
+        self.key = int(key)
+        self.unitID = int(unitID)
+        self.draw = 0
+        random.Random.__init__(self, 0)
+
+    def seed(self, a = None):
+        self.draw = 0
+
+    def random(self):
+        u = hashUniformInt(self.key, self.unitID, self.draw)
+        self.draw += 1
+        return u
+
+    def normalvariate(self, mu, sigma):
+        """Box-Muller on the next two draws, the same variate as StreamManager.normalvariate()"""
+        u1 = self.random()
+        u2 = self.random()
+        return float(boxMuller(u1, u2, mu, sigma))
+
+    gauss = normalvariate
+
+
+class StreamManager:
+    """Hands out the random streams of one module in one cycle of the simulation. The array
+    methods draw the draw-th variate of every Block of unitIDs at once (scalar ID in, scalar
+    out), they match the first draws of the corresponding BlockStream, so a Block loop and a
+    batch over all Blocks sample exactly the same values."""
+    def __init__(self, seed, module, cycle):
+        self.seed = int(seed)
+        self.module = module
+        self.cycle = int(cycle)
+        self.keys = {}
+
+    def getKey(self, purpose):
+        if purpose not in self.keys:
+            self.keys[purpose] = getStreamKey(self.seed, self.module, self.cycle, purpose)
+        return self.keys[purpose]
+
+    def stream(self, unitID, purpose):
+        """Returns the BlockStream of unitID for purpose, starting at its first draw"""
+        return BlockStream(self.getKey(purpose), unitID)
+
+    def random(self, unitIDs, purpose, draw = 0):
+        if np.ndim(unitIDs) == 0:
+            return hashUniformInt(self.getKey(purpose), unitIDs, draw)
+        return hashUniform(self.getKey(purpose), unitIDs, draw)
+
+    def uniform(self, unitIDs, purpose, a, b, draw = 0):
+        """Uniform variates between a and b, as random.uniform()"""
+        return a + (b - a) * self.random(unitIDs, purpose, draw)
+
+    def randint(self, unitIDs, purpose, a, b, draw = 0):
+        """Integers a <= N <= b, as random.randint()"""
+        u = self.random(unitIDs, purpose, draw)
+        if np.ndim(unitIDs) == 0:
+            return int(a) + int(u * (int(b) - int(a) + 1))
+        return int(a) + (u * (int(b) - int(a) + 1)).astype(np.int64)
+
+    def normalvariate(self, unitIDs, purpose, mu, sigma, draw = 0):
+        """Normal variates from draws draw and draw+1, as BlockStream.normalvariate()"""
+        return boxMuller(self.random(unitIDs, purpose, draw), self.random(unitIDs, purpose, draw + 1), mu, sigma)
+
+
+def getStreamManager(map_attr, module):
+    """Returns the StreamManager of module for the seed and cycle set by Delinblocks"""
+    return StreamManager(map_attr.getAttribute("RNGSeed").getDouble(), module,
+                         map_attr.getAttribute("RNGCycle").getDouble())
@@ -0,0 +1,557 @@
+# -*- coding: utf-8 -*-
+"""
+@file
+@author  Peter M Bach <peterbach@gmail.com>
+@version 1.0
+@section LICENSE
+
+This file is part of UrbanBEATS (www.urbanbeatsmodel.com)
+Copyright (C) 2011, 2012, 2013  Peter M Bach
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+import hashlib
+import heapq
+import os
+import numpy as np
+
+#Order of the neighbours in all neighbourhood lists and tables of UrbanBEATS
+NHD_ORDER = ["N", "S", "W", "E", "NE", "NW", "SE", "SW"]
+NHD_DX = np.array([0, 0, -1, 1, 1, -1, 1, -1])      #column offset of each neighbour
+NHD_DY = np.array([1, -1, 0, 0, 1, 1, -1, -1])      #row offset of each neighbour (North = up = +1)
+
+def buildNeighbourTable(widthnew, heightnew):
+    """Creates the (numblocks x 8) table of neighbour Block IDs for the whole Block grid
+    with array arithmetic. Row i holds the neighbours of BlockID i+1 in the order
+    N, S, W, E, NE, NW, SE, SW, neighbours outside the grid are 0.
+        - widthnew: width of the simulation area [#Blocks]
+        - heightnew: height of the simulation area [#Blocks]
+    """
+    ygrid, xgrid = np.mgrid[0:heightnew, 0:widthnew]
+    xgrid = xgrid.ravel()[:, np.newaxis] + NHD_DX[np.newaxis, :]
+    ygrid = ygrid.ravel()[:, np.newaxis] + NHD_DY[np.newaxis, :]
+    inside = (xgrid >= 0) & (xgrid < widthnew) & (ygrid >= 0) & (ygrid < heightnew)
+    table = np.where(inside, ygrid * widthnew + xgrid + 1, 0)
+    return table.astype(np.int32)
+
+
+def createTerrainStore(status, elevation, hasriver, widthnew, heightnew, cs):
+    """Creates the terrain store, a dictionary of contiguous arrays indexed by [BlockID-1]
+    that holds everything the flow path and basin algorithms need. Keys are named after
+    the Block attributes they are written back to at the end of the terrain analysis.
+        - status: Status of each Block (1 = active, 0 = not part of simulation)
+        - elevation: average elevation of each Block [m]
+        - hasriver: 1 if the Block contains a river, 0 otherwise
+        - widthnew, heightnew: size of the Block grid [#Blocks]
+        - cs: Block size [m]
+    """
+    numblocks = widthnew * heightnew
+    ygrid, xgrid = np.mgrid[0:heightnew, 0:widthnew]
+    
+    terrain = {}
+    terrain["Shape"] = (heightnew, widthnew)        #Block grid dimensions, arrays reshape to [y, x] with this
+    terrain["Status"] = np.asarray(status, dtype = np.int32).copy()
+    terrain["AvgElev"] = np.asarray(elevation, dtype = np.float64).copy()
+    terrain["HasRiv"] = np.asarray(hasriver, dtype = np.int32).copy()
+    terrain["CentreX"] = (xgrid.ravel() + 0.5) * cs
+    terrain["CentreY"] = (ygrid.ravel() + 0.5) * cs
+    terrain["downID"] = np.zeros(numblocks, dtype = np.int32)        #ID block water flows to naturally
+    terrain["drainID"] = np.zeros(numblocks, dtype = np.int32)       #ID block drains to if a sink
+    terrain["BasinID"] = np.zeros(numblocks, dtype = np.int32)
+    terrain["Outlet"] = np.zeros(numblocks, dtype = np.int32)
+    terrain["maxdZ"] = np.zeros(numblocks, dtype = np.float64)
+    terrain["slope"] = np.zeros(numblocks, dtype = np.float64)
+    terrain["h_pond"] = np.zeros(numblocks, dtype = np.float64)
+    terrain["downProb"] = np.ones(numblocks, dtype = np.float64)     #probability of the chosen flow direction
+    terrain["altDownID"] = -np.ones(numblocks, dtype = np.int32)     #D-infinity: other neighbour of the steepest facet
+    terrain["altProb"] = np.zeros(numblocks, dtype = np.float64)     #probability of flowing to altDownID
+    terrain["outAgree"] = np.ones(numblocks, dtype = np.float64)     #share of realizations ending in the same Block
+    terrain["Network"] = []         #[BlockID, DownID, max_Zdrop, avg_slope, Type] of all flow paths to draw
+    return terrain
+
+
+def getKernelOffsets(nhd_type):
+    """Returns the (dy, dx) offsets of the smoothing kernel including the centre Block,
+    nhd_type 4 = von Neumann (cross-shaped kernel), 8 = Moore (full 3x3 kernel)"""
+    if nhd_type == 4:
+        count = 4
+    else:
+        count = 8
+    return [(0, 0)] + [(NHD_DY[k], NHD_DX[k]) for k in range(count)]
+
+
+def smoothElevation(elevation, status, shape, nhd_type, passes):
+    """Smooths the Block elevations by averaging each active Block with its active
+    neighbours. Each pass is one masked convolution over the whole Block grid, so all
+    passes are carried out on arrays without any intermediate writes to the Blocks.
+        - elevation: flat array of Block elevations indexed by [BlockID-1]
+        - status: flat array of Block status, inactive Blocks (0) are excluded
+        - shape: (heightnew, widthnew) of the Block grid
+        - nhd_type: 4 = von Neumann, 8 = Moore
+        - passes: number of smoothing passes
+    Returns the new flat elevation array, inactive Blocks keep their elevation.
+    """
+    heightnew, widthnew = shape
+    active = (np.asarray(status) != 0).reshape(shape)
+    weight = active.astype(np.float64)
+    z = np.asarray(elevation, dtype = np.float64).reshape(shape).copy()
+    offsets = getKernelOffsets(nhd_type)
+    
+    for currentpass in range(int(passes)):
+        zpad = np.pad(np.where(active, z, 0.0), 1, mode = "constant")
+        wpad = np.pad(weight, 1, mode = "constant")
+        zsum = np.zeros(shape)
+        wsum = np.zeros(shape)
+        for dy, dx in offsets:
+            zsum += zpad[1+dy:1+dy+heightnew, 1+dx:1+dx+widthnew]
+            wsum += wpad[1+dy:1+dy+heightnew, 1+dx:1+dx+widthnew]
+        z = np.where(active, zsum / np.maximum(wsum, 1), z)
+    return z.ravel()
+
+
+def getNeighbourhoodZGrid(elevation, status, shape):
+    """Returns an (8, heightnew, widthnew) array with the elevations of all eight
+    neighbours of every Block in the order N, S, W, E, NE, NW, SE, SW, taken as shifted
+    views of the padded elevation grid. Neighbours that are outside the map or inactive
+    get 99999, so that nothing can drain into them."""
+    heightnew, widthnew = shape
+    z = np.where(np.asarray(status).reshape(shape) != 0, np.asarray(elevation, dtype = np.float64).reshape(shape), 99999.0)
+    zpad = np.pad(z, 1, mode = "constant", constant_values = 99999.0)
+    neighboursZ = np.empty((8, heightnew, widthnew))
+    for k in range(8):
+        neighboursZ[k] = zpad[1+NHD_DY[k]:1+NHD_DY[k]+heightnew, 1+NHD_DX[k]:1+NHD_DX[k]+widthnew]
+    return neighboursZ
+
+
+def findDownstreamD8Grid(elevation, status, shape, nhd_type, cs):
+    """Solves the D8 flow direction for every Block of the grid at once. The direction
+    is the neighbour with the largest drop in elevation, Blocks whose largest drop is
+    not positive are sinks. Slope uses the Block size for cardinal neighbours and the
+    diagonal distance for NE, NW, SE and SW.
+        - elevation, status: flat arrays indexed by [BlockID-1]
+        - shape: (heightnew, widthnew) of the Block grid
+        - nhd_type: 4 = von Neumann (diagonals are ignored), 8 = Moore
+        - cs: Block size [m]
+    Returns flat arrays of direction (index into N, S, W, E, NE, NW, SE, SW or -9999 for
+    sinks), max_Zdrop, avg_slope and downstream ID (-1 for sinks).
+    """
+    neighboursZ = getNeighbourhoodZGrid(elevation, status, shape)
+    if nhd_type == 4:
+        neighboursZ[4:] = 999999
+    drops = np.asarray(elevation, dtype = np.float64).reshape(shape)[np.newaxis] - neighboursZ
+    
+    direction = np.argmax(drops, axis = 0).ravel()      #first largest drop, same tie-break as list.index
+    max_Zdrop = np.max(drops, axis = 0).ravel()
+    direction = np.where(max_Zdrop <= 0, -9999, direction)
+    avg_slope, downID = getFlowFromDirection(direction, max_Zdrop, shape, cs)
+    return direction, max_Zdrop, avg_slope, downID
+
+
+def getFlowFromDirection(direction, max_Zdrop, shape, cs):
+    """Converts flat arrays of flow directions (index into N, S, W, E, NE, NW, SE, SW or
+    -9999 for sinks) and drops into the average slope and downstream Block ID (-1 for
+    sinks). The diagonal distance is used for NE, NW, SE and SW."""
+    heightnew, widthnew = shape
+    sink = direction == -9999
+    safedir = np.where(sink, 0, direction)
+    ygrid, xgrid = np.mgrid[0:heightnew, 0:widthnew]
+    downID = (ygrid.ravel() + NHD_DY[safedir]) * widthnew + (xgrid.ravel() + NHD_DX[safedir]) + 1
+    dx = np.where(safedir <= 3, float(cs), np.sqrt(2*cs*cs))
+    avg_slope = np.where(sink, 0.0, max_Zdrop / dx)
+    downID = np.where(sink, -1, downID)
+    return avg_slope, downID
+
+
+#Triangular facets of the D-infinity method ordered counter-clockwise from East, each
+#spanned by a cardinal neighbour (e1) and a diagonal neighbour (e2), given as indices into
+#N, S, W, E, NE, NW, SE, SW
+DINF_E1 = [3, 0, 0, 2, 2, 1, 1, 3]      #E, N, N, W, W, S, S, E
+DINF_E2 = [4, 4, 5, 5, 7, 7, 6, 6]      #NE, NE, NW, NW, SW, SW, SE, SE
+
+def findDownstreamDinfGrid(elevation, status, shape, cs):
+    """D-infinity (Tarboton, 1997) for the whole Block grid at once. The slopes of all
+    eight triangular facets of every Block are calculated together, the steepest facet
+    gives the flow angle, which is split between the facet's cardinal and diagonal
+    neighbour. Returns a dictionary with:
+        - "FlowProb": (numblocks, 8) proportion of flow to each neighbour (N ... SW)
+        - "Cardinal", "Diagonal": direction indices of the two neighbours of the steepest facet
+        - "pDiagonal": proportion of flow to the diagonal neighbour
+        - "Sink": True where no facet slopes downwards
+        - "Drops": (8, numblocks) elevation drop to each neighbour
+    """
+    e0 = np.asarray(elevation, dtype = np.float64).reshape(shape)[np.newaxis]
+    neighboursZ = getNeighbourhoodZGrid(elevation, status, shape)
+    e1 = neighboursZ[DINF_E1]
+    e2 = neighboursZ[DINF_E2]
+    
+    d = float(cs)
+    s1 = (e0 - e1)/d
+    s2 = (e1 - e2)/d
+    r = np.arctan2(s2, s1)
+    s = np.sqrt(s1*s1 + s2*s2)
+    low = r < 0                             #flow angle outside of the facet, use the edge of the facet
+    s = np.where(low, s1, s)
+    r = np.where(low, 0.0, r)
+    high = r > np.pi/4
+    s = np.where(high, (e0 - e2)/np.sqrt(2*d*d), s)
+    r = np.where(high, np.pi/4, r)
+    
+    facet = np.argmax(s, axis = 0).ravel()
+    blocks = np.arange(facet.size)
+    smax = s.reshape(8, -1)[facet, blocks]
+    rmax = r.reshape(8, -1)[facet, blocks]
+    
+    dinf = {}
+    dinf["Sink"] = smax <= 0
+    dinf["Cardinal"] = np.array(DINF_E1)[facet]
+    dinf["Diagonal"] = np.array(DINF_E2)[facet]
+    dinf["pDiagonal"] = np.where(dinf["Sink"], 0.0, rmax/(np.pi/4))
+    flowprob = np.zeros((facet.size, 8))
+    flowprob[blocks, dinf["Cardinal"]] = 1 - dinf["pDiagonal"]
+    flowprob[blocks, dinf["Diagonal"]] += dinf["pDiagonal"]
+    flowprob[dinf["Sink"]] = 0.0
+    dinf["FlowProb"] = flowprob
+    dinf["Drops"] = (e0 - neighboursZ).reshape(8, -1)
+    return dinf
+
+
+def drawDinfRealizations(dinf, nrealizations, seed):
+    """Draws a batch of stochastic D-infinity flow directions, in every realization each
+    Block sends its flow to the diagonal neighbour of its steepest facet with probability
+    pDiagonal and to the cardinal neighbour otherwise. Realization n is drawn from its own
+    RNG stream seeded with (seed, n), so each one can be reproduced on its own.
+    Returns an (nrealizations, numblocks) array of directions, -9999 for sinks."""
+    numblocks = dinf["Sink"].size
+    directions = np.empty((int(nrealizations), numblocks), dtype = np.int64)
+    for n in range(int(nrealizations)):
+        stream = np.random.RandomState([int(seed) % 4294967296, n])
+        todiagonal = stream.random_sample(numblocks) < dinf["pDiagonal"]
+        directions[n] = np.where(todiagonal, dinf["Diagonal"], dinf["Cardinal"])
+    directions[:, dinf["Sink"]] = -9999
+    return directions
+
+
+def getDinfRealizationFlow(dinf, direction, shape, cs):
+    """Returns max_Zdrop, avg_slope, downstream ID and the probability of the chosen
+    direction for one D-infinity realization (flat array of directions)."""
+    blocks = np.arange(direction.size)
+    sink = direction == -9999
+    safedir = np.where(sink, 0, direction)
+    max_Zdrop = np.where(sink, dinf["Drops"].max(axis = 0), dinf["Drops"][safedir, blocks])
+    avg_slope, downID = getFlowFromDirection(direction, max_Zdrop, shape, cs)
+    probability = np.where(sink, 1.0, dinf["FlowProb"][blocks, safedir])
+    return max_Zdrop, avg_slope, downID, probability
+
+
+def getFlowEnds(downID, routed):
+    """Returns the index of the Block every Block finally drains into when following
+    downID, by pointer doubling over the whole grid. Blocks that are not routed or have
+    no downstream Block in the grid end in themselves."""
+    numblocks = downID.size
+    blocks = np.arange(numblocks)
+    valid = routed & (downID >= 1) & (downID <= numblocks)
+    ends = np.where(valid, downID - 1, blocks)
+    for k in range(int(np.ceil(np.log2(max(numblocks, 2)))) + 1):
+        ends = ends[ends]
+    return ends
+
+
+def getDinfSensitivity(dinf, directions, choice, routed, shape, cs):
+    """Sensitivity of the drainage to the D-infinity randomness. Returns for every Block
+    the ID of the other neighbour of its steepest facet and the probability of flowing
+    there (-1 and 0 if all flow goes to one neighbour), with downID and downProb of the
+    chosen realization these are the Block's non-zero flow proportions. outAgree is the
+    share of the realizations in which the Block drains into the same end Block as in
+    the chosen realization, i.e. how stable its basin is."""
+    chosen = directions[choice]
+    blocks = np.arange(chosen.size)
+    sink = chosen == -9999
+    altdir = np.where(chosen == dinf["Cardinal"], dinf["Diagonal"], dinf["Cardinal"])
+    altProb = np.where(sink, 0.0, dinf["FlowProb"][blocks, altdir])
+    altdir = np.where(altProb > 0, altdir, -9999)
+    altDownID = getFlowFromDirection(altdir, np.zeros(chosen.size), shape, cs)[1]
+    ends = np.array([getFlowEnds(getFlowFromDirection(d, np.zeros(d.size), shape, cs)[1], routed) for d in directions])
+    outAgree = (ends == ends[choice]).mean(axis = 0)
+    return altDownID, altProb, outAgree
+
+
+def chooseMostLikelyRealization(dinf, directions, mask):
+    """Returns the index of the realization with the highest joint probability over the
+    Blocks in mask, i.e. the most likely drainage network of the batch."""
+    blocks = np.arange(directions.shape[1])
+    safedirs = np.where(directions == -9999, 0, directions)
+    probability = np.where(directions == -9999, 1.0, dinf["FlowProb"][blocks[np.newaxis, :], safedirs])
+    loglikelihood = np.log(np.maximum(probability[:, mask], 1e-12)).sum(axis = 1)
+    return int(np.argmax(loglikelihood))
+
+
+FILL_EPSILON = 0.001        #minimum gradient [m] across filled depressions so that every Block keeps draining
+
+def priorityFloodFill(elevation, status, outlets, table, nhd_type, epsilon = FILL_EPSILON):
+    """Fills all depressions of the Block grid with the priority-flood algorithm (Barnes
+    et al. 2014, priority-flood + epsilon) in O(n log n). The flood starts from the
+    outlets and always grows from the lowest Block on its heap, raising every Block it
+    reaches to at least epsilon above the Block it was reached from. Every Block of the
+    filled surface therefore has a strictly lower neighbour on its way to an outlet.
+        - elevation, status: flat arrays indexed by [BlockID-1]
+        - outlets: boolean flat array, Blocks where water leaves the map (map edge,
+          next to inactive Blocks, rivers)
+        - table: neighbour table from buildNeighbourTable()
+        - nhd_type: 4 = von Neumann (only N, S, W, E are flooded), 8 = Moore
+        - epsilon: minimum rise of the filled surface per Block [m]
+    Returns the filled elevation, inactive Blocks keep their elevation.
+    """
+    elevation = np.asarray(elevation, dtype = np.float64)
+    active = np.asarray(status) != 0
+    filled = elevation.copy()
+    neighbours = table[:, :nhd_type] - 1
+    
+    visited = ~active
+    heap = []
+    for i in np.flatnonzero(active & outlets):
+        visited[i] = True
+        heap.append((filled[i], i))
+    heapq.heapify(heap)
+    
+    while heap:
+        z, i = heapq.heappop(heap)
+        for j in neighbours[i]:
+            if j < 0 or visited[j]:
+                continue
+            visited[j] = True
+            filled[j] = max(elevation[j], z + epsilon)
+            heapq.heappush(heap, (filled[j], j))
+    return filled
+
+
+def getFloodOutlets(status, hasriver, table, nhd_type):
+    """Returns the Blocks the priority-flood starts from: active Blocks on the map edge or
+    next to an inactive Block (within the neighbourhood) and all active river Blocks."""
+    active = np.asarray(status) != 0
+    neighbours = table[:, :nhd_type]
+    nhdactive = np.where(neighbours > 0, active[np.maximum(neighbours - 1, 0)], False)
+    return active & (~np.all(nhdactive, axis = 1) | (np.asarray(hasriver) == 1))
+
+
+def getDownstreamPointers(terrain):
+    """Builds the downstream pointer array of the Block grid: the Block ID that each
+    active Block drains to, i.e. downID, or drainID for unblocked sinks, 0 for outlets
+    and Blocks that drain out of the map, -1 for inactive Blocks."""
+    downID = terrain["downID"]
+    drainID = terrain["drainID"]
+    pointer = np.where(downID > 0, downID, np.where(drainID > 0, drainID, 0))
+    return np.where(terrain["Status"] != 0, pointer, -1).astype(np.int64)
+
+
+def delineateBasinGraph(pointer):
+    """Delineates basins, outlets and all upstream and downstream Blocks from the
+    downstream pointer array in linear time. The pointers form a forest whose roots are
+    the outlets; a topological order (upstream first) is derived once and every other
+    quantity follows from one pass along it. Returns a dictionary with:
+        - "BasinID", "Outlet": per Block, basins are numbered by ascending outlet Block ID
+        - "TotalBasins": number of basins found
+        - "UpstrIdx", "UpstrPtr", "UpstrCount": upstream Blocks of Block i are
+          UpstrIdx[UpstrPtr[i]:UpstrPtr[i]+UpstrCount[i]] (the subtree in preorder)
+        - "DownstrIdx", "DownstrPtr": CSR of the downstream Blocks, those of Block i are
+          DownstrIdx[DownstrPtr[i]:DownstrPtr[i+1]] ordered from near to far
+    All indices are Block IDs. Drainage loops (possible between unblocked sinks) are
+    broken at their lowest Block ID, which becomes an outlet.
+    """
+    numblocks = len(pointer)
+    active = pointer >= 0
+    parent = np.where(active & (pointer > 0), pointer - 1, -1)
+    parent[(parent >= 0) & ~active[np.maximum(parent, 0)]] = -1     #never drain into inactive Blocks
+    
+    #Topological order (Kahn's algorithm), headwater Blocks first
+    indegree = np.bincount(parent[parent >= 0], minlength = numblocks)
+    queue = list(np.flatnonzero(active & (indegree == 0)))
+    visited = np.zeros(numblocks, dtype = bool)
+    toporder = []
+    while True:
+        while queue:
+            v = queue.pop()
+            visited[v] = True
+            toporder.append(v)
+            p = parent[v]
+            if p >= 0:
+                indegree[p] -= 1
+                if indegree[p] == 0:
+                    queue.append(p)
+        remaining = np.flatnonzero(active & ~visited)
+        if len(remaining) == 0:
+            break
+        #Everything left sits on a drainage loop, break the loop at its lowest Block ID
+        v = remaining[0]
+        loop = []
+        while v not in loop:
+            loop.append(v)
+            v = parent[v]
+        cut = min(loop[loop.index(v):])
+        print "Drainage loop found, Block", cut+1, "becomes an outlet"
+        p = parent[cut]
+        parent[cut] = -1
+        indegree[p] -= 1
+        if indegree[p] == 0:
+            queue.append(p)
+    toporder = np.array(toporder, dtype = np.int64)
+    
+    #Basins and outlets, walking from the outlets upstream
+    outlets = np.flatnonzero(active & (parent == -1))
+    basinID = np.zeros(numblocks, dtype = np.int64)
+    basinID[outlets] = np.arange(1, len(outlets)+1)
+    for v in toporder[::-1]:
+        if parent[v] >= 0:
+            basinID[v] = basinID[parent[v]]
+    outlet = np.zeros(numblocks, dtype = np.int64)
+    outlet[outlets] = 1
+    
+    #Upstream Blocks: each Block's subtree is a contiguous range of the preorder
+    childcount = np.bincount(parent[parent >= 0], minlength = numblocks)
+    childptr = np.concatenate([[0], np.cumsum(childcount)])
+    haschild = np.flatnonzero(parent >= 0)
+    children = haschild[np.argsort(parent[haschild], kind = "mergesort")]
+    subtreesize = np.ones(numblocks, dtype = np.int64)
+    for v in toporder:
+        if parent[v] >= 0:
+            subtreesize[parent[v]] += subtreesize[v]
+    preorder = []
+    stack = list(outlets[::-1])
+    while stack:
+        v = stack.pop()
+        preorder.append(v)
+        stack.extend(children[childptr[v]:childptr[v+1]][::-1])
+    preorder = np.array(preorder, dtype = np.int64)
+    position = np.zeros(numblocks, dtype = np.int64)
+    position[preorder] = np.arange(len(preorder))
+    
+    #Downstream Blocks: the path to the outlet, each Block extends its parent's path
+    depth = np.zeros(numblocks, dtype = np.int64)
+    for v in toporder[::-1]:
+        if parent[v] >= 0:
+            depth[v] = depth[parent[v]] + 1
+    downptr = np.concatenate([[0], np.cumsum(depth)])
+    downidx = np.empty(downptr[-1], dtype = np.int64)
+    for v in toporder[::-1]:
+        p = parent[v]
+        if p >= 0:
+            downidx[downptr[v]] = p + 1
+            downidx[downptr[v]+1:downptr[v+1]] = downidx[downptr[p]:downptr[p+1]]
+    
+    basins = {}
+    basins["BasinID"] = basinID
+    basins["Outlet"] = outlet
+    basins["TotalBasins"] = len(outlets)
+    basins["UpstrIdx"] = preorder + 1
+    basins["UpstrPtr"] = np.where(active, position + 1, 0)
+    basins["UpstrCount"] = np.where(active, subtreesize - 1, 0)
+    basins["DownstrIdx"] = downidx
+    basins["DownstrPtr"] = downptr
+    return basins
+
+
+def getUpstreamIDs(basins, blockID):
+    """Returns the array of all Block IDs upstream of blockID"""
+    start = basins["UpstrPtr"][blockID-1]
+    return basins["UpstrIdx"][start:start+basins["UpstrCount"][blockID-1]]
+
+
+def getDownstreamIDs(basins, blockID):
+    """Returns the array of all Block IDs downstream of blockID, nearest first"""
+    return basins["DownstrIdx"][basins["DownstrPtr"][blockID-1]:basins["DownstrPtr"][blockID]]
+
+
+FLOWBASINS_VERSION = 2
+FLOWBASINS_ARRAYS = ["AvgElev", "downID", "drainID", "maxdZ", "slope", "h_pond", "downProb", "altDownID", "altProb",
+                     "outAgree", "BasinID", "Outlet"]
+DINF_ARRAYS = ["FlowProb", "DinfRealizations"]        #only saved with D-infinity
+BASINGRAPH_ARRAYS = ["UpstrIdx", "UpstrPtr", "UpstrCount", "DownstrIdx", "DownstrPtr"]
+
+def getFlowBasinsKey(elevationdigest, terrain, settings):
+    """Returns the key that identifies a terrain delineation, a SHA-1 hash of the raw
+    elevation raster, the Block status and river Blocks (these decide which Blocks are
+    routed) and all settings that change the result (Block size, neighbourhood, flow
+    method, smoothing, ...). A cached delineation is only reused if the keys match.
+        - elevationdigest: SHA-1 hex digest of the raw elevation raster rows
+        - terrain: the terrain store before any smoothing or delineation
+        - settings: list of all parameter values the delineation depends on
+    """
+    keyhash = hashlib.sha1()
+    keyhash.update(str(FLOWBASINS_VERSION))
+    keyhash.update(elevationdigest)
+    keyhash.update(np.ascontiguousarray(terrain["Status"], dtype = np.int32).tostring())
+    keyhash.update(np.ascontiguousarray(terrain["HasRiv"], dtype = np.int32).tostring())
+    keyhash.update(repr([str(s) for s in settings]))
+    return keyhash.hexdigest()
+
+
+def saveFlowBasins(filename, key, terrain):
+    """Saves the delineated flow paths and basins of the terrain store to a compressed
+    binary NumPy archive (.npz) together with its key. Upstream and downstream Blocks are
+    stored in their CSR form, the flow path network as one (n, 5) array. With D-infinity the
+    flow proportions of all Blocks and all realizations are saved as well."""
+    basins = terrain["Basins"]
+    archive = {}
+    archive["Key"] = np.array(key)
+    archive["Shape"] = np.array(terrain["Shape"], dtype = np.int64)
+    archive["TotalBasins"] = np.array(basins["TotalBasins"], dtype = np.int64)
+    for name in FLOWBASINS_ARRAYS:
+        archive[name] = terrain[name]
+    for name in BASINGRAPH_ARRAYS:
+        archive[name] = np.asarray(basins[name], dtype = np.int32)
+    if "FlowProb" in terrain:
+        archive["FlowProb"] = terrain["FlowProb"]
+        archive["DinfRealizations"] = np.asarray(terrain["DinfRealizations"], dtype = np.int16)
+    archive["Network"] = np.array(terrain["Network"], dtype = np.float64).reshape(-1, 5)
+    f = open(filename, 'wb')
+    np.savez_compressed(f, **archive)
+    f.close()
+    return True
+
+
+def loadFlowBasins(filename, key, terrain):
+    """Loads a delineation saved with saveFlowBasins into the terrain store. Returns False
+    and leaves the terrain store untouched if the file is missing, unreadable or was saved
+    for a different key, True if the delineation was loaded."""
+    if not os.path.isfile(filename):
+        return False
+    try:
+        archive = np.load(filename)
+        if str(archive["Key"]) != key or tuple(archive["Shape"]) != tuple(terrain["Shape"]):
+            return False
+        loaded = {}
+        for name in FLOWBASINS_ARRAYS:
+            loaded[name] = archive[name]
+        basins = {}
+        for name in BASINGRAPH_ARRAYS:
+            basins[name] = archive[name]
+        basins["BasinID"] = loaded["BasinID"]
+        basins["Outlet"] = loaded["Outlet"]
+        basins["TotalBasins"] = int(archive["TotalBasins"])
+        for name in DINF_ARRAYS:
+            if name in archive.files:
+                loaded[name] = archive[name]
+        network = archive["Network"]
+        archive.close()
+    except (IOError, KeyError, ValueError):
+        return False
+    
+    for name in FLOWBASINS_ARRAYS:
+        terrain[name] = np.asarray(loaded[name], dtype = terrain[name].dtype)
+    if "FlowProb" in loaded:
+        terrain["FlowProb"] = loaded["FlowProb"]
+        terrain["DinfRealizations"] = np.asarray(loaded["DinfRealizations"], dtype = np.int64)
+    terrain["Basins"] = basins
+    terrain["Network"] = [[int(p[0]), int(p[1]), float(p[2]), float(p[3]), int(p[4])] for p in network]
+    return True
@@ -176,6 +176,45 @@ def runRiverImport(segmentmax, *args):
     return riverpoints
     
 
+def runRiverLineImport(*args):
+    """Imports the river lines as they are, without segmentizing them into points: returns a
+    list of lines, each a list of its [x, y] vertices. Used to walk the rivers through the
+    Block grid (see ubblockaggregate.walkLinesThroughBlocks)."""
+    if len(args) == 2:    
+        filename = args[0]
+        currentdir = args[1]
+        os.chdir(currentdir)
+    else:
+        filename = args[0]
+        currentdir = ""
+    print "Importing River Lines"
+
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    
+    dataSource = driver.Open(filename, 0)
+    if dataSource is None:
+        print "Error, could not open file"
+        time.sleep(4)
+        sys.exit(1)
+    layer = dataSource.GetLayer()
+    totfeatures = layer.GetFeatureCount()
+    print totfeatures    
+    spatialRef = getSpatialRefDataSource(layer)
+    
+    riverlines = []
+    for i in range(totfeatures):
+        currentfeature = layer.GetFeature(i)
+        geometrydetail = currentfeature.GetGeometryRef()
+        if geometrydetail.GetGeometryType() == 2:
+            riverlines.append(getAllPointsInRiverFeature([], geometrydetail))
+        elif geometrydetail.GetGeometryType() == 5:
+            linestrings = disassembleMultiDataSource(geometrydetail)
+            for j in range(len(linestrings)):
+                riverlines.append(getAllPointsInRiverFeature([], linestrings[j]))
+    print "Import Success"
+    return riverlines
+
+
 def getAllPointsInRiverFeature(riverpoints, geometrydetail):
     point_count = geometrydetail.GetPointCount()
     for i in range(point_count):
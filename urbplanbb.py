@@ -26,8 +26,12 @@ from urbplanbbguic import *
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 from pydynamind import *
-import random, math
+import math
 import numpy as np
+import ubactiveblocks as ubactive
+import ubblockstore as ubstore
+import ubblockaggregate as ubagg
+import ubrandom as ubrand
 
 class Urbplanbb(Module):
     """Determines urban form of grid of blocks for model city by processing the
@@ -428,12 +432,23 @@ class Urbplanbb(Module):
         self.considerAG = True     #Even consider Agriculture areas in model?
         self.CBD_MAD_dist = 10.0        #km - approximate distance between main CBD and major activity districts
         
+        #Hidden Inputs
+        self.createParameter("batch_planning", BOOL, "")
+        self.batch_planning = True      #plan all Blocks at once in a few array passes (see planBlocksBatch)? False = Block by Block
+        self.createParameter("check_batch_planning", BOOL, "")
+        self.check_batch_planning = False       #also plan the Blocks Block by Block and stop if the batch planning differs? (slow, for testing)
+        
         #------------------------------------------
         #END OF INPUT PARAMETER LIST
 
         #VIEWS-------------------------------------
 	self.mapattributes = View("GlobalMapAttributes", COMPONENT,READ)
 	self.mapattributes.getAttribute("NumBlocks")
+	self.mapattributes.getAttribute("ActiveBlockIDs")
+	self.mapattributes.getAttribute("BlockStore")
+	self.mapattributes.getAttribute("NhdRadius")
+	self.mapattributes.getAttribute("RNGSeed")
+	self.mapattributes.getAttribute("RNGCycle")
 	self.mapattributes.getAttribute("BlockSize")
 	self.mapattributes.getAttribute("WidthBlocks")
 	self.mapattributes.getAttribute("HeightBlocks")
@@ -446,6 +461,7 @@ class Urbplanbb(Module):
         self.blocks = View("Block", FACE, WRITE)
         self.blocks.getAttribute("BlockID")
         self.blocks.modifyAttribute("Employ")
+        self.blocks.addAttribute("NhdTIF")          #Share of impervious area in the Block's neighbourhood
         self.blocks.addAttribute("MiscAtot")
         self.blocks.addAttribute("MiscAimp")
         self.blocks.addAttribute("UndType")
@@ -478,15 +494,19 @@ class Urbplanbb(Module):
         datastream.append(self.prevMapAttr)
         self.addData("City", datastream)
         self.BLOCKIDtoUUID = {}         #DYNAMIND
+        self.blockstore = None          #Block attribute store, if used (see ubblockstore)
+        self.rng = None                 #per-Block random streams (see ubrandom)
         self.prevBLOCKIDtoUUID = {}     #DYNAMIND
         
     def run(self):
-	#random.seed()   #Random seed has already been placed in delinblocks
+	#random.seed()   #Random streams are seeded by delinblocks (RNGSeed), see ubrandom
 	city = self.getData("City")             #DYNAMIND - obtain the City's datastream
         self.initBLOCKIDtoUUID(city)            #DYNAMIND - initialize the dictionary that tracks Block ID and UUID
         
         strvec = city.getUUIDsOfComponentsInView(self.mapattributes)    #DYNAMIND - get map attributes
         map_attr = city.getComponent(strvec[0]) #Get Map Attributes     #DYNAMIND - save attributes to a variable
+        self.blockstore = ubstore.getBlockStore(map_attr)      #None if the Block attributes are kept on the faces
+        self.rng = ubrand.getStreamManager(map_attr, "urbplanbb")  #all random draws come from per-Block streams
         strvec = city.getUUIDsOfComponentsInView(self.prevMapAttr)
         prev_map_attr = city.getComponent(strvec[0])
         
@@ -514,15 +534,30 @@ class Urbplanbb(Module):
         if int(prev_map_attr.getAttribute("Impl_cycle").getDouble()) == 0:    #Is this implementation cycle?
             self.initPrevBLOCKIDtoUUID(city)        #DYNAMIND - initialize the dictionary that tracks Previous Block IDs and UUID
         
+        #Only active Blocks are planned, inactive Blocks just receive no-data totals
+        activeIDs = ubactive.getActiveBlockIDs(map_attr, blocks_num)
+        for currentID in ubactive.getInactiveBlockIDs(activeIDs, blocks_num):
+            currentAttList = self.getBlockUUID(currentID, city)
+            currentAttList.addAttribute("Blk_TIA", -9999)
+            currentAttList.addAttribute("Blk_EIF", -9999)
+            currentAttList.addAttribute("Blk_TIF", -9999)
+            currentAttList.addAttribute("Blk_RoofsA", -9999)
+        
+        #The batch planning check plans every Block in both ways, the batch inputs are taken before the
+        #Block loop changes them (Employ)
+        checkbatch = self.batch_planning and self.check_batch_planning
+        if checkbatch:
+            checkinputs = self.gatherBlockInputs(city, np.asarray(activeIDs, dtype = np.int64), self.getBatchInputNames(map_attr))
+        
         #LOOP ACROSS BLOCKS
-        for i in range(int(blocks_num)):
+        planIDs = []        #Blocks left for the batch planning engine
+        for currentID in activeIDs:      #GRAB BLOCK INFORMATION
             #Reset tally variables
             blk_tia = 0         #Total Block Impervious Area
             blk_roof = 0        #Total Block Roof Area
             blk_eia = 0         #Total Block effective impervious area
             blk_avspace = 0     #Total available space for decentralised water infrastructure
             
-            currentID = i+1             #GRAB BLOCK INFORMATION
             currentAttList = self.getBlockUUID(currentID, city)         #DYNAMIND - assign block information to variable currentAttList
             
             print "Now Developing BlockID", currentID
@@ -543,6 +578,11 @@ class Urbplanbb(Module):
                     print "Changes in Block are below threshold levels, transferring data"
                     self.transferBlockAttributes(currentAttList, prevAttList)
                     continue        #If Block does not need to be developed, skip it
+            
+            if self.batch_planning:
+                planIDs.append(currentID)       #planned together with all other Blocks after the loop
+                if not checkbatch:
+                    continue
                 
             #Get Active Area
             activity = currentAttList.getAttribute("Active").getDouble()
@@ -672,13 +712,13 @@ class Urbplanbb(Module):
             blk_avspace += (Asvu_WS + Asvu_WW + Asvu_SW + Asvu_OTH)
             
             #-----------ROADS---------------------------------------------------
-            A_rd =+ rdextra                              #This part only plans out the Major Arterials & Hwys
+            A_rd += rdextra                              #This part only plans out the Major Arterials & Hwys
             #print "Total Road Area: ", A_rd
             
             #Draw stochastic values:
-            laneW = random.randint(hwy_wlane[0], hwy_wlane[1])
-            medW = random.randint(hwy_med[0], hwy_med[1])
-            buffW = random.randint(hwy_buf[0], hwy_buf[1])
+            laneW = self.rng.randint(currentID, "HwyLaneW", hwy_wlane[0], hwy_wlane[1])
+            medW = self.rng.randint(currentID, "HwyMedW", hwy_med[0], hwy_med[1])
+            buffW = self.rng.randint(currentID, "HwyBufW", hwy_buf[0], hwy_buf[1])
             
             if (A_park+A_ref) >= 0.5*A_rd:               #if total open space is greater than half the road area, use it as buffer
                 rd_imp = float((2*laneW)/(2*laneW + medW))
@@ -815,9 +855,9 @@ class Urbplanbb(Module):
             A_orc = currentAttList.getAttribute("pLU_ORC").getDouble() * Aactive 
             
             #Sample frontage information and create vector to store this
-            Wfp = random.randint(nres_fpw[0], nres_fpw[1])
-            Wns = random.randint(nres_nsw[0], nres_nsw[1])
-            Wrd = random.randint(lane_w[0], lane_w[1])
+            Wfp = self.rng.randint(currentID, "NresFpW", nres_fpw[0], nres_fpw[1])
+            Wns = self.rng.randint(currentID, "NresNsW", nres_nsw[0], nres_nsw[1])
+            Wrd = self.rng.randint(currentID, "NresLaneW", lane_w[0], lane_w[1])
             frontage = [Wfp, Wns, Wrd]
             
             #print "Total Non-res Area to be constructed with Planning Rules: ", A_li + A_hi + A_com + A_orc
@@ -857,9 +897,9 @@ class Urbplanbb(Module):
                     #Transfer attributes from indHI dictionary
                     currentAttList.addAttribute("HIjobs", indHI_dict["TotalBlockEmployed"])
                     currentAttList.addAttribute("HIestates", indHI_dict["Estates"])
-                    currentAttList.addAttribute("avSt_HI", indLI_dict["av_St"])
-                    currentAttList.addAttribute("HIAfront", indLI_dict["Afrontage"])
-                    currentAttList.addAttribute("HIAfrEIA", indLI_dict["FrontageEIA"])
+                    currentAttList.addAttribute("avSt_HI", indHI_dict["av_St"])
+                    currentAttList.addAttribute("HIAfront", indHI_dict["Afrontage"])
+                    currentAttList.addAttribute("HIAfrEIA", indHI_dict["FrontageEIA"])
                     currentAttList.addAttribute("HIAestate", indHI_dict["Aestate"])
                     currentAttList.addAttribute("HIAeBldg", indHI_dict["EstateBuildingArea"])
                     currentAttList.addAttribute("HIFloors", indHI_dict["Floors"])
@@ -946,6 +986,18 @@ class Urbplanbb(Module):
 
             #END OF BLOCK LOOP
         
+        if len(planIDs) > 0 and checkbatch:
+            index = np.searchsorted(activeIDs, planIDs)
+            blk = dict((name, values[index]) for name, values in checkinputs.items())
+            outputs = self.planBlocksBatch(city, map_attr, planIDs, Atblock, hwy_wlane, hwy_med, hwy_buf, nres_fpw, nres_nsw, lane_w, blk, False)
+            self.checkBatchOutputs(city, planIDs, outputs)
+        elif len(planIDs) > 0:
+            self.planBlocksBatch(city, map_attr, planIDs, Atblock, hwy_wlane, hwy_med, hwy_buf, nres_fpw, nres_nsw, lane_w)
+        
+        #Imperviousness in the neighbourhood of each Block (radius of Delinblocks' neighbourhood statistics)
+        if map_attr.getAttribute("NhdRadius").getDouble() > 0:
+            self.calcNeighbourhoodImperviousness(city, map_attr, activeIDs)
+        
         #Add new attributes to Map Attributes for use later
         map_attr.addAttribute("ParkProhibit", self.pg_restrict)                 #Prohibit use of park space for systems
         map_attr.addAttribute("RefLimit", self.ref_limit_stormwater)            #Limit Reserves and Floodways to SW Management
@@ -957,6 +1009,631 @@ class Urbplanbb(Module):
     ########################################################################
     ### URBPLANBB SUB-FUNCTIONS                                          ###
     ########################################################################
+    def calcNeighbourhoodImperviousness(self, city, map_attr, activeIDs):
+        """Calculates the share of impervious area within NhdRadius of every active Block
+        (NhdTIF) from summed-area tables of the Blocks' total impervious and active areas, the
+        same square windows as Delinblocks' neighbourhood land use and population statistics."""
+        numblocks = int(map_attr.getAttribute("NumBlocks").getDouble())
+        shape = (int(map_attr.getAttribute("HeightBlocks").getDouble()), int(map_attr.getAttribute("WidthBlocks").getDouble()))
+        block_size = map_attr.getAttribute("BlockSize").getDouble()
+        radius = int(round(map_attr.getAttribute("NhdRadius").getDouble() / block_size))
+        
+        blk_tia = np.zeros(numblocks)
+        blk_area = np.zeros(numblocks)
+        for currentID in activeIDs:
+            currentAttList = self.getBlockUUID(currentID, city)
+            blk_tia[currentID-1] = max(currentAttList.getAttribute("Blk_TIA").getDouble(), 0)
+            blk_area[currentID-1] = currentAttList.getAttribute("Active").getDouble() * block_size * block_size
+        
+        nhd_tia = ubagg.windowSum(ubagg.summedAreaTable(blk_tia.reshape(shape)), radius).ravel()
+        nhd_area = ubagg.windowSum(ubagg.summedAreaTable(blk_area.reshape(shape)), radius).ravel()
+        for currentID in activeIDs:
+            self.getBlockUUID(currentID, city).addAttribute("NhdTIF", nhd_tia[currentID-1] / max(nhd_area[currentID-1], 1))
+        return True
+    
+    ########################################################################
+    ### BATCH PLANNING ENGINE                                            ###
+    ########################################################################
+    #The same planning rules as the Block loop in run(), evaluated for all Blocks to plan at once:
+    #inputs are gathered into arrays, every design step is a masked array expression and the outputs
+    #are written back to the Blocks in one pass at the end. Random variates come from the same per-Block
+    #streams as in the Block loop (see ubrandom), so both plan every Block identically.
+    
+    def planBlocksBatch(self, city, map_attr, blockIDs, Atblock, hwy_wlane, hwy_med, hwy_buf, nres_fpw, nres_nsw, lane_w, blk = None, write = True):
+        """Plans all Blocks of blockIDs (active and to be redeveloped) in a
+        few array passes and writes the results to the Blocks, see the Block loop in run()
+        for the individual planning steps. Returns the outputs, blk optionally holds the input
+        arrays of the Blocks, with write = False nothing is written."""
+        blockIDs = np.asarray(blockIDs, dtype = np.int64)
+        n = len(blockIDs)
+        considerCBD = map_attr.getAttribute("considerCBD").getDouble()
+        if blk is None:
+            blk = self.gatherBlockInputs(city, blockIDs, self.getBatchInputNames(map_attr))
+        olderr = np.seterr(divide = "ignore", invalid = "ignore")
+        
+        outputs = {}
+        tally = {"TIA" : np.zeros(n), "EIA" : np.zeros(n), "Roof" : np.zeros(n), "AvSpace" : np.zeros(n), "Employed" : np.zeros(n)}
+        allblocks = np.ones(n, dtype = bool)
+        Aactive = blk["Active"] * Atblock
+        
+        #------------UNCLASSIFIED AREA--------------------------------------
+        A_unc = blk["pLU_NA"] * Aactive
+        A_park = blk["pLU_PG"] * Aactive
+        A_ref = blk["pLU_REF"] * Aactive
+        A_rd = blk["pLU_RD"] * Aactive
+        undevextra, pgextra, refextra, rdextra, otherarea, otherimp = self.planUnclassifiedBatch(A_unc, A_park, A_ref, A_rd, Atblock)
+        self.setBatchOutput(outputs, "MiscAtot", otherarea, allblocks)
+        self.setBatchOutput(outputs, "MiscAimp", otherimp, allblocks)
+        tally["TIA"] += otherimp
+        tally["EIA"] += otherimp
+        
+        #-----------UNDEVELOPED AREA----------------------------------------
+        A_und = blk["pLU_UND"] * Aactive + undevextra
+        undtype = self.determineUndevTypeBatch(blk, considerCBD)
+        self.setBatchOutput(outputs, "UndType", np.where(A_und != 0, undtype, "NA").astype(object), allblocks)
+        self.setBatchOutput(outputs, "UND_av", A_und*self.und_allowdev, allblocks)
+        tally["AvSpace"] += A_und*self.und_allowdev
+        
+        #-----------OPEN SPACES---------------------------------------------
+        A_park = A_park + pgextra
+        A_ref = A_ref + refextra
+        A_svu = blk["pLU_SVU"] * Aactive
+        self.planOpenSpacesBatch(outputs, tally, A_park, A_ref, A_svu)
+        
+        #-----------ROADS---------------------------------------------------
+        A_rd = A_rd + rdextra                           #only Major Arterials & Hwys
+        laneW = self.rng.randint(blockIDs, "HwyLaneW", hwy_wlane[0], hwy_wlane[1])
+        medW = self.rng.randint(blockIDs, "HwyMedW", hwy_med[0], hwy_med[1])
+        buffW = self.rng.randint(blockIDs, "HwyBufW", hwy_buf[0], hwy_buf[1])
+        park_buffer = (A_park + A_ref) >= 0.5*A_rd      #total open space is used as buffer if greater than half the road area
+        rd_imp = np.where(park_buffer, (2*laneW)/(2*laneW + medW), (2*laneW)/(2*laneW + medW + 2*buffW)).astype(np.float64)
+        av_spRD = np.where(park_buffer, medW/(2*laneW + medW), medW/(2*laneW + medW + buffW*2)).astype(np.float64) * A_rd
+        Aimp_rd = A_rd*rd_imp
+        self.setBatchOutput(outputs, "RoadTIA", Aimp_rd, allblocks)
+        self.setBatchOutput(outputs, "ParkBuffer", park_buffer.astype(np.float64), allblocks)
+        self.setBatchOutput(outputs, "RD_av", av_spRD, allblocks)
+        self.setBatchOutput(outputs, "RDMedW", medW, allblocks)
+        tally["TIA"] += Aimp_rd
+        tally["EIA"] += Aimp_rd * 0.9
+        tally["AvSpace"] += av_spRD
+        
+        #------------RESIDENTIAL AREA---------------------------------------
+        A_res = blk["pLU_RES"] * Aactive
+        minHouse = self.person_space * self.occup_avg * 4
+        hasres = (A_res >= minHouse) & (blk["Pop"] > self.occup_flat_avg)
+        self.setBatchOutput(outputs, "HasRes", hasres.astype(np.float64), allblocks)
+        self.setBatchOutput(outputs, "avSt_RES", A_res, ~hasres)      #becomes street-scape area available
+        tally["AvSpace"] += np.where(hasres, 0, A_res)
+        self.buildResidentialBatch(outputs, tally, blk, blockIDs, A_res, hasres, Atblock)
+        
+        #-----------NON-RESIDENTIAL (HOTSPOTS) -----------------------------
+        #Civic and transport areas become commercial and industrial area unless considered explicitly,
+        #explicit facilities are not planned yet (see identifyHotspots)
+        A_civ = blk["pLU_CIV"] * Aactive
+        A_tr = blk["pLU_TR"] * Aactive
+        extraCom = A_civ * float(self.mun_explicit == 0)
+        extraInd = A_tr * float(self.considerTRFacilities == 0)
+        
+        #-----------NON-RESIDENTIAL (PLANNING RULES) -----------------------
+        Aluc = {"LI" : blk["pLU_LI"] * Aactive + extraInd + A_svu,
+                "HI" : blk["pLU_HI"] * Aactive,
+                "COM" : blk["pLU_COM"] * Aactive + extraCom,
+                "ORC" : blk["pLU_ORC"] * Aactive}
+        frontage = [self.rng.randint(blockIDs, "NresFpW", nres_fpw[0], nres_fpw[1]),
+                    self.rng.randint(blockIDs, "NresNsW", nres_nsw[0], nres_nsw[1]),
+                    self.rng.randint(blockIDs, "NresLaneW", lane_w[0], lane_w[1])]
+        for type, hasname in [["LI", "Has_LI"], ["HI", "Has_HI"], ["COM", "Has_Com"], ["ORC", "Has_ORC"]]:
+            self.buildNonResAreaBatch(outputs, tally, blk, blockIDs, map_attr, Aluc[type], type, hasname, frontage)
+        
+        #TALLY UP TOTAL BLOCK DETAILS
+        self.setBatchOutput(outputs, "Employ", tally["Employed"], allblocks)
+        self.setBatchOutput(outputs, "Blk_TIA", tally["TIA"], allblocks)
+        self.setBatchOutput(outputs, "Blk_EIA", tally["EIA"], allblocks)
+        self.setBatchOutput(outputs, "Blk_EIF", tally["EIA"] / Aactive, allblocks)
+        self.setBatchOutput(outputs, "Blk_TIF", tally["TIA"] / Aactive, allblocks)
+        self.setBatchOutput(outputs, "Blk_RoofsA", tally["Roof"], allblocks)
+        np.seterr(**olderr)
+        
+        if write:
+            self.writeBatchOutputs(city, blockIDs, outputs)
+        return outputs
+    
+    def getBatchInputNames(self, map_attr):
+        """Returns the names of the Block attributes the batch planning reads"""
+        inputs = ["Active", "Pop", "Employ", "pLU_NA", "pLU_PG", "pLU_REF", "pLU_RD", "pLU_UND", "pLU_SVU", "pLU_RES",
+                  "pLU_CIV", "pLU_TR", "pLU_LI", "pLU_HI", "pLU_COM", "pLU_ORC"]
+        if map_attr.getAttribute("considerCBD").getDouble() and self.und_state != "M":
+            inputs.append("CBDdist")
+        return inputs
+    
+    def gatherBlockInputs(self, city, blockIDs, names):
+        """Returns a dictionary of arrays of the attributes names of all Blocks of blockIDs, read
+        as whole columns from the Block attribute store if one is used."""
+        if self.blockstore is not None:
+            return dict((name, np.asarray(self.blockstore.column(name)[blockIDs], dtype = np.float64)) for name in names)
+        blk = dict((name, np.zeros(len(blockIDs))) for name in names)
+        for i, currentID in enumerate(blockIDs):
+            currentAttList = self.getBlockUUID(currentID, city)
+            for name in names:
+                blk[name][i] = currentAttList.getAttribute(name).getDouble()
+        return blk
+    
+    def setBatchOutput(self, outputs, name, values, mask):
+        """Sets an output attribute for the Blocks where mask is True, outputs holds the
+        (values, mask) of every attribute, only Blocks within the mask are written."""
+        values = np.asarray(values)
+        if name in outputs:
+            oldvalues, oldmask = outputs[name]
+            values = np.where(mask, values, oldvalues)
+            mask = mask | oldmask
+        outputs[name] = (values, mask)
+    
+    def checkBatchOutputs(self, city, blockIDs, outputs):
+        """Compares the batch outputs with the attributes the Block loop wrote to the same Blocks
+        (check_batch_planning), raises a ValueError listing the first differences."""
+        mismatches = []
+        for i, currentID in enumerate(blockIDs):
+            currentAttList = self.getBlockUUID(currentID, city)
+            for name, (values, mask) in sorted(outputs.items()):
+                if not mask[i]:
+                    continue
+                if values.dtype == object:
+                    same = currentAttList.getAttribute(name).getString() == values[i]
+                else:
+                    loopvalue = currentAttList.getAttribute(name).getDouble()
+                    same = loopvalue == float(values[i]) or np.isclose(loopvalue, float(values[i]), rtol = 1e-9, atol = 1e-9)
+                if not same:
+                    mismatches.append("BlockID"+str(currentID)+" "+name)
+        if len(mismatches) > 0:
+            raise ValueError("Batch planning differs from the Block loop in "+str(len(mismatches))+" values: "+", ".join(mismatches[:20]))
+        print "Batch planning matches the Block loop on", len(blockIDs), "Blocks"
+        return True
+    
+    def writeBatchOutputs(self, city, blockIDs, outputs):
+        """Writes all batch outputs back to the Blocks, column by column into the Block attribute
+        store if one is used, otherwise in one pass over the Blocks."""
+        if self.blockstore is not None:
+            for name, (values, mask) in outputs.items():
+                if values.dtype == object:
+                    for i in np.flatnonzero(mask):
+                        self.blockstore.setValue(blockIDs[i], name, values[i])
+                else:
+                    self.blockstore.column(name)[blockIDs[mask]] = values[mask]
+            return True
+        for i, currentID in enumerate(blockIDs):
+            currentAttList = self.getBlockUUID(currentID, city)
+            for name, (values, mask) in outputs.items():
+                if not mask[i]:
+                    continue
+                value = values[i] if values.dtype == object else float(values[i])
+                if name == "Employ":
+                    currentAttList.changeAttribute(name, value)
+                else:
+                    currentAttList.addAttribute(name, value)
+        return True
+    
+    def planUnclassifiedBatch(self, A_unc, A_park, A_ref, A_rd, Atblock):
+        """planUnclassified for arrays of Blocks, returns the arrays undevextra, pgextra, refextra,
+        rdextra, otherarea and otherimp. Blocks whose merge weights are all zero are merged with
+        undeveloped land."""
+        custom = (A_unc != 0) & bool(self.unc_custom) & (A_unc >= (Atblock*self.unc_customthresh/100))
+        weights = [self.unc_pgmerge * self.unc_pgmerge_w * (A_park > 0),
+                   self.unc_refmerge * self.unc_refmerge_w * (A_ref > 0),
+                   self.unc_rdmerge * self.unc_rdmerge_w * (A_rd > 0)]
+        sumweights = weights[0] + weights[1] + weights[2]
+        merge = (A_unc != 0) & ~custom & bool(self.unc_merge) & ((A_park + A_ref + A_rd) > 0) & (sumweights > 0)
+        finaldiv = [np.where(merge, A_unc * w/np.where(sumweights > 0, sumweights, 1), 0) for w in weights]
+        undevextra = np.where(custom | merge, 0, A_unc)
+        otherarea = np.where(custom, A_unc, 0)
+        otherimp = np.where(custom, A_unc * self.unc_customimp/100, 0)
+        return undevextra, finaldiv[0], finaldiv[1], finaldiv[2], otherarea, otherimp
+    
+    def determineUndevTypeBatch(self, blk, considerCBD):
+        """determineUndevType for arrays of Blocks, returns an array of the type strings"""
+        n = len(blk["Active"])
+        if self.und_state == "M":
+            return np.array([self.und_type_manual] * n)
+        elif considerCBD == 0:
+            return np.array([self.undtypeDefault] * n)
+        distCBD = blk["CBDdist"]/1000   #convert to km
+        if self.cityarchetype == "MC":       #Monocentric City Case
+            BFdist = float(self.und_BFtoGF)/100 * float(self.citysprawl)
+            GFdist = float(self.und_BFtoAG)/100 * float(self.citysprawl)
+        else:       #Polycentric City Case
+            MAD_sprawl = self.citysprawl - self.CBD_MAD_dist
+            BFdist = self.CBD_MAD_dist + MAD_sprawl*self.und_BFtoGF/100
+            GFdist = self.CBD_MAD_dist + MAD_sprawl*self.und_BFtoAG/100
+        conditions = [distCBD <= BFdist,
+                      (distCBD <= GFdist) & bool(self.considerGF),
+                      (distCBD > GFdist) & bool(self.considerAG),
+                      (distCBD > GFdist) & bool(self.considerGF)]
+        return np.select(conditions, ["BF", "GF", "AG", "GF"], "BF")
+    
+    def planOpenSpacesBatch(self, outputs, tally, A_park, A_ref, A_svu):
+        """Parks & Gardens, Reserves & Floodways and Services & Utilities of arrays of Blocks"""
+        allblocks = np.ones(len(A_park), dtype = bool)
+        #---Parks & Gardens
+        parkratio = float((self.pg_greengrey_ratio + 10)/20)  #Ratio of green/grey spaces
+        sqratio = 1-parkratio
+        sqarea = A_park * sqratio
+        parkarea = A_park * parkratio
+        avail_space = parkarea * self.pg_unused_space/100
+        self.setBatchOutput(outputs, "OpenSpace", A_park + A_ref, allblocks)
+        self.setBatchOutput(outputs, "AGardens", parkarea, allblocks)
+        self.setBatchOutput(outputs, "ASquare", sqarea, allblocks)
+        self.setBatchOutput(outputs, "PG_av", avail_space, allblocks)
+        tally["TIA"] += sqarea
+        tally["EIA"] += sqarea
+        tally["AvSpace"] += avail_space
+        
+        #---Reserves & Floodways
+        avail_ref = A_ref * self.ref_usable_percent/100
+        self.setBatchOutput(outputs, "REF_av", avail_ref, allblocks)
+        tally["AvSpace"] += avail_ref
+        
+        #---Services & Utilities
+        Asvu_water = A_svu * self.svu_water/100
+        Asvu_others = A_svu - Asvu_water
+        svu_props = [self.svu4supply_prop*self.svu4supply, 
+                     self.svu4waste_prop*self.svu4waste, 
+                     self.svu4storm_prop*self.svu4storm]    #take into account check boxes
+        if sum(svu_props) > 100:
+            sumfactor = sum(svu_props)
+        else:
+            sumfactor = 100
+        for i in range(len(svu_props)):                     #"Normalize" proportions
+            svu_props[i] = svu_props[i]/sumfactor
+        Asvu_WS = Asvu_water*self.svu4supply*svu_props[0]
+        Asvu_WW = Asvu_water*self.svu4waste*svu_props[1]
+        Asvu_SW = Asvu_water*self.svu4storm*svu_props[2]
+        Asvu_OTH = Asvu_water - Asvu_WS - Asvu_WW - Asvu_SW
+        self.setBatchOutput(outputs, "ANonW_Utils", Asvu_others, allblocks)
+        self.setBatchOutput(outputs, "SVU_avWS", Asvu_WS, allblocks)
+        self.setBatchOutput(outputs, "SVU_avWW", Asvu_WW, allblocks)
+        self.setBatchOutput(outputs, "SVU_avSW", Asvu_SW, allblocks)
+        self.setBatchOutput(outputs, "SVU_avOTH", Asvu_OTH, allblocks)
+        tally["AvSpace"] += Asvu_WS + Asvu_WW + Asvu_SW + Asvu_OTH
+        return True
+    
+    def retrieveRatiosBatch(self, far):
+        """retrieveRatios for an array of FARs, returns the [LUI, FAR, OSR, LSR, RSR, OCR, TCR]
+        rows as a (7, n) array. The next higher FAR of the table is taken, FARs beyond the table
+        return LUI = -9999 with the FAR unchanged and all other ratios 0."""
+        tablefar = np.array(self.resLUIdict["FAR"])
+        index = np.searchsorted(tablefar, far, side = "right")
+        found = index < len(tablefar)
+        index = np.where(found, index, 0)
+        ratios = np.zeros((7, len(far)))
+        for i, key in enumerate(["LUI", "FAR", "OSR", "LSR", "RSR", "OCR", "TCR"]):
+            ratios[i] = np.where(found, np.array(self.resLUIdict[key])[index], 0)
+        ratios[0] = np.where(found, ratios[0], -9999)
+        ratios[1] = np.where(found, ratios[1], far)
+        return ratios
+    
+    def retrieveResTypeBatch(self, lui):
+        """retrieveResType for an array of LUIs, returns the arrays of the first and second type"""
+        conditions = [lui == -9999,
+                      lui < self.aptLUIthresh[0],
+                      (lui > self.aptLUIthresh[0]) & (lui < self.houseLUIthresh[1]),
+                      (lui < self.aptLUIthresh[1]) & (lui > self.houseLUIthresh[1]),
+                      (lui > self.highLUIthresh[0]) & (lui < self.aptLUIthresh[1])]
+        type1 = np.select(conditions, ["HighRise", "House", "House", "Apartment", "Apartment"], "HighRise")
+        type2 = np.select(conditions, ["0", "0", "Apartment", "0", "HighRise"], "0")
+        return type1, type2
+    
+    def buildResidentialBatch(self, outputs, tally, blk, blockIDs, A_res, hasres, Atblock):
+        """buildResidential for arrays of Blocks: determines the typology of all Blocks with
+        residential area (hasres) and designs houses or apartments for them."""
+        pop = blk["Pop"]
+        Afloor = self.person_space * pop
+        ratios = self.retrieveRatiosBatch(Afloor / A_res)
+        type1, type2 = self.retrieveResTypeBatch(ratios[0])
+        highrise = type1 == "HighRise"
+        if highrise.any():
+            hdr_person_space = float(self.flat_area_max)/float(self.occup_flat_avg)
+            Afloor = np.where(highrise, hdr_person_space * pop, Afloor)
+            ratios = np.where(highrise, self.retrieveRatiosBatch(Afloor / A_res), ratios)
+            hrtype1, hrtype2 = self.retrieveResTypeBatch(ratios[0])
+            type1 = np.where(highrise, hrtype1, type1)
+            type2 = np.where(highrise, hrtype2, type2)
+        houses = hasres & ((type1 == "House") | (type2 == "House"))
+        self.designResidentialHousesBatch(outputs, tally, blockIDs, A_res, pop, houses)
+        self.designResidentialApartmentsBatch(outputs, tally, blk, blockIDs, A_res, pop, ratios, Afloor, hasres & ~houses, Atblock)
+        return True
+    
+    def designResidentialHousesBatch(self, outputs, tally, blockIDs, A_res, pop, houses):
+        """designResidentialHouses for the Blocks where houses is True"""
+        n = len(A_res)
+        #Sample parameters from specified ranges, occupancy is redrawn until within its absolute limits
+        occup = np.zeros(n)
+        redraw = houses.copy()
+        draw = 0
+        while redraw.any():
+            occup[redraw] = self.rng.normalvariate(blockIDs[redraw], "HouseOccup", self.occup_avg, self.occup_avg/10, draw)
+            redraw = houses & ((occup < self.occup_flat_avg) | (occup > self.occup_max) | (occup == 0))
+            draw += 2
+        res_fpw = self.adjustSampleRange(self.res_fpwmin, self.res_fpwmax, self.res_fpmed)
+        res_nsw = self.adjustSampleRange(self.res_nswmin, self.res_nswmax, self.res_nsmed)
+        lane_w = self.adjustSampleRange(self.lane_wmin, self.lane_wmax, self.lane_wmed)
+        Wfp = self.rng.randint(blockIDs, "ResFpW", res_fpw[0], res_fpw[1])
+        Wns = self.rng.randint(blockIDs, "ResNsW", res_nsw[0], res_nsw[1])
+        Wrd = self.rng.randint(blockIDs, "ResLaneW", lane_w[0], lane_w[1])
+        Wfrontage = Wfp + Wns + Wrd
+        if self.setback_f_med == 0:
+            fsetback = np.round(self.rng.uniform(blockIDs, "SetbackF", self.setback_f_min, self.setback_f_max), 1)
+        else:
+            fsetback = (self.setback_f_min + self.setback_f_max)/2
+        if self.setback_s_med == 0:
+            ssetback = np.round(self.rng.uniform(blockIDs, "SetbackS", self.setback_s_min, self.setback_s_max), 1)
+        else:
+            ssetback = (self.setback_s_min + self.setback_s_max)/2
+        roofconnect = np.array([self.roof_connected] * n)
+        if self.roof_connected == "Vary":
+            roofconnect = np.array(["Direct", "Disconnect"])[self.rng.randint(blockIDs, "RoofConnect", 0, 1)]
+        occup = np.where(houses, occup, 1)
+        
+        #Step 2: Subdivide Area
+        Ndwunits = np.trunc(((pop/occup)/2)+1)*2                #make it an even number
+        district_L = A_res/100                                  #default typology depth = 100m
+        parcels = np.maximum(np.trunc(district_L / 200), 1.0)  #default typology width = 200m
+        Afrontage = (district_L * Wfrontage * 2) + ((parcels*2)*Wfrontage*(100 - 2*Wfrontage))
+        Dlot = (100 - 2*Wfrontage)/2                            #Depth of one allotment
+        Aca = A_res - Afrontage
+        AfrontagePerv = Afrontage * (Wns / Wfrontage)
+        
+        #Step 2b: Smallest number of dwellings per allotment that keeps allotments at least min_allot_width wide
+        DWperLot = np.ones(n, dtype = np.int64)
+        Wlot = np.zeros(n)
+        redo = houses & (Aca > 0) & (Dlot > 0)
+        while redo.any():
+            Wlot[redo] = (Aca / (Ndwunits/DWperLot) / Dlot)[redo]
+            redo = redo & (Wlot < self.min_allot_width)
+            DWperLot[redo] += 1
+        Nallotments = Ndwunits/DWperLot
+        Alot = Aca / Nallotments
+        Wlot = Alot / Dlot
+        
+        #Step 3: Subdivide ONE Lot
+        res_parking_area = self.carports_max * 2.6*4.9              #ADDITIONAL COVERAGE ON SITE
+        if self.garage_incl:
+            Agarage = res_parking_area
+            Aparking = res_parking_area* 0.5
+        else:
+            Agarage = 0
+            Aparking = res_parking_area
+        if self.patio_covered:
+            Acover = self.patio_area_max
+            Apatio = 0
+        else:
+            Acover = 0
+            Apatio = self.patio_area_max
+        
+        Alotfloor = DWperLot*(occup*self.person_space*(1+self.extra_comm_area/100) + Agarage + Acover)
+        lotratios = self.retrieveRatiosBatch(Alotfloor / Alot)
+        Als = lotratios[3]*Alot
+        Ars = lotratios[4]*Alot
+        Apave = fsetback * self.w_driveway_min + Apatio + Aparking  #DRIVEWAY + PATIO + PARKING
+        
+        #Determine if need more floors, then retry with less garden, less carpark paving and a shorter driveway
+        floors = self.calcLotFloors(Alotfloor, Apave + Als, Alot, houses)
+        retry = houses & (floors > self.floor_num_max)
+        Als = np.where(retry, Ars, Als)
+        floors = np.where(retry, self.calcLotFloors(Alotfloor, Apave + Als, Alot, retry), floors)
+        retry = houses & (floors > self.floor_num_max)
+        if Agarage == 0:
+            Apave = np.where(retry, Apave - Aparking/2, Apave)     #no garage, half of the parking stays
+        else:
+            Apave = np.where(retry, Apave - Aparking, Apave)
+        floors = np.where(retry, self.calcLotFloors(Alotfloor, Apave + Als, Alot, retry), floors)
+        retry = houses & (floors > self.floor_num_max)
+        Apave = np.where(retry, Apave - (fsetback - ssetback)*self.w_driveway_min, Apave)
+        floors = np.where(retry, self.calcLotFloors(Alotfloor, Apave + Als, Alot, retry), floors)
+        
+        Aba = Alotfloor/floors
+        Dbuilding = Aba / (Wlot - 2*ssetback)
+        Apa = ssetback * Dbuilding * 2
+        av_LOT = Alot - Ars - Aba - Apave - Apa   #WSUD SPACE = Lot area - Building - Recreation - Paving - Planning Req.
+        
+        AroofEff = np.where(roofconnect == "Direct", Aba, 0)
+        AimpLot = Aba + Apave
+        AConnectedImp = (AroofEff + Apave) * (1.0 - float(self.imperv_prop_dced/100))
+        Agarden = av_LOT + Ars + Apa
+        
+        for name, values in [["HasHouses", np.ones(n)], ["HouseOccup", occup], ["ResParcels", parcels], ["ResFrontT", Afrontage],
+                             ["avSt_RES", AfrontagePerv], ["WResNstrip", Wns], ["ResAllots", Nallotments], ["ResDWpLot", DWperLot],
+                             ["ResHouses", Ndwunits], ["ResLotArea", Alot], ["ResRoof", Aba], ["avLt_RES", av_LOT],
+                             ["ResHFloors", floors], ["ResLotTIA", AimpLot], ["ResLotEIA", AConnectedImp], ["ResGarden", Agarden],
+                             ["ResRoofCon", roofconnect.astype(object)]]:
+            self.setBatchOutput(outputs, name, values, houses)
+        
+        frontageTIF = 1 - (AfrontagePerv / Afrontage)
+        tally["TIA"] += np.where(houses, (AimpLot * Nallotments) + frontageTIF * Afrontage, 0)
+        tally["EIA"] += np.where(houses, (AConnectedImp * Nallotments) + 0.9 * frontageTIF * Afrontage, 0)
+        tally["Roof"] += np.where(houses, Aba * Nallotments, 0)
+        tally["AvSpace"] += np.where(houses, (av_LOT * Nallotments) + AfrontagePerv, 0)
+        return True
+    
+    def calcLotFloors(self, Alotfloor, Aother, Alot, mask):
+        """Smallest number of floors for which the building footprint Alotfloor/floors and the
+        other lot uses Aother fit onto the lot, for the Blocks where mask is True. Lots on which
+        even an infinitely tall building does not fit get floor_num_max + 1 floors."""
+        floors = np.ones(len(Alot), dtype = np.int64)
+        fits = mask & (Aother < Alot)
+        floors[mask & ~fits] = int(self.floor_num_max) + 1
+        redo = fits & ((Alotfloor + Aother) > Alot)
+        while redo.any():
+            floors[redo] += 1
+            redo = redo & ((Alotfloor/floors + Aother) > Alot)
+        return floors
+    
+    def designResidentialApartmentsBatch(self, outputs, tally, blk, blockIDs, A_res, pop, ratios, Afloor, apartments, Atblock):
+        """designResidentialApartments for the Blocks where apartments is True. The layout uses
+        the open space ratio (OSR) unless that exceeds floor_num_HDRmax but the liveability space
+        ratio (LSR) does not, with neither the OSR layout is used regardless of the floors."""
+        n = len(A_res)
+        #Step 2: Subdivide Area
+        Apa = np.sqrt(A_res)*2*self.setback_HDR_avg + (np.sqrt(A_res)-self.setback_HDR_avg)*2*self.setback_HDR_avg
+        A_res_adj = A_res - Apa     #minus Planning Area Apa
+        Aos = ratios[2]*A_res_adj   #min required open space area (outdoor + 1/2 indoor) (within A_res_adj)
+        Als = ratios[3]*A_res_adj   #min required liveability space area (within Aos)
+        Ars = ratios[4]*A_res_adj   #min required recreation space area (within Als)
+        
+        #Step3: Work out N units and car parking + indoor/outdoor spaces
+        Naptunits = np.trunc(pop/self.occup_flat_avg+1)
+        cpMin = ratios[5]*Naptunits*2.6*4.9
+        cpMax = ratios[6]*Naptunits*2.6*4.9
+        AextraIndoor = float(self.commspace_indoor)/100 * Afloor
+        AextraOutdoor = float(self.commspace_outdoor)/100 * Afloor
+        scaledown = AextraOutdoor < Aos         #user-defined outdoor space requirements are less than the minimum suggested
+        Aos = np.where(scaledown, AextraOutdoor, Aos)
+        Als = np.where(scaledown, AextraOutdoor * (Als/Aos), Als)
+        Ars = np.where(scaledown, AextraOutdoor * (Ars/Aos), Ars)
+        Apg = blk["pLU_PG"] * blk["Active"] * Atblock * float(int(self.park_OSR))
+        
+        #Step 4: Work out Building Footprint using OSR, or LSR if only that keeps within the floor limit
+        Aoutdoor = np.maximum(Aos - 0.5*AextraIndoor - Apg, 0)
+        Nfloors = np.trunc(((Afloor + AextraIndoor)/(A_res_adj - Aoutdoor))+1)
+        AoutdoorLSR = np.maximum(Als - Apg, 0)
+        NfloorsLSR = np.trunc(((Afloor + AextraIndoor)/(A_res_adj - AoutdoorLSR))+1)
+        useLSR = (Nfloors >= self.floor_num_HDRmax) & (NfloorsLSR < self.floor_num_HDRmax)
+        Aoutdoor = np.where(useLSR, AoutdoorLSR, Aoutdoor)
+        Nfloors = np.where(useLSR, NfloorsLSR, Nfloors)
+        Als_site = np.where(Aoutdoor == 0, 0, Als)
+        Ars_site = np.where(Aoutdoor == 0, 0, Ars)
+        
+        #Step 5: Layout Urban Form
+        Aba = (Afloor + AextraIndoor)/Nfloors
+        Aouts = A_res - Apa - Aba
+        Aon_rs = np.maximum(Ars_site - Apg, 0)
+        av_RESHDR = np.maximum(Als_site - Aon_rs, 0)   #Available WSUD Space for residential district
+        Aparking = self.calculateParkingAreaBatch(Aouts, Als_site, cpMin, cpMax, blockIDs)
+        Aimp = Aba + Aparking 
+        Aeff = Aimp * float(1- self.imperv_prop_dced/100)
+        Agarden = A_res - Aba - Aparking
+        
+        for name, values in [["HasFlats", np.ones(n)], ["avSt_RES", np.zeros(n)], ["HDRFlats", Naptunits], ["HDRRoofA", Aba],
+                             ["HDROccup", np.zeros(n) + self.occup_flat_avg], ["HDR_TIA", Aimp], ["HDR_EIA", Aeff],
+                             ["HDRFloors", Nfloors], ["av_HDRes", av_RESHDR], ["HDRGarden", Agarden], ["HDRCarPark", Aparking]]:
+            self.setBatchOutput(outputs, name, values, apartments)
+        
+        tally["TIA"] += np.where(apartments, Aimp, 0)
+        tally["EIA"] += np.where(apartments, Aeff, 0)
+        tally["Roof"] += np.where(apartments, Aba, 0)
+        tally["AvSpace"] += np.where(apartments, av_RESHDR, 0)
+        return True
+    
+    def calculateParkingAreaBatch(self, Aout, Alive, cpMin, cpMax, blockIDs):
+        """calculateParkingArea for arrays of Blocks, with parking_HDR = "Vary" every Block
+        draws on-site, off-site or varied parking."""
+        parking_HDR = np.array([self.parking_HDR] * len(Aout))
+        if self.parking_HDR == "Vary":
+            parking_HDR = np.array(["On", "Off", "Var"])[self.rng.randint(blockIDs, "ParkingHDR", 0, 2)]
+        avail_Parking = np.maximum(Aout - Alive, 0)
+        Aparking = np.where(avail_Parking > cpMax, avail_Parking - cpMax, avail_Parking)
+        return np.where(parking_HDR == "On", Aparking, 0)
+    
+    def buildNonResAreaBatch(self, outputs, tally, blk, blockIDs, map_attr, Aluc, type, hasname, frontage):
+        """buildNonResArea for arrays of Blocks, plans the estates of land use type on all Blocks
+        with Aluc != 0 and writes the attributes of the Blocks with a developable area."""
+        n = len(Aluc)
+        prefix = type
+        laneW = frontage[0].astype(np.float64)
+        nstrip = frontage[1].astype(np.float64)
+        fpath = frontage[2].astype(np.float64)
+        Wfrontage = laneW + nstrip + fpath
+        
+        #STEP 1: Determine employment in the area
+        if self.employment_mode == "I" and map_attr.getAttribute("include_employment").getDouble() == 1:
+            employed = blk["Employ"].copy()
+        elif self.employment_mode == "D":
+            employed = {"LI" : self.ind_edist, "HI" : self.ind_edist, "COM" : self.com_edist, "ORC" : self.orc_edist}[type]*Aluc/10000
+        else:
+            employed = np.zeros(n)
+        totalemployed = employed
+        employmentDens = employed /(Aluc/10000)      #Employment density [jobs/ha]
+        
+        #STEP 2: Subdivide the area and allocate employment
+        if type == "LI" or type == "HI":
+            blockthresh = np.round(self.rng.uniform(blockIDs, "Estate"+type, self.ind_subd_min, self.ind_subd_max), 1)
+        else:
+            blockthresh = np.round(self.rng.uniform(blockIDs, "Estate"+type, self.com_subd_min, self.com_subd_max), 1)
+        estates = np.maximum(np.trunc(Aluc/(blockthresh*10000)), 1)
+        Aestate = Aluc/estates
+        Westate = np.sqrt(Aestate)
+        Afrontage = Westate*Wfrontage + Wfrontage*(Westate-2*Wfrontage)
+        Aca = np.maximum(Aestate - Afrontage, 0)
+        employed = employmentDens * (Aestate/10000)
+        av_St = (nstrip/(laneW+nstrip+fpath)) * Afrontage
+        develop = (Aluc != 0) & (Aca != 0)
+        
+        #STEP 3: Determine building area, height, plot ratio balance for ONE estate
+        setbackmin = max(self.nres_minfsetback*float(not(self.nres_setback_auto)), 2.0)
+        Afloor = self.nonres_far[type] * employed
+        if type == "LI" or type == "HI":
+            Afootprintmax = self.maxplotratio_ind/100 * Aca
+        elif type == "COM":
+            Afootprintmax = self.maxplotratio_com/100 * Aca
+        else:       #type = "ORC", plot ratio rules do not apply, but instead setback rules, taken on 2 faces
+            Afootprintmax = Aca - 2.0*np.sqrt(Aca)*setbackmin
+        num_floors = np.trunc(Afloor/Afootprintmax + 1)
+        if type != "ORC" and not self.nres_nolimit_floors:
+            #Floors exceeded: increase the building footprint to the setback, if still exceeded use the maximum
+            #floors on the plot ratio footprint and reduce the employment accordingly
+            exceeded = num_floors > self.nres_maxfloors
+            Afootprintmaxadj = np.maximum(Aca - 2.0*np.sqrt(Aca)*setbackmin, 0)
+            adjfloors = np.where(Afootprintmaxadj != 0, np.trunc(Afloor/Afootprintmaxadj + 1), 0)
+            reduced = exceeded & (adjfloors > self.nres_maxfloors)
+            num_floors = np.where(reduced, self.nres_maxfloors, np.where(exceeded, adjfloors, num_floors))
+            Afloor = np.where(reduced, Afootprintmax * self.nres_maxfloors, Afloor)
+            employed = np.where(reduced, np.trunc(Afloor/self.nonres_far[type] + 1), employed)
+        
+        #STEP 4: Lay out site and determine parking and loading bay requirements
+        Afootprintfinal = np.where(num_floors == 0, 0, Afloor/num_floors)
+        Aloadingbay = Afloor/100.0 * self.loadingbay_A
+        if type == "LI" or type == "HI":
+            Acarpark = self.carpark_ind * employed * self.carpark_Wmin * self.carpark_Dmin
+        else:
+            Acarpark = self.carpark_com * Afloor/100 * self.carpark_Wmin * self.carpark_Dmin
+        minsetback = np.maximum(np.maximum(not(self.nres_setback_auto)*self.nres_minfsetback,
+                                           (num_floors/2+1.5)*self.nres_setback_auto*(num_floors <= 5)), 2.0)
+        setbackArea = np.sqrt(Aestate)*minsetback*2 - minsetback*minsetback       #take setback area on two faces
+        Asite_remain = Aca - Afootprintfinal - setbackArea
+        
+        #Step 4c: Try to fit carpark and loading bay on-site, otherwise stack
+        cases = [(Asite_remain - Acarpark - Aloadingbay) > 0, (Asite_remain - Aloadingbay) > 0, Asite_remain > 0]
+        Alandscape = np.select(cases, [(Asite_remain - Acarpark - Aloadingbay) + setbackArea, setbackArea,
+                                       np.maximum(setbackArea - Aloadingbay, 0)], np.maximum(Aca - Afootprintfinal, 0))
+        Outdoorcarpark = np.select(cases, [Acarpark, Asite_remain - Aloadingbay, 0], 0)
+        
+        #STEP 5: Landscaping
+        if self.lscape_hsbalance == -1:
+            prop_Soft = 0
+            prop_Hard = 1
+        elif self.lscape_hsbalance == 1:
+            prop_Soft = 1
+            prop_Hard = 0
+        else:
+            prop_Soft = 0.5
+            prop_Hard = 0.5
+        Agreen = prop_Soft * Alandscape
+        Aimp_total = Aca - Alandscape + prop_Hard * Alandscape
+        Aimp_connected = (1- self.lscape_impdced/100) * Aimp_total
+        FrontageEIA = Afrontage - av_St
+        
+        for name, values in [[hasname, np.ones(n)], [prefix+"jobs", totalemployed], [prefix+"estates", estates],
+                             ["avSt_"+prefix, av_St], [prefix+"Afront", Afrontage], [prefix+"AfrEIA", FrontageEIA],
+                             [prefix+"Aestate", Aestate], [prefix+"AeBldg", Afootprintfinal], [prefix+"Floors", num_floors],
+                             [prefix+"AeLoad", Aloadingbay], [prefix+"AeCPark", Outdoorcarpark], ["avLt_"+prefix, Agreen],
+                             [prefix+"AeLgrey", Alandscape - Agreen], [prefix+"AeEIA", Aimp_connected], [prefix+"AeTIA", Aimp_total]]:
+            self.setBatchOutput(outputs, name, values, develop)
+        
+        tally["Employed"] += np.where(develop, totalemployed, 0)
+        tally["TIA"] += np.where(develop, estates * (Aimp_total + FrontageEIA), 0)
+        tally["EIA"] += np.where(develop, estates * (Aimp_connected + 0.9*FrontageEIA), 0)
+        tally["Roof"] += np.where(develop, estates * Afootprintfinal, 0)
+        tally["AvSpace"] += np.where(develop, estates * (Agreen + av_St), 0)
+        return True
+    
     def keepBlockDataCheck(self, currentAttList, prevAttList):
         """Performs the dynamic checks on the current Block to see if its previous
         planning data can be transferred."""
@@ -1011,23 +1688,25 @@ class Urbplanbb(Module):
         which performs three possible options:
             1) Merges unclassified land with existing other LUCs: Parks, Reserves, Roads
             2) Treats Unclassified land as a special area with custom surface cover properties
-            3) Merges unclassified land with undeveloped land (default action if none of above options ticked)
+            3) Merges unclassified land with undeveloped land (default action if none of above options ticked,
+               or if the merge weights of all LUCs present in the Block are zero)
         """
+        weights = [self.unc_pgmerge * self.unc_pgmerge_w * bool(A_park > 0),
+                   self.unc_refmerge * self.unc_refmerge_w * bool(A_ref > 0),
+                   self.unc_rdmerge * self.unc_rdmerge_w * bool(A_rd > 0)]
         
         #Check if exceedence of threshold
         if self.unc_custom and A_unc >= (Atblock*self.unc_customthresh/100):  #Case 1: Treat land as its own
             unc_Aimp = A_unc * self.unc_customimp/100   #Surface cover
             unc_Aperv = A_unc - unc_Aimp
+            irrigateextra = 0
             if self.unc_landirrigate:   #determine if land needs to be irrigated
                 irrigateextra = unc_Aperv  #Add area to public irrigation
             
             otherarea = A_unc
             otherimp = unc_Aimp
             undevextra, pgextra, refextra, rdextra = 0,0,0,0
-        elif self.unc_merge and (A_park + A_ref + A_rd) > 0:            #Case 2: Merge area with other LUCs
-            weights = [self.unc_pgmerge * self.unc_pgmerge_w * bool(A_park > 0),
-                       self.unc_refmerge * self.unc_refmerge_w * bool(A_ref > 0),
-                       self.unc_rdmerge * self.unc_rdmerge_w * bool(A_rd > 0)]
+        elif self.unc_merge and (A_park + A_ref + A_rd) > 0 and sum(weights) > 0:            #Case 2: Merge area with other LUCs
             finaldiv = []
             for i in weights:
                 #Tally up division of areas
@@ -1111,9 +1790,11 @@ class Urbplanbb(Module):
         occupmin = self.occup_flat_avg  #Absolute min
         occupmax = self.occup_max       #Absolute max
         
+        currentID = int(currentAttList.getAttribute("BlockID").getDouble())
+        occupstream = self.rng.stream(currentID, "HouseOccup")
         occup = 0       #initialize to enter the loop
         while occup < occupmin or occup > occupmax or occup == 0:
-            occup = random.normalvariate(self.occup_avg, self.occup_avg/10)
+            occup = occupstream.normalvariate(self.occup_avg, self.occup_avg/10)
         #print "Block occupancy: ", occup
         
         resdict["HouseOccup"] = occup
@@ -1121,9 +1802,9 @@ class Urbplanbb(Module):
         res_fpw = self.adjustSampleRange(self.res_fpwmin, self.res_fpwmax, self.res_fpmed)
         res_nsw = self.adjustSampleRange(self.res_nswmin, self.res_nswmax, self.res_nsmed)
         lane_w = self.adjustSampleRange(self.lane_wmin, self.lane_wmax, self.lane_wmed)
-        Wfp = random.randint(res_fpw[0], res_fpw[1])
-        Wns = random.randint(res_nsw[0], res_nsw[1])
-        Wrd = random.randint(lane_w[0], lane_w[1])
+        Wfp = self.rng.randint(currentID, "ResFpW", res_fpw[0], res_fpw[1])
+        Wns = self.rng.randint(currentID, "ResNsW", res_nsw[0], res_nsw[1])
+        Wrd = self.rng.randint(currentID, "ResLaneW", lane_w[0], lane_w[1])
         Wfrontage = Wfp + Wns + Wrd
         
         #Step 2: Subdivide Area
@@ -1167,12 +1848,12 @@ class Urbplanbb(Module):
         resdict["ResHouses"] = Ndwunits
         
         if self.setback_f_med == 0:
-            fsetback = round(random.uniform(self.setback_f_min, self.setback_f_max),1)
+            fsetback = round(self.rng.uniform(currentID, "SetbackF", self.setback_f_min, self.setback_f_max),1)
         else:
             fsetback = (self.setback_f_min + self.setback_f_max)/2
         
         if self.setback_s_med == 0:
-            ssetback = round(random.uniform(self.setback_s_min, self.setback_s_max),1)
+            ssetback = round(self.rng.uniform(currentID, "SetbackS", self.setback_s_min, self.setback_s_max),1)
         else:
             ssetback = (self.setback_s_min + self.setback_s_max)/2
         
@@ -1200,44 +1881,24 @@ class Urbplanbb(Module):
         Apave = fsetback * self.w_driveway_min + Apatio + Aparking  #DRIVEWAY + PATIO + PARKING
         
         #Determine if need more floors
-        floors = 1
-        Aba = Alotfloor
-        while (Aba + Apave + Als) > Alot:
-            #print "Need more than ", floors, " floor(s)!"
-            floors += 1
-            Aba = Alotfloor/floors
+        floors = self.findLotFloors(Alotfloor, Apave + Als, Alot)
         
         #Retry #1 - Als set to Ars
         if floors > self.floor_num_max:
             Als = Ars       #set the remaining garden space to recreational space
-            floors = 1
-            Aba = Alotfloor
-            while (Aba + Apave + Als) > Alot:
-                #print "Even with less garden, need more than ", floors, "floor(s)!"
-                floors += 1
-                Aba = Alotfloor/floors
+            floors = self.findLotFloors(Alotfloor, Apave + Als, Alot)
         #Retry #2 - Remove Carpark Paving
         if floors > self.floor_num_max:
             if Agarage == 0:
-                Apave =- Aparking/2                         #DRIVEWAY + PATIO + half of PARKING since no garage!
+                Apave -= Aparking/2                         #DRIVEWAY + PATIO + half of PARKING since no garage!
             else: 
-                Apave =- Aparking                           #DRIVEWAY + PATIO
-            floors = 1
-            Aba = Alotfloor
-            while(Aba + Apave + Als) > Alot:
-                #print "Even with less garden and less carpark paving, need more than ", floors, "floor(s)!"
-                floors += 1
-                Aba = Alotfloor/floors
+                Apave -= Aparking                           #DRIVEWAY + PATIO
+            floors = self.findLotFloors(Alotfloor, Apave + Als, Alot)
         
         #Retry #3 - fsetback becomes ssetback (i.e. reduces paved driveway area even further)
         if floors > self.floor_num_max:
-            Apave =- (fsetback - ssetback)*self.w_driveway_min      #REDUCED DRIVEWAY + PATIO + either half of PARKING or NONE
-            floors = 1
-            Aba = Alotfloor
-            while(Aba + Apave + Als) > Alot:
-                #print "Even with less garden, carpark paving and driveway, need more than ", floors, "floor(s)!"
-                floors += 1
-                Aba = Alotfloor/floors
+            Apave -= (fsetback - ssetback)*self.w_driveway_min      #REDUCED DRIVEWAY + PATIO + either half of PARKING or NONE
+            floors = self.findLotFloors(Alotfloor, Apave + Als, Alot)
         
         #Last Resort - exceed floor limit
         if floors > self.floor_num_max:
@@ -1260,7 +1921,7 @@ class Urbplanbb(Module):
         roofconnect = self.roof_connected
         connectivity = ["Direct", "Disconnect"]
         if roofconnect == "Vary":
-            choice = random.randint(0, 1)
+            choice = self.rng.randint(currentID, "RoofConnect", 0, 1)
             roofconnect = connectivity[choice]
         if roofconnect == "Direct":
             AroofEff = Aba
@@ -1279,6 +1940,17 @@ class Urbplanbb(Module):
         
         return resdict
 
+    def findLotFloors(self, Alotfloor, Aother, Alot):
+        """Smallest number of floors for which the building footprint Alotfloor/floors and the
+        other lot uses Aother fit onto the lot, as calcLotFloors(). Lots on which even an
+        infinitely tall building does not fit get floor_num_max + 1 floors."""
+        if Aother >= Alot:
+            return int(self.floor_num_max) + 1
+        floors = 1
+        while (Alotfloor/floors + Aother) > Alot:
+            floors += 1
+        return floors
+
     def designResidentialApartments(self, currentAttList, map_attr, A_res, pop, ratios, Afloor):
         """Lays out the specified residential area with high density apartments for a given population
         and ratios for the block. Algorithm works within floor constraints, but ignores these if the site
@@ -1286,6 +1958,7 @@ class Urbplanbb(Module):
         """
         resdict = {}
         resdict["TypeApt"] = 1
+        currentID = int(currentAttList.getAttribute("BlockID").getDouble())
         
         #Step 2: Subdivide Area
         Apa = math.sqrt(A_res)*2*self.setback_HDR_avg + (math.sqrt(A_res)-self.setback_HDR_avg)*2*self.setback_HDR_avg
@@ -1336,7 +2009,7 @@ class Urbplanbb(Module):
             Aon_rs = max(Ars_site - Apg, 0)
             av_RESHDR = max(Als_site - Aon_rs, 0)   #Available WSUD Space for residential district
             
-            Aparking = self.calculateParkingArea(Aouts, Als_site, cpMin, cpMax)
+            Aparking = self.calculateParkingArea(Aouts, Als_site, cpMin, cpMax, currentID)
             Aimp = Aba + Aparking 
             Aeff = Aimp * float(1- self.imperv_prop_dced/100)
             Agarden = A_res - Aba - Aparking
@@ -1374,7 +2047,7 @@ class Urbplanbb(Module):
             Aon_rs = max(Ars_site - Apg, 0)
             av_RESHDR = max(Als_site - Aon_rs, 0)  #Available WSUD Space for residential district
                     
-            Aparking = self.calculateParkingArea(Aouts, Als_site, cpMin, cpMax)
+            Aparking = self.calculateParkingArea(Aouts, Als_site, cpMin, cpMax, currentID)
             Aimp = Aba + Aparking 
             Aeff = Aimp * float(1- self.imperv_prop_dced/100)
             Agarden = A_res - Aba - Aparking
@@ -1411,7 +2084,7 @@ class Urbplanbb(Module):
         Aon_rs = max(Ars_site - Apg,0)
         av_RESHDR = max(Als_site - Aon_rs, 0)
             
-        Aparking = self.calculateParkingArea(Aouts, Als_site, cpMin, cpMax)
+        Aparking = self.calculateParkingArea(Aouts, Als_site, cpMin, cpMax, currentID)
         Aimp = Aba + Aparking 
         Aeff = Aimp * float(1- self.imperv_prop_dced/100)
         Agarden = A_res - Aba - Aparking
@@ -1428,7 +2101,7 @@ class Urbplanbb(Module):
         
         return resdict
 
-    def calculateParkingArea(self, Aout, Alive, cpMin, cpMax):
+    def calculateParkingArea(self, Aout, Alive, cpMin, cpMax, currentID):
         """Determines the total outdoor parking space on the HDR site based on OSR's remaining
         available space, using information about parking requirements, liveability space and
         inputs.
@@ -1438,23 +2111,25 @@ class Urbplanbb(Module):
             - Alive - Liveability space on-site = LSR x LA or zero if all area is leveraged by park
             - cpMin - minimum area required for car parks
             - cpMax - maximum area required for car parks
+            - currentID - Block ID, selects the Block's random stream if parking varies
         Outputs:
             - Aparking - area of parking outside
         """
-        if self.parking_HDR == "Vary":
+        parking_HDR = self.parking_HDR
+        if parking_HDR == "Vary":
             park_options = ["On", "Off", "Var"]
-            choice = random.randint(0, 2)
+            choice = self.rng.randint(currentID, "ParkingHDR", 0, 2)
             parking_HDR = park_options[choice]
         
-        if self.parking_HDR == "On":
+        if parking_HDR == "On":
             avail_Parking = max(Aout - Alive,0)
             if avail_Parking < cpMin:
                 Aparking = avail_Parking
-            elif avail_Parking <cpMax:
+            elif avail_Parking <= cpMax:
                 Aparking = avail_Parking
-            elif avail_Parking > cpMax:
+            else:
                 Aparking = avail_Parking - cpMax
-        elif parking_HDR == "Off" or parking_HDR == "Var":
+        else:       #"Off" or "Var"
             Aparking = 0
         return Aparking
 
@@ -1545,6 +2220,7 @@ class Urbplanbb(Module):
         building, carparks, service/loading bay and landscaping."""
         
         nresdict = {}
+        currentID = int(currentAttList.getAttribute("BlockID").getDouble())
         #Note: Auto-setback
         #The formula to calculate auto-setback = H/2 + 1.5m based on Monash Council's Documents
         #This, however, relates more predominantly to facilities in close proximity to residential
@@ -1573,9 +2249,9 @@ class Urbplanbb(Module):
         
         #STEP 2: Subdivide the area and allocate employment
         if type == "LI" or type == "HI":
-            blockthresh = round(random.uniform(self.ind_subd_min, self.ind_subd_max), 1)
+            blockthresh = round(self.rng.uniform(currentID, "Estate"+type, self.ind_subd_min, self.ind_subd_max), 1)
         elif type == "ORC" or type == "COM":
-            blockthresh = round(random.uniform(self.com_subd_min, self.com_subd_max), 1)
+            blockthresh = round(self.rng.uniform(currentID, "Estate"+type, self.com_subd_min, self.com_subd_max), 1)
         
         estates = float(max(int(Aluc/(blockthresh*10000)),1))
         Aestate = Aluc/float(estates)
@@ -1754,6 +2430,9 @@ class Urbplanbb(Module):
                 employed = self.orc_edist*Aluc/10000
             else:
                 print "Something's wrong here..."
+                employed = 0
+        else:
+            employed = 0    #"I" without employment data on the Blocks
         return employed
 
     def scaleEmployment(self, currentAttList, employed, Aluc):
@@ -1916,6 +2595,8 @@ class Urbplanbb(Module):
     ########################################################   
     
     def getBlockUUID(self, blockid,city):
+	if self.blockstore is not None:
+		return self.blockstore.record(blockid)     #attributes are read and written through the Block attribute store
 	try:
             key = self.BLOCKIDtoUUID[blockid]
 	except KeyError: